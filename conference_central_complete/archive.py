@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+"""archive.py
+
+Conference Central hot/cold archival of finished conferences
+
+A conference that ended more than ARCHIVE_AFTER_DAYS ago is moved, with
+everything stored under it (sessions, session details, attendee stats,
+notification jobs) and the wishlist items pointing at it, into the
+ARCHIVE_NAMESPACE. Archived entities keep their key paths, only the
+namespace changes, so websafe keys held elsewhere (profiles, wishlists)
+still identify them and can be resolved against the archive on request.
+Queries in the default namespace, and their indexes, only see live data.
+
+Entities are copied before the originals are deleted, so a move that is
+interrupted can simply be run again.
+
+"""
+
+from datetime import date
+from datetime import timedelta
+
+from google.appengine.ext import ndb
+
+from models import Conference
+from models import SessionWishlistItem
+import stats
+
+ARCHIVE_NAMESPACE = 'archive'
+HOT_NAMESPACE = ''
+ARCHIVE_AFTER_DAYS = 30
+MOVE_BATCH_SIZE = 500
+
+stats.register('archive.conferences', 'archive.entities', 'archive.restored')
+
+
+def archivedKey(key):
+    """Return the key an entity has once archived."""
+    return ndb.Key(pairs=key.pairs(), app=key.app(), namespace=ARCHIVE_NAMESPACE)
+
+
+def hotKey(key):
+    """Return the key an entity has while live."""
+    return ndb.Key(pairs=key.pairs(), app=key.app(), namespace=HOT_NAMESPACE)
+
+
+def isArchived(key):
+    """Return True if a key is in the archive."""
+    return key.namespace() == ARCHIVE_NAMESPACE
+
+
+def getMulti(keys, include_archived=False, **ctx_options):
+    """Like ndb.get_multi, but when include_archived is set,
+        entities missing from the live data are looked up in the archive.
+    """
+    entities = ndb.get_multi(keys, **ctx_options)
+    if include_archived:
+        missing = [i for i, entity in enumerate(entities) if entity is None]
+        archived = ndb.get_multi([archivedKey(keys[i]) for i in missing],
+                                 **ctx_options)
+        for i, entity in zip(missing, archived):
+            entities[i] = entity
+    return entities
+
+
+def archiveCandidates(today=None):
+    """Return keys of live conferences that ended long enough ago
+        to be archived, except those restored to stay live.
+    """
+    cutoff = (today or date.today()) - timedelta(days=ARCHIVE_AFTER_DAYS)
+    return [conf.key for conf in Conference.query(Conference.endDate < cutoff)
+            if not conf.keepLive]
+
+
+def _descendantKeys(conf_key):
+    """Return the keys of a conference, everything under it,
+        and the wishlist items referring to it.
+    """
+    keys = [key for key in ndb.Query(ancestor=conf_key).fetch(keys_only=True)
+            if key != conf_key]
+    keys.extend(SessionWishlistItem.query(
+        SessionWishlistItem.parent_wsck == hotKey(conf_key).urlsafe(),
+        namespace=conf_key.namespace()).fetch(keys_only=True))
+    # the conference goes last: while it is still in place,
+    #   an interrupted move is found and finished by the next run
+    keys.append(conf_key)
+    return keys
+
+
+def moveConference(conf_key, to_archive=True):
+    """Move a conference and its entities into or out of the archive.
+       Returns the number of entities moved.
+    """
+    if to_archive:
+        source, destination = hotKey(conf_key), archivedKey
+    else:
+        source, destination = archivedKey(conf_key), hotKey
+
+    keys = _descendantKeys(source)
+    for start in range(0, len(keys), MOVE_BATCH_SIZE):
+        batch = keys[start:start + MOVE_BATCH_SIZE]
+        entities = [entity for entity in ndb.get_multi(batch) if entity is not None]
+        for entity in entities:
+            entity.key = destination(entity.key)
+        ndb.put_multi(entities)
+        ndb.delete_multi(batch)
+
+    if to_archive:
+        stats.incrMulti({'archive.conferences': 1, 'archive.entities': len(keys)})
+    else:
+        stats.incr('archive.restored')
+    return len(keys)
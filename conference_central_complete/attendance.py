@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+
+"""attendance.py
+
+Conference Central attendee stats backfill and attendee exports
+
+ConferenceAttendeeStats is kept up to date by the registration
+transactions (ConferenceApi._recordAttendance), but a conference that
+had attendees before its stats existed needs them counted once. The
+first change recorded for such a conference starts a backfill: an
+AttendeeStatsBackfill under the conference pages through the Profiles
+attending it, in key order, counting them, and when the last page is
+counted its counts replace the stats'. Each step queues the next in the
+same transaction that records its progress, like snapshot.py.
+
+A change recorded while a backfill runs goes into the stats as usual,
+and into the backfill's counts as well if its profile is one the
+backfill has already paged past, so the counts it writes at the end
+include it. A change that lands while its page is being read can still
+be missed. Daily registrations are not backfilled: profiles don't
+record when they registered.
+
+An export writes a conference's attendees as CSV or NDJSON, one file
+per page of EXPORT_PAGE_SIZE profiles, through the snapshot target
+(snapshot.getTarget), so memory use doesn't grow with the conference:
+
+    exports/attendees/<conference id>/<time>/part-00000.csv
+
+"""
+
+import csv
+import json
+from cStringIO import StringIO
+from datetime import datetime
+
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from models import AttendeeExportJob
+from models import AttendeeStatsBackfill
+from models import ConferenceAttendeeStats
+from models import Profile
+import snapshot
+
+BACKFILL_PAGE_SIZE = 500
+EXPORT_PAGE_SIZE = 500
+EXPORT_FIELDS = ('displayName', 'mainEmail', 'teeShirtSize')
+# export format -> content type
+EXPORT_FORMATS = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+CHUNK_NAME_TPL = '%s/part-%05d.%s'
+
+
+def statsKey(conf_key):
+    """Return the key of a conference's ConferenceAttendeeStats."""
+    return ndb.Key(ConferenceAttendeeStats, 1, parent=conf_key)
+
+
+def backfillKey(conf_key):
+    """Return the key of a conference's AttendeeStatsBackfill."""
+    return ndb.Key(AttendeeStatsBackfill, 1, parent=conf_key)
+
+
+def _attendeeQuery(conf_key):
+    """Return the query for the Profiles attending a conference."""
+    return Profile.query(Profile.conferenceKeysToAttend == conf_key.urlsafe())
+
+
+def applyChanges(entity, changes):
+    """Add changes, (profile key, {size: delta}, registrations) tuples,
+        to the attendees and sizeCounts of stats or a backfill.
+       Counts never go below zero.
+    """
+    sizes = dict(entity.sizeCounts or {})
+    registrations = 0
+    for _, size_deltas, delta in changes:
+        for size, count in size_deltas.items():
+            sizes[size] = sizes.get(size, 0) + count
+        registrations += delta
+    entity.sizeCounts = dict((size, count) for size, count in sizes.items() if count > 0)
+    entity.attendees = max(0, entity.attendees + registrations)
+
+
+def startBackfill(report):
+    """Start counting a conference's attendees into its stats, unless a
+        count was started before. Call inside a transaction on the
+        conference's entity group, then put the report.
+    """
+    if report.backfill:
+        return
+    conf_key = report.key.parent()
+    report.backfill = 'RUNNING'
+    AttendeeStatsBackfill(key=backfillKey(conf_key)).put()
+    taskqueue.add(url='/tasks/backfill_attendee_stats',
+                  params={'conf': conf_key.urlsafe(), 'step': 0},
+                  transactional=True)
+
+
+def recordInBackfill(report, changes):
+    """Add changes to a running backfill's counts, for the profiles it
+        has already paged past. Call in the transaction recording the
+        changes in report.
+    """
+    if report.backfill != 'RUNNING':
+        return
+    job = backfillKey(report.key.parent()).get()
+    if not job or job.lastProfile is None:
+        return
+    passed = [change for change in changes
+              if change[0] is not None and change[0].id() <= job.lastProfile]
+    if passed:
+        applyChanges(job, passed)
+        job.put()
+
+
+def backfillStep(conf_key, step):
+    """Count one page of a conference's attendees, then queue the next step."""
+    job = backfillKey(conf_key).get()
+    if not job or job.status != 'RUNNING' or job.step != step:
+        # finished, or a duplicate of a step that already ran
+        return
+
+    cursor = Cursor(urlsafe=job.cursor) if job.cursor else None
+    profiles, next_cursor, more = _attendeeQuery(conf_key).fetch_page(
+        BACKFILL_PAGE_SIZE, start_cursor=cursor)
+    _advanceBackfill(conf_key, step, profiles,
+                     next_cursor.urlsafe() if more and next_cursor else None)
+
+
+@ndb.transactional()
+def _advanceBackfill(conf_key, step, profiles, next_cursor):
+    """Add a counted page to the backfill and queue the next step, or
+        replace the stats' counts after the last page, atomically.
+    """
+    job, report = ndb.get_multi([backfillKey(conf_key), statsKey(conf_key)])
+    if job.step != step:
+        return
+
+    applyChanges(job, [(prof.key, {prof.teeShirtSize: 1}, 1) for prof in profiles])
+    if profiles:
+        job.lastProfile = profiles[-1].key.id()
+    job.cursor = next_cursor
+    job.step += 1
+    if next_cursor:
+        taskqueue.add(url='/tasks/backfill_attendee_stats',
+                      params={'conf': conf_key.urlsafe(), 'step': job.step},
+                      transactional=True)
+    else:
+        job.status = 'DONE'
+        report = report or ConferenceAttendeeStats(key=statsKey(conf_key))
+        report.attendees = job.attendees
+        report.sizeCounts = dict(job.sizeCounts)
+        report.backfill = 'DONE'
+        report.put()
+    job.put()
+
+
+def encodePage(profiles, fmt, header=False):
+    """Return one page of attendees as CSV or NDJSON."""
+    buf = StringIO()
+    if fmt == 'ndjson':
+        for prof in profiles:
+            buf.write(json.dumps(dict((field, getattr(prof, field) or '')
+                                      for field in EXPORT_FIELDS)) + '\n')
+    else:
+        writer = csv.writer(buf)
+        if header:
+            writer.writerow(EXPORT_FIELDS)
+        for prof in profiles:
+            writer.writerow([(getattr(prof, field) or '').encode('utf-8')
+                             for field in EXPORT_FIELDS])
+    return buf.getvalue()
+
+
+def chunkNames(job):
+    """Return the names of the files an export has written."""
+    return [CHUNK_NAME_TPL % (job.prefix, chunk, job.format)
+            for chunk in range(job.chunks)]
+
+
+def startExport(conf_key, fmt):
+    """Create an AttendeeExportJob for a conference and queue its first step."""
+    job = AttendeeExportJob(parent=conf_key, format=fmt)
+    job.started = datetime.utcnow()
+    job.prefix = 'exports/attendees/%s/%s' % (
+        conf_key.id(), job.started.strftime('%Y%m%dT%H%M%S'))
+    _queueFirstExportStep(job)
+    return job
+
+
+@ndb.transactional()
+def _queueFirstExportStep(job):
+    job.put()
+    taskqueue.add(url='/tasks/export_attendees',
+                  params={'job': job.key.urlsafe(), 'step': 0},
+                  transactional=True)
+
+
+def exportStep(job_key, step, target=None):
+    """Write one page of attendees to a file, then queue the next step."""
+    job = job_key.get()
+    if not job or job.status != 'RUNNING' or job.step != step:
+        # finished, or a duplicate of a step that already ran
+        return
+
+    cursor = Cursor(urlsafe=job.cursor) if job.cursor else None
+    profiles, next_cursor, more = _attendeeQuery(job_key.parent()).fetch_page(
+        EXPORT_PAGE_SIZE, start_cursor=cursor)
+
+    # the first file is written even if empty, for the CSV header;
+    #   a retried step rewrites the same file
+    wrote = bool(profiles) or step == 0
+    if wrote:
+        (target or snapshot.getTarget()).write(
+            CHUNK_NAME_TPL % (job.prefix, job.chunks, job.format),
+            encodePage(profiles, job.format, header=step == 0),
+            EXPORT_FORMATS[job.format])
+
+    _advanceExport(job_key, step, len(profiles), wrote,
+                   next_cursor.urlsafe() if more and next_cursor else None)
+
+
+@ndb.transactional()
+def _advanceExport(job_key, step, rows, wrote, next_cursor):
+    """Record an exported page and queue the next step, atomically."""
+    job = job_key.get()
+    if job.step != step:
+        return
+
+    job.rows += rows
+    if wrote:
+        job.chunks += 1
+    job.cursor = next_cursor
+    job.step += 1
+    if next_cursor:
+        taskqueue.add(url='/tasks/export_attendees',
+                      params={'job': job_key.urlsafe(), 'step': job.step},
+                      transactional=True)
+    else:
+        job.status = 'DONE'
+    job.put()
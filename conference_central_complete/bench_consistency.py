@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+
+"""bench_consistency.py
+
+Conference Central read latency by consistency mode
+
+Calls the endpoints taking a `consistency` field (consistency.py) on a
+running app, alternating STRONG and EVENTUAL calls so both modes see the
+same load, and reports latency percentiles per endpoint and mode:
+
+    python bench_consistency.py https://<app>.appspot.com <websafeConferenceKey>
+
+Endpoints that need a signed-in user are only measured when --token
+passes an OAuth access token. Run it against a deployed app: the dev
+server's datastore stub applies writes at once, so both modes cost the
+same there. Write some sessions to the conference while it runs to see
+what strong reads pay for waiting on pending writes.
+
+Registration, wishlist and room booking checks always read strongly
+and have no mode to compare.
+
+"""
+
+import argparse
+import json
+import time
+import urllib
+import urllib2
+
+API_PATH = '/_ah/api/conference/v1/'
+MODES = ('STRONG', 'EVENTUAL')
+
+# name, HTTP method, path, query, body, where the mode goes, needs a user
+ENDPOINTS = (
+    ('getConference', 'GET', 'conference/%(wsck)s', {}, None, 'query', False),
+    ('getConferenceSessions', 'GET', 'getConferenceSessions',
+     {'websafeKey': '%(wsck)s'}, None, 'query', False),
+    ('getConferenceSessionsByType', 'POST', 'getConferenceSessionsByType',
+     {'parent_wsck': '%(wsck)s'}, {'session_type': '%(session_type)s'}, 'body', False),
+    ('getConferencesCreated', 'POST', 'getConferencesCreated', {}, None, 'query', True),
+    ('getConferencesToAttend', 'GET', 'conferences/attending', {}, None, 'query', True),
+    ('getSessionsInWishlist', 'POST', 'getSessionsInWishlist',
+     {}, {'wsck': '%(wsck)s'}, 'body', True),
+)
+
+
+def _fill(value, params):
+    """Substitute params into the strings of a query or body."""
+    if value is None:
+        return None
+    return dict((key, item % params) for key, item in value.items())
+
+
+def call(base_url, endpoint, mode, params, token=None):
+    """Call an endpoint once; returns (seconds taken, HTTP status)."""
+    _, method, path, query, body, where, _ = endpoint
+    query, body = _fill(query, params), _fill(body, params)
+    if where == 'body':
+        body['consistency'] = mode
+    else:
+        query['consistency'] = mode
+    url = base_url.rstrip('/') + API_PATH + path % params + '?' + urllib.urlencode(query)
+    data = json.dumps(body or {}) if method == 'POST' else None
+    request = urllib2.Request(url, data, {'Content-Type': 'application/json'})
+    request.get_method = lambda: method
+    if token:
+        request.add_header('Authorization', 'Bearer %s' % token)
+
+    start = time.time()
+    try:
+        urllib2.urlopen(request).read()
+        status = 200
+    except urllib2.HTTPError as e:
+        status = e.code
+    return time.time() - start, status
+
+
+def percentile(values, fraction):
+    """Return a percentile of a list of numbers."""
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('url', help='base URL of the app')
+    parser.add_argument('wsck', help='websafe key of a conference with sessions')
+    parser.add_argument('--calls', type=int, default=100,
+                        help='calls per endpoint and mode')
+    parser.add_argument('--session-type', default='lecture')
+    parser.add_argument('--token', help='OAuth access token of a user')
+    args = parser.parse_args()
+
+    params = {'wsck': args.wsck, 'session_type': args.session_type}
+    print '%-28s %-9s %8s %8s %8s %7s' % ('endpoint', 'mode', 'p50 ms', 'p95 ms',
+                                          'mean ms', 'errors')
+    for endpoint in ENDPOINTS:
+        if endpoint[6] and not args.token:
+            continue
+        timings = dict((mode, []) for mode in MODES)
+        errors = dict((mode, 0) for mode in MODES)
+        for _ in range(args.calls):
+            for mode in MODES:
+                seconds, status = call(args.url, endpoint, mode, params, args.token)
+                if status == 200:
+                    timings[mode].append(seconds * 1000)
+                else:
+                    errors[mode] += 1
+        for mode in MODES:
+            ms = timings[mode] or [0]
+            print '%-28s %-9s %8.1f %8.1f %8.1f %7d' % (
+                endpoint[0], mode, percentile(ms, 0.5), percentile(ms, 0.95),
+                sum(ms) / len(ms), errors[mode])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+
+"""bench_etag.py
+
+Conference Central read latency with and without ETags
+
+Calls the endpoints taking an `ifNoneMatch` field on a running app,
+alternating plain calls with conditional ones that send the ETag of the
+first response, and reports latency percentiles and response size per
+endpoint and mode, and how many conditional calls came back notModified:
+
+    python bench_etag.py https://<app>.appspot.com <websafeConferenceKey>
+
+Run it against a deployed app, on a conference with sessions, and set an
+announcement first (/crons/set_announcement) so getAnnouncement has one
+to tag. Writes to the conference while it runs change the ETag; the
+conditional calls then pay for a full read until the next run.
+
+"""
+
+import argparse
+import json
+import time
+import urllib
+import urllib2
+
+API_PATH = '/_ah/api/conference/v1/'
+MODES = ('plain', 'ifNoneMatch')
+
+# name, path, query
+ENDPOINTS = (
+    ('getConference', 'conference/%(wsck)s', {}),
+    ('getConferenceSessions', 'getConferenceSessions', {'websafeKey': '%(wsck)s'}),
+    ('getAnnouncement', 'conference/announcement/get', {}),
+)
+
+
+def call(base_url, endpoint, params, etag=None):
+    """Call an endpoint once.
+       Returns (seconds taken, HTTP status, response bytes, response JSON).
+    """
+    _, path, query = endpoint
+    query = dict((key, value % params) for key, value in query.items())
+    if etag:
+        query['ifNoneMatch'] = etag
+    url = base_url.rstrip('/') + API_PATH + path % params
+    if query:
+        url += '?' + urllib.urlencode(query)
+
+    start = time.time()
+    try:
+        body = urllib2.urlopen(url).read()
+        status = 200
+    except urllib2.HTTPError as e:
+        body = ''
+        status = e.code
+    seconds = time.time() - start
+    return seconds, status, len(body), json.loads(body) if body else {}
+
+
+def percentile(values, fraction):
+    """Return a percentile of a list of numbers."""
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('url', help='base URL of the app')
+    parser.add_argument('wsck', help='websafe key of a conference with sessions')
+    parser.add_argument('--calls', type=int, default=100,
+                        help='calls per endpoint and mode')
+    args = parser.parse_args()
+
+    params = {'wsck': args.wsck}
+    print '%-22s %-12s %8s %8s %8s %8s %7s %7s' % (
+        'endpoint', 'mode', 'p50 ms', 'p95 ms', 'mean ms', 'bytes',
+        'not mod', 'errors')
+    for endpoint in ENDPOINTS:
+        _, status, _, first = call(args.url, endpoint, params)
+        etag = first.get('etag')
+        if status != 200 or not etag:
+            print '%-22s no ETag in the first response (HTTP %d); skipped' % (
+                endpoint[0], status)
+            continue
+
+        timings = dict((mode, []) for mode in MODES)
+        sizes = dict((mode, []) for mode in MODES)
+        errors = dict((mode, 0) for mode in MODES)
+        not_modified = 0
+        for _ in range(args.calls):
+            for mode in MODES:
+                seconds, status, size, body = call(
+                    args.url, endpoint, params,
+                    etag if mode == 'ifNoneMatch' else None)
+                if status != 200:
+                    errors[mode] += 1
+                    continue
+                timings[mode].append(seconds * 1000)
+                sizes[mode].append(size)
+                if body.get('notModified'):
+                    not_modified += 1
+        for mode in MODES:
+            ms = timings[mode] or [0]
+            size = sizes[mode] or [0]
+            print '%-22s %-12s %8.1f %8.1f %8.1f %8d %7s %7d' % (
+                endpoint[0], mode, percentile(ms, 0.5), percentile(ms, 0.95),
+                sum(ms) / len(ms), sum(size) / len(size),
+                not_modified if mode == 'ifNoneMatch' else '-', errors[mode])
+
+
+if __name__ == '__main__':
+    main()
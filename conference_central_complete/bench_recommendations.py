@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+
+"""bench_recommendations.py
+
+Conference Central co-wishlist counting cost
+
+Generates wishlists for --users users over --sessions sessions, with a
+skewed session popularity, and counts them with the CooccurrenceIndex of
+recommendations.py two ways:
+
+    one pass    a single index over every wishlist, as one request
+                would hold it
+    paged       the rebuild task chain: one index per page of
+                SCAN_PAGE_SIZE items, added into per-session counts
+                pruned at PRUNE_AT, like the NeighborCounts entities
+
+and reports the time, the counters held and the memory growth of each,
+the largest working set of a paged step, and how many of the one-pass
+top neighbors the paged build agrees on. Datastore time is not
+included.
+
+    python bench_recommendations.py --sdk ~/google_appengine
+
+"""
+
+import argparse
+import os
+import random
+import resource
+import time
+
+
+def _maxRssMb():
+    """Return the peak resident memory of the process in MB (Linux)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def makeWishlists(users, sessions, items, seed):
+    """Return one list of session ids per user, about items in all,
+        with session popularity following a power law.
+    """
+    rng = random.Random(seed)
+    weights = [1.0 / (rank + 1) ** 0.8 for rank in range(sessions)]
+    total = sum(weights)
+    cumulative, acc = [], 0.0
+    for weight in weights:
+        acc += weight / total
+        cumulative.append(acc)
+
+    def pick():
+        x = rng.random()
+        lo, hi = 0, sessions - 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if cumulative[mid] < x:
+                lo = mid + 1
+            else:
+                hi = mid
+        return 's%05d' % lo
+
+    per_user = float(items) / users
+    return [[pick() for _ in range(max(1, int(rng.expovariate(1 / per_user))))]
+            for _ in range(users)]
+
+
+def onePass(recommendations, wishlists):
+    """Count every wishlist in one index; returns (index, seconds)."""
+    t0 = time.time()
+    index = recommendations.CooccurrenceIndex()
+    for sessions in wishlists:
+        index.addWishlist(sessions)
+    return index, time.time() - t0
+
+
+def paged(recommendations, wishlists):
+    """Count wishlists page by page as the rebuild steps do.
+       Returns (per-session counts, seconds, steps, largest step working set).
+    """
+    t0 = time.time()
+    counts = {}
+    steps = largest = 0
+    page, page_items = [], 0
+    for i, sessions in enumerate(wishlists):
+        page.append(sessions)
+        page_items += len(sessions)
+        if page_items < recommendations.SCAN_PAGE_SIZE and i < len(wishlists) - 1:
+            continue
+        index = recommendations.CooccurrenceIndex(
+            prune_at=recommendations.SCAN_PAGE_SIZE + page_items)
+        for user_sessions in page:
+            index.addWishlist(user_sessions)
+        working = 0
+        for session, counter in index.counts.items():
+            merged = counts.get(session, {})
+            working += len(counter) + len(merged)
+            for other, count in counter.items():
+                merged[other] = merged.get(other, 0) + count
+            counts[session] = recommendations._prune(merged, recommendations.PRUNE_AT)
+        largest = max(largest, working)
+        steps += 1
+        page, page_items = [], 0
+    return counts, time.time() - t0, steps, largest
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--sdk', default=os.environ.get('GAE_SDK', ''),
+                        help='path to the App Engine Python SDK')
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--sessions', type=int, default=5000)
+    parser.add_argument('--items', type=int, default=1000000,
+                        help='wishlist items in all')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    if not args.sdk:
+        parser.error('--sdk or GAE_SDK is required')
+
+    from replay import _setupPaths
+    _setupPaths(args.sdk)
+    import recommendations
+
+    wishlists = makeWishlists(args.users, args.sessions, args.items, args.seed)
+    print '%d wishlist items from %d users over %d sessions' % (
+        sum(len(w) for w in wishlists), len(wishlists), args.sessions)
+
+    baseline = _maxRssMb()
+    index, seconds = onePass(recommendations, wishlists)
+    t0 = time.time()
+    top = {}
+    for session in index.counts:
+        top[session] = index.neighbors(session)
+    print 'one pass: %.1fs to count, %.1fs for top-K, %d counters, %+.0f MB' % (
+        seconds, time.time() - t0, sum(len(c) for c in index.counts.values()),
+        _maxRssMb() - baseline)
+    del index
+
+    counts, seconds, steps, largest = paged(recommendations, wishlists)
+    agree = total = 0
+    for session, neighbors in top.items():
+        expected = set(other for other, _ in neighbors)
+        got = set(other for other, _ in recommendations._top(counts.get(session, {})))
+        agree += len(expected & got)
+        total += len(expected)
+    print 'paged:    %.1fs in %d steps, at most %d counters per step, %d stored' % (
+        seconds, steps, largest, sum(len(c) for c in counts.values()))
+    print 'paged top-K agrees with one pass on %.1f%% of neighbors' % (
+        100.0 * agree / max(1, total))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+
+"""bench_singleflight.py
+
+Conference Central stampede check for singleflight.py
+
+Starts --callers threads at once against one memcache key whose value
+takes --recompute-ms to compute, in five cases:
+
+    cold        the key is missing
+    stale       the key is cached but due for refresh
+    background  the same, with the recompute registered so it is
+                refreshed by one task instead of inline
+    stuck       the key is missing and a lease is held by a caller that
+                never finishes, so everyone waits WAIT_TIMEOUT and
+                recomputes
+    plain       the key is missing and callers use memcache get/set
+                without singleflight, for comparison
+
+and reports how many times the value was recomputed and the callers'
+latency percentiles. It exits with status 1 if the cold or stale case
+recomputes more than once, or the background case doesn't queue exactly
+one refresh and serve every caller the stale value. Memcache and the
+task queue are the SDK's in-process stubs:
+
+    python bench_singleflight.py --sdk ~/google_appengine
+
+"""
+
+import argparse
+import os
+import sys
+import threading
+import time
+
+KEY = 'bench_singleflight'
+REFRESH_URL = '/tasks/refresh_cache'
+
+
+def percentile(values, fraction):
+    """Return a percentile of a list of numbers."""
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+class Recompute(object):
+    """A slow recompute that counts its calls."""
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        with self._lock:
+            self.calls += 1
+        time.sleep(self.seconds)
+        return 'fresh'
+
+
+def stampede(read, callers):
+    """Run read() in callers threads started together.
+       Returns (latencies in ms, values read).
+    """
+    start = threading.Event()
+    latencies, values = [], []
+    lock = threading.Lock()
+
+    def caller():
+        start.wait()
+        t0 = time.time()
+        value = read()
+        with lock:
+            latencies.append((time.time() - t0) * 1000)
+            values.append(value)
+
+    threads = [threading.Thread(target=caller) for _ in range(callers)]
+    for thread in threads:
+        thread.start()
+    start.set()
+    for thread in threads:
+        thread.join()
+    return latencies, values
+
+
+def runCase(bed, name, callers, seconds):
+    """Prepare memcache for a case and stampede it.
+       Returns (recomputes, latencies in ms, values read, refreshes queued).
+    """
+    from google.appengine.api import memcache
+    import singleflight
+
+    memcache.flush_all()
+    queue = bed.get_stub('taskqueue')
+    queue.FlushQueue('default')
+    recompute = Recompute(seconds)
+    singleflight.register('bench', recompute)
+    if name in ('stale', 'background'):
+        singleflight.store(KEY, 'stale', soft_ttl=-1)
+    elif name == 'stuck':
+        memcache.add(singleflight.LEASE_TPL % KEY, True,
+                     time=singleflight.LEASE_TTL)
+
+    if name == 'plain':
+        def read():
+            value = memcache.get(KEY)
+            if value is None:
+                value = recompute()
+                memcache.set(KEY, value)
+            return value
+    elif name == 'background':
+        def read():
+            return singleflight.get(KEY, recompute, refresh=('bench', []))
+    else:
+        def read():
+            return singleflight.get(KEY, recompute)
+
+    latencies, values = stampede(read, callers)
+    calls = recompute.calls
+    tasks = queue.get_filtered_tasks(url=REFRESH_URL)
+    return calls, latencies, values, len(tasks)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--sdk', default=os.environ.get('GAE_SDK', ''),
+                        help='path to the App Engine Python SDK')
+    parser.add_argument('--callers', type=int, default=50)
+    parser.add_argument('--recompute-ms', type=int, default=200)
+    args = parser.parse_args()
+    if not args.sdk:
+        parser.error('--sdk or GAE_SDK is required')
+
+    from replay import _setupPaths
+    _setupPaths(args.sdk)
+    from google.appengine.ext import testbed
+
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.init_memcache_stub()
+    bed.init_taskqueue_stub(root_path=os.path.dirname(os.path.abspath(__file__)))
+
+    print '%d callers, %d ms recompute' % (args.callers, args.recompute_ms)
+    print '%-10s %10s %8s %8s %8s %7s %7s' % ('case', 'recomputes', 'p50 ms',
+                                             'p95 ms', 'max ms', 'stale', 'tasks')
+    failed = False
+    for name in ('cold', 'stale', 'background', 'stuck', 'plain'):
+        calls, latencies, values, tasks = runCase(bed, name, args.callers,
+                                                  args.recompute_ms / 1000.0)
+        print '%-10s %10d %8.1f %8.1f %8.1f %7d %7d' % (
+            name, calls, percentile(latencies, 0.5), percentile(latencies, 0.95),
+            max(latencies), values.count('stale'), tasks)
+        if name in ('cold', 'stale') and calls != 1:
+            failed = True
+        if name == 'background' and (
+                calls or tasks != 1 or values.count('stale') != args.callers):
+            failed = True
+    bed.deactivate()
+
+    if failed:
+        print 'FAIL: a stampede recomputed more than once or refreshed inline'
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
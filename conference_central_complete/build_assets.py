@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+
+"""build_assets.py
+
+Conference Central frontend build: bundles the app's own JS, CSS and
+Angular partials into two content-hashed files under static/dist.
+
+    python build_assets.py
+
+- JS_SOURCES are concatenated and minified, and every partial in
+  static/partials is preloaded into Angular's $templateCache, so routes
+  and modals render without fetching their templates.
+- CSS_SOURCES are concatenated and minified; @import rules are moved
+  to the top. The bundle sits one directory below the root like
+  static/bootstrap/css, so relative url()s such as ../fonts/ still work.
+- The bundle names carry a hash of their contents, so they are served
+  with a one year expiration and a new build is picked up at once.
+- The <!-- build:css --> and <!-- build:js --> blocks of
+  templates/index.html are pointed at the bundles, and app.yaml gets
+  the /dist handler; running the build again only swaps the names.
+
+Third party libraries stay on their CDNs.
+
+"""
+
+from __future__ import print_function
+
+import glob
+import gzip
+import hashlib
+import io
+import json
+import os
+import re
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+JS_SOURCES = ['static/js/app.js', 'static/js/controllers.js']
+CSS_SOURCES = ['static/bootstrap/css/bootstrap-cosmo.css',
+               'static/bootstrap/css/main.css',
+               'static/bootstrap/css/offcanvas.css']
+PARTIALS_DIR = 'static/partials'
+PARTIALS_URL = '/partials/'
+DIST_DIR = 'static/dist'
+DIST_URL = '/dist/'
+INDEX_HTML = 'templates/index.html'
+APP_YAML = 'app.yaml'
+HASH_LENGTH = 10
+
+BLOCK_RE = r'([ \t]*)(<!-- build:%s -->\n)(.*?)(\n[ \t]*<!-- endbuild -->)'
+DIST_HANDLER = """- url: /dist
+  static_dir: static/dist
+  expiration: "365d"
+
+"""
+TEMPLATE_CACHE_JS = """angular.module('conferenceApp').run(['$templateCache', function ($templateCache) {
+%s
+}]);
+"""
+
+
+def _read(path):
+    with io.open(os.path.join(ROOT, path), encoding='utf-8') as f:
+        return f.read()
+
+
+def _write(path, text):
+    with io.open(os.path.join(ROOT, path), 'w', encoding='utf-8') as f:
+        f.write(text)
+
+
+def stripComments(source, line_comments=True):
+    """Remove /* */ (and, for JS, //) comments outside string literals."""
+    out = []
+    i, n = 0, len(source)
+    while i < n:
+        c = source[i]
+        if c in '"\'':
+            # copy a string literal as is
+            j = i + 1
+            while j < n and source[j] != c:
+                j += 2 if source[j] == '\\' else 1
+            out.append(source[i:j + 1])
+            i = j + 1
+        elif source.startswith('/*', i):
+            end = source.find('*/', i + 2)
+            i = n if end == -1 else end + 2
+        elif line_comments and source.startswith('//', i) and (
+                i == 0 or source[i - 1] in ' \t\n;{}(),'):
+            # '//' after ':' is a URL inside code, not a comment
+            end = source.find('\n', i)
+            i = n if end == -1 else end
+        else:
+            out.append(c)
+            i += 1
+    return ''.join(out)
+
+
+def minifyJs(source):
+    """Strip comments, indentation and blank lines.
+       Line breaks are kept, so automatic semicolon insertion
+       works exactly as it does in the sources.
+    """
+    lines = (line.strip() for line in stripComments(source).split('\n'))
+    return '\n'.join(line for line in lines if line) + '\n'
+
+
+def minifyCss(source):
+    """Strip comments and whitespace outside string literals."""
+    parts = re.split(r'("(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\')',
+                     stripComments(source, line_comments=False))
+    for i in range(0, len(parts), 2):
+        text = re.sub(r'\s+', ' ', parts[i])
+        text = re.sub(r'\s*([{};,])\s*', r'\1', text)
+        text = re.sub(r':\s+', ':', text)
+        parts[i] = text.replace(';}', '}')
+    return ''.join(parts).strip() + '\n'
+
+
+def templateCacheJs():
+    """Return JS putting every partial into Angular's $templateCache."""
+    puts = []
+    for path in sorted(glob.glob(os.path.join(ROOT, PARTIALS_DIR, '*.html'))):
+        # whitespace between tags shrinks to one space, which renders the same
+        html = re.sub(r'>\s+<', '> <', _read(os.path.relpath(path, ROOT)).strip())
+        # '</' is escaped so a partial can't close an inline <script>
+        puts.append('$templateCache.put(%s, %s);' % (
+            json.dumps(PARTIALS_URL + os.path.basename(path)),
+            json.dumps(html).replace('</', '<\\/')))
+    return TEMPLATE_CACHE_JS % '\n'.join(puts)
+
+
+def bundleCss():
+    """Return the minified CSS bundle, with @import rules first."""
+    imports, rules = [], []
+    for path in CSS_SOURCES:
+        css = minifyCss(_read(path))
+        for statement in re.findall(r'@import[^;]+;', css):
+            imports.append(statement)
+        rules.append(re.sub(r'@import[^;]+;', '', css))
+    return ''.join(imports) + '\n' + ''.join(rules)
+
+
+def bundleJs():
+    """Return the minified JS bundle, partials included."""
+    return ';\n'.join(minifyJs(_read(path)) for path in JS_SOURCES) + \
+        ';\n' + minifyJs(templateCacheJs())
+
+
+def writeBundle(name, ext, text):
+    """Write a content-hashed bundle, removing older builds of it.
+       Returns its URL.
+    """
+    data = text.encode('utf-8')
+    filename = '%s.%s.%s' % (name, hashlib.md5(data).hexdigest()[:HASH_LENGTH], ext)
+    dist = os.path.join(ROOT, DIST_DIR)
+    if not os.path.isdir(dist):
+        os.makedirs(dist)
+    for old in glob.glob(os.path.join(dist, '%s.*.%s' % (name, ext))):
+        if os.path.basename(old) != filename:
+            os.remove(old)
+    with open(os.path.join(dist, filename), 'wb') as f:
+        f.write(data)
+    return DIST_URL + filename
+
+
+def rewriteIndex(css_url, js_url):
+    """Point the build blocks of index.html at the bundles."""
+    html = _read(INDEX_HTML)
+    for block, tag in (('css', '<link rel="stylesheet" href="%s">' % css_url),
+                       ('js', '<script src="%s"></script>' % js_url)):
+        html, count = re.subn(BLOCK_RE % block,
+                              lambda m: m.group(1) + m.group(2) + m.group(1) + tag + m.group(4),
+                              html, flags=re.S)
+        if not count:
+            raise SystemExit('%s has no <!-- build:%s --> block' % (INDEX_HTML, block))
+    _write(INDEX_HTML, html)
+
+
+def rewriteAppYaml():
+    """Add the long-lived /dist handler to app.yaml if it isn't there."""
+    yaml = _read(APP_YAML)
+    if '- url: /dist\n' not in yaml:
+        yaml = yaml.replace('- url: /js\n', DIST_HANDLER + '- url: /js\n', 1)
+        _write(APP_YAML, yaml)
+
+
+def _gzipSize(data):
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+        f.write(data)
+    return len(buf.getvalue())
+
+
+def _report(label, paths):
+    """Print the request count and bytes of a set of files."""
+    data = [open(os.path.join(ROOT, path), 'rb').read() for path in paths]
+    print('%-7s %d requests, %7d bytes, %6d gzipped' % (
+        label, len(paths), sum(len(d) for d in data),
+        sum(_gzipSize(d) for d in data)))
+
+
+def main():
+    css_url = writeBundle('app', 'css', bundleCss())
+    js_url = writeBundle('app', 'js', bundleJs())
+    rewriteIndex(css_url, js_url)
+    rewriteAppYaml()
+
+    # a cold load of the home page, not counting CDN libraries and images
+    print('Own assets on a cold load of /:')
+    _report('before', CSS_SOURCES + JS_SOURCES + [PARTIALS_DIR + '/home.html'])
+    _report('after', [DIST_DIR + '/' + os.path.basename(css_url),
+                      DIST_DIR + '/' + os.path.basename(js_url)])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+
+"""capture.py
+
+Conference Central traffic capture for replay.py
+
+When CAPTURE_ENABLED is set in settings.py, each sampled call to a
+@captured endpoint is written to the request log as one line:
+CAPTURE_PREFIX followed by a JSON record of the endpoint, the caller,
+the request message, the status and the latency. User ids are replaced
+by salted hashes and free text by filler of the same length, so logs
+can be exported and replayed without carrying personal data.
+
+Websafe keys are replaced too, by their kind and a salted hash: a key
+encodes its ancestors, and the Profile at the root of conference,
+session and wishlist keys is named by the user's email. Page tokens
+are cursors, which encode keys as well, and are dropped. The body of a
+batch call is a JSON request itself and is sanitized the same way.
+
+"""
+
+import functools
+import hashlib
+import json
+import logging
+import random
+import time
+
+import endpoints
+from google.appengine.ext import ndb
+from protorpc import protojson
+
+import settings
+
+CAPTURE_PREFIX = 'CAPTURE '
+MASK_PREFIX = 'anon-'
+KEY_MASK_TPL = 'key:%s:%s'
+
+# request fields holding user ids, emails or names
+MASKED_FIELDS = ('mainEmail', 'displayName', 'organizerUserId',
+                 'organizerDisplayName', 'profileIds', 'profileId')
+# request fields holding websafe keys
+KEY_FIELDS = ('websafeConferenceKey', 'websafeKey', 'websafeSessionKey',
+              'websafeJobKey', 'websafe_key', 'parent_wsck', 'wsck',
+              'session_websafe_key', 'conferenceKeysToAttend')
+# free text whose size matters to the replay, but not its content
+FILLED_FIELDS = ('description', 'highlights', 'name', 'speaker')
+# request fields that can't be anonymized and are left out
+DROPPED_FIELDS = ('pageToken',)
+
+
+def mask(value):
+    """Return the stable anonymous id for a user id or email."""
+    digest = hashlib.sha1(settings.CAPTURE_SALT + value.encode('utf-8'))
+    return MASK_PREFIX + digest.hexdigest()[:16]
+
+
+def maskKey(wsk):
+    """Return the stable anonymous stand-in for a websafe key:
+        its kind, which replay.py maps by, and a salted hash.
+    """
+    try:
+        kind = ndb.Key(urlsafe=wsk).kind()
+    except Exception:
+        # not a key; replay passes it through and fails as the call did
+        kind = '?'
+    digest = hashlib.sha1(settings.CAPTURE_SALT + wsk.encode('utf-8'))
+    return KEY_MASK_TPL % (kind, digest.hexdigest()[:16])
+
+
+def _maskEach(value, masker):
+    """Mask a string or each string of a list."""
+    if isinstance(value, list):
+        return [masker(v) for v in value if isinstance(v, basestring)]
+    if isinstance(value, basestring):
+        return masker(value)
+    return value
+
+
+def _sanitize(data):
+    """Mask, fill or drop sensitive fields of a decoded JSON message in place."""
+    if isinstance(data, list):
+        for item in data:
+            _sanitize(item)
+    elif isinstance(data, dict):
+        for name, value in data.items():
+            if name in MASKED_FIELDS:
+                data[name] = _maskEach(value, mask)
+            elif name in KEY_FIELDS:
+                data[name] = _maskEach(value, maskKey)
+            elif name in DROPPED_FIELDS:
+                del data[name]
+            elif name in FILLED_FIELDS and isinstance(value, basestring):
+                data[name] = 'x' * len(value)
+            elif name == 'body' and isinstance(value, basestring):
+                # a batch call's sub-request
+                try:
+                    data[name] = json.dumps(_sanitize(json.loads(value)))
+                except ValueError:
+                    data[name] = 'x' * len(value)
+            else:
+                _sanitize(value)
+    return data
+
+
+def _caller():
+    """Return the masked id of the caller, or None if anonymous."""
+    try:
+        user = endpoints.get_current_user()
+    except Exception:
+        user = None
+    return mask(user.email()) if user else None
+
+
+def captured(func):
+    """Decorator for ConferenceApi endpoint methods;
+        place it below @endpoints.method and above @rateLimited.
+    """
+    endpoint = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(self, request):
+        if (not settings.CAPTURE_ENABLED or
+                random.random() >= settings.CAPTURE_SAMPLE_RATE):
+            return func(self, request)
+
+        started = time.time()
+        status = 'OK'
+        try:
+            return func(self, request)
+        except endpoints.ServiceException as e:
+            status = e.__class__.__name__
+            raise
+        except Exception:
+            status = 'InternalServerError'
+            raise
+        finally:
+            try:
+                record = {
+                    'at': started,
+                    'endpoint': endpoint,
+                    'caller': _caller(),
+                    'request': _sanitize(json.loads(protojson.encode_message(request))),
+                    'status': status,
+                    'latencyMs': round((time.time() - started) * 1000, 2),
+                }
+                logging.info(CAPTURE_PREFIX + json.dumps(record, sort_keys=True))
+            except Exception:
+                # capture must never break the call it records
+                logging.exception('Could not capture %s call', endpoint)
+    return wrapper
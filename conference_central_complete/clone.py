@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+
+"""clone.py
+
+Conference Central copying of a conference's sessions into a clone
+
+cloneConference creates the new Conference itself; a CloneJob then
+copies the sessions, with their SessionDetail, under it, shifting their
+dates by the job's offset. Each step copies one page of CLONE_PAGE_SIZE
+sessions and queues the next in the same transaction that records the
+job's progress, like snapshot.py, so a large agenda is copied in the
+background and resumes where it stopped after a failure. An agenda
+that fits in one page is copied within the request.
+
+Copies keep their source's ids under the new conference. Each step
+reserves them there with one allocate_ids call, so createSession can't
+be handed one of them later, and a retried step rewrites the same
+entities instead of duplicating them.
+
+When the last page is copied, a single finish task recomputes the data
+derived from the sessions (ConferenceApi._finishClone).
+
+"""
+
+from datetime import timedelta
+
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from models import CloneJob
+from models import Session
+from models import SessionDetail
+
+CLONE_PAGE_SIZE = 200
+PUT_BATCH_SIZE = 100
+
+
+def startJob(source_key, target_key, offset_days):
+    """Create the CloneJob copying a conference's sessions to another.
+       A small agenda is copied right away; a larger one by a task chain.
+       Returns the job.
+    """
+    total = Session.query(ancestor=source_key).count()
+    job = CloneJob(source=source_key.urlsafe(), target=target_key.urlsafe(),
+                   offsetDays=offset_days, total=total)
+    if total <= CLONE_PAGE_SIZE:
+        job.put()
+        cloneStep(job.key, 0)
+        return job.key.get()
+    _queueFirstStep(job)
+    return job
+
+
+@ndb.transactional()
+def _queueFirstStep(job):
+    job.put()
+    taskqueue.add(url='/tasks/clone_conference',
+                  params={'job': job.key.urlsafe(), 'step': 0},
+                  transactional=True)
+
+
+def _copy(entity, key, offset):
+    """Return a copy of a Session or SessionDetail under a new key."""
+    copy = type(entity)(key=key, **entity.to_dict(exclude=['updated']))
+    if getattr(copy, 'date', None):
+        copy.date += offset
+    return copy
+
+
+def cloneStep(job_key, step):
+    """Copy one page of sessions, then queue the next step or the finish."""
+    job = job_key.get()
+    if not job or job.status != 'RUNNING' or job.step != step:
+        # finished, or a duplicate of a step that already ran
+        return
+
+    source = ndb.Key(urlsafe=job.source)
+    target = ndb.Key(urlsafe=job.target)
+    cursor = Cursor(urlsafe=job.cursor) if job.cursor else None
+    sessions, next_cursor, more = Session.query(ancestor=source).fetch_page(
+        CLONE_PAGE_SIZE, start_cursor=cursor)
+
+    if sessions:
+        ids = [session.key.id() for session in sessions
+               if isinstance(session.key.id(), (int, long))]
+        if ids:
+            Session.allocate_ids(max=max(ids), parent=target)
+        detail_keys = [ndb.Key(SessionDetail, 1, parent=session.key)
+                       for session in sessions]
+        offset = timedelta(days=job.offsetDays)
+        copies = []
+        for session, detail in zip(sessions, ndb.get_multi(detail_keys)):
+            key = ndb.Key(Session, session.key.id(), parent=target)
+            copies.append(_copy(session, key, offset))
+            if detail:
+                copies.append(_copy(detail, ndb.Key(SessionDetail, 1, parent=key), offset))
+        # the batches go out in parallel
+        futures = []
+        for start in range(0, len(copies), PUT_BATCH_SIZE):
+            futures.extend(ndb.put_multi_async(copies[start:start + PUT_BATCH_SIZE]))
+        for future in futures:
+            future.get_result()
+
+    next_cursor = next_cursor.urlsafe() if more and next_cursor else None
+    _advance(job_key, step, len(sessions), next_cursor)
+
+
+@ndb.transactional()
+def _advance(job_key, step, copied, next_cursor):
+    """Record a copied page and queue the next step, atomically."""
+    job = job_key.get()
+    if job.step != step:
+        return
+
+    job.copied += copied
+    job.cursor = next_cursor
+    job.step += 1
+    if next_cursor:
+        taskqueue.add(url='/tasks/clone_conference',
+                      params={'job': job_key.urlsafe(), 'step': job.step},
+                      transactional=True)
+    else:
+        job.status = 'DONE'
+        taskqueue.add(url='/tasks/finish_clone',
+                      params={'job': job_key.urlsafe()},
+                      transactional=True)
+    job.put()
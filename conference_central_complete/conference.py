@@ -13,14 +13,18 @@ created by wesc on 2014 apr 21
 __author__ = 'wesc+api@google.com (Wesley Chun)'
 
 import endpoints
-from protorpc import messages, message_types, remote
+from protorpc import messages, message_types, protojson, remote
 
 from google.appengine.api import memcache, taskqueue
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
 
 from models import ConflictException
 from models import BooleanMessage
+from models import AnnouncementMessage
 from models import StringMessage
+from models import ReadConsistency
+from models import TypeaheadForm
 
 from models import Profile
 from models import ProfileMiniForm
@@ -28,27 +32,82 @@ from models import ProfileForm
 from models import TeeShirtSize
 
 from models import Conference
+from models import ConferenceAttendeeStats
 from models import ConferenceForm
 from models import ConferenceForms
 from models import GetConferenceForm
 from models import ConferenceQueryForm
 from models import ConferenceQueryForms
+from models import FacetCountForm
+from models import CloneConferenceForm
+from models import CloneJob
+from models import CloneJobForm
+from models import FacetCountForms
 
 from models import Session
+from models import SessionDetail
 from models import SessionForm
 from models import SessionForms
+from models import SessionResultForm
+from models import SessionResultForms
+from models import RoomSchedule
+from models import SessionsAtForm
 from models import SessionByTypeQueryForm
 from models import SessionBySpeakerQueryForm
 
+from models import FeaturedSpeaker
+
 from models import SessionWishlistItem
 from models import SessionWishlistItemForm
 from models import SessionWishlistQueryForm
+from models import RecommendedSessionsQueryForm
+
+from models import GroupRegistrationForm
+from models import GroupMemberResultForm
+from models import GroupRegistrationResultForm
+
+from models import SizeCountForm
+from models import DailyCountForm
+from models import AttendeeReportForm
+
+from models import AgendaItemForm
+from models import AgendaForm
+
+from models import BatchRequestForm
+from models import BatchResponseItem
+from models import BatchResponseForm
 
 from settings import WEB_CLIENT_ID, ANDROID_CLIENT_ID, IOS_CLIENT_ID, \
     ANDROID_AUDIENCE
 
 from utils import getUserId
-from datetime import datetime
+from schedule import sessionInterval, findOverlaps, sessionsAt
+from schedule import roomName, roomSlot, slotConflicts
+from ratelimit import rateLimited
+from capture import captured
+from consistency import readConsistency, isEventual, readOptions
+import archive
+import attendance
+import clone
+import facets
+import ical
+import notifications
+import recommendations
+import singleflight
+import stats
+import taskutils
+import typeahead
+
+import bisect
+import collections
+import hashlib
+import json
+import logging
+import sys
+import threading
+import time
+import uuid
+from datetime import date, datetime, timedelta
 from collections import Counter
 
 EMAIL_SCOPE = endpoints.EMAIL_SCOPE
@@ -62,10 +121,79 @@ CONF_GET_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     websafeConferenceKey=messages.StringField(1),)
 
+CONF_GET_CONDITIONAL_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKey=messages.StringField(1),
+    ifNoneMatch=messages.StringField(2),
+    includeArchived=messages.BooleanField(3, default=False),
+    consistency=messages.EnumField(ReadConsistency, 4),)
+
+UPCOMING_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    days=messages.IntegerField(1, default=90),
+    city=messages.StringField(2),
+    topic=messages.StringField(3),
+    pageSize=messages.IntegerField(4, default=20),
+    pageToken=messages.StringField(5),)
+
+TYPEAHEAD_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    field=messages.StringField(1, required=True),
+    prefix=messages.StringField(2),
+    limit=messages.IntegerField(3, default=10),)
+
+ARCHIVE_OPTION_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    includeArchived=messages.BooleanField(1, default=False),
+    consistency=messages.EnumField(ReadConsistency, 2),)
+
+ANNOUNCEMENT_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    ifNoneMatch=messages.StringField(1),)
+
+SESSION_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeSessionKey=messages.StringField(1),)
+
+SESSION_POST_REQUEST = endpoints.ResourceContainer(
+    SessionForm,
+    parent_wsck=messages.StringField(1),
+    allowOverlap=messages.BooleanField(2, default=False),)
+
+SESSIONS_POST_REQUEST = endpoints.ResourceContainer(
+    SessionForms,
+    parent_wsck=messages.StringField(1),
+    allowOverlap=messages.BooleanField(2, default=False),)
+
+ROOM_SCHEDULE_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKey=messages.StringField(1),
+    location=messages.StringField(2),)
+
+SESSIONS_AT_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKey=messages.StringField(1),
+    at=messages.StringField(2),
+    window=messages.IntegerField(3, default=60),
+    limit=messages.IntegerField(4, default=5),
+    utcOffset=messages.IntegerField(5, default=0),)
+
+GROUP_REGISTRATION_REQUEST = endpoints.ResourceContainer(
+    GroupRegistrationForm,
+    websafeConferenceKey=messages.StringField(1),)
+
 CONF_POST_REQUEST = endpoints.ResourceContainer(
     ConferenceForm,
     websafeConferenceKey=messages.StringField(1),)
 
+CLONE_POST_REQUEST = endpoints.ResourceContainer(
+    CloneConferenceForm,
+    websafeConferenceKey=messages.StringField(1),)
+
+CLONE_JOB_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeJobKey=messages.StringField(1),)
+
 DEFAULTS = {
     "city": "Default City",
     "maxAttendees": 0,
@@ -87,6 +215,101 @@ OPERATORS = {
     'NE':   '!='}
 
 MEMCACHE_ANNOUNCEMENTS_KEY = "RECENT_ANNOUNCEMENTS"
+ANNOUNCEMENT_TTL = 2 * 60 * 60          # the cron job refreshes it hourly
+ANNOUNCEMENT_SOFT_TTL = 70 * 60
+
+MEMCACHE_FEATURED_SPEAKER_KEY = 'featured_speaker'
+FEATURED_SPEAKER_ID = 'current'
+
+# getConference reads, protected against stampedes by singleflight;
+#   keyed by the conference's version, so an update is never hidden
+#   by a recompute that read the conference before it
+MEMCACHE_CONFERENCE_TPL = 'conference:%s:%s'
+CONFERENCE_TTL = 10 * 60
+CONFERENCE_SOFT_TTL = 5 * 60
+
+# queryConferences result cache; the generation is bumped whenever
+#   a conference is created or updated so stale entries are never read
+MEMCACHE_CONFERENCE_GENERATION_KEY = "CONFERENCE_GENERATION"
+QUERY_CACHE_TPL = 'queryConferences:%s:%s'
+QUERY_CACHE_TTL = 600
+# the cached queries are eventually consistent: right after a bump they
+#   may miss the write that caused it, so results are then cached briefly
+MEMCACHE_CONFERENCE_BUMPED_KEY = "CONFERENCE_GENERATION_BUMPED"
+QUERY_SETTLE_TIME = 10
+QUERY_UNSETTLED_TTL = 10
+INTEGER_FIELDS = ('month', 'maxAttendees')
+
+# getUpcomingConferences: the first page of each query is cached briefly,
+#   per conference generation; later pages are read through cursors
+UPCOMING_CACHE_TPL = 'upcoming:%s:%s'
+UPCOMING_CACHE_TTL = 60
+MAX_UPCOMING_DAYS = 366
+MAX_UPCOMING_PAGE_SIZE = 100
+MONTH_BUCKET_BACKFILL_PAGE_SIZE = 100
+
+# facet counts are cached per conference generation, like queryConferences
+FACETS_CACHE_TPL = 'facets:%s:%s'
+
+# entity versions backing ETags; checked without touching the datastore
+MEMCACHE_VERSION_TPL = 'version:%s:%s'
+ETAG_TPL = '"%s-%s"'
+
+# sessions moved to SessionDetail per migration task
+SESSION_MIGRATION_PAGE_SIZE = 200
+
+# profiles registered per cross-group transaction; the datastore
+#   allows 25 entity groups per transaction
+GROUP_REGISTRATION_CHUNK_SIZE = 24
+
+# t-shirt size changes remembered per conference's attendee stats
+APPLIED_CHANGES_KEPT = 100
+
+# batch endpoint limits, and the request fields holding websafe keys
+#   that are prefetched together before the calls run
+MAX_BATCH_ITEMS = 20
+BATCH_KEY_FIELDS = ('websafeConferenceKey', 'websafeKey', 'websafeSessionKey',
+                    'parent_wsck', 'wsck', 'session_websafe_key')
+
+# per-user agenda index: sorted (start, end, session key) entries
+MEMCACHE_AGENDA_TPL = 'agenda:%s'
+
+# per-conference schedules of (start, end, session key) entries, keyed
+#   by the sessions version so a session write never serves stale data;
+#   instances also keep recent schedules in memory for a few seconds.
+#   Sessions themselves are read by key, so a large agenda still fits
+#   in one memcache value
+MEMCACHE_SCHEDULE_TPL = 'schedule:%s:%s'
+SCHEDULE_TTL = 60 * 60
+SCHEDULE_LOCAL_TTL = 5
+MAX_LOCAL_SCHEDULES = 50
+MAX_SESSIONS_AT_LIMIT = 20
+# a conference's sessions, keyed by the sessions version; only strong
+#   reads fill it, eventual reads of getConferenceSessions use it
+MEMCACHE_SESSIONS_TPL = 'sessions:%s:%s'
+_local_schedules = collections.OrderedDict()
+# requests run on concurrent threads
+_local_schedules_lock = threading.Lock()
+
+# SessionForm fields that are stored on Session or SessionDetail
+SESSION_FORM_FIELDS = ('name', 'highlights', 'speaker', 'date', 'startTime',
+                       'duration', 'session_type', 'location')
+MAX_BATCH_SESSIONS = 100
+# seconds before the slots of a booking whose sessions were never saved
+#   are released, if the booking couldn't release them itself
+ROOM_RELEASE_DELAY = 120
+
+stats.register('queryConferences.hits',
+               'queryConferences.misses',
+               'queryConferences.queryOpsSaved')
+stats.register('conditionalGet.notModified',
+               'conditionalGet.readsSaved')
+stats.register('schedule.localHits', 'schedule.incrementalUpdates')
+stats.register('upcoming.firstPageHits', 'upcoming.firstPageMisses')
+stats.register('rooms.conflicts', 'rooms.schedulesBuilt',
+               'rooms.slotsReleased', 'sessions.failedSaves')
+stats.register('sessions.cacheHits', 'sessions.eventualQueries')
+stats.register('clone.started', 'clone.finished')
 ANNOUNCEMENT_TPL = ('Last chance to attend! The following conferences '
                     'are nearly sold out: %s')
 
@@ -99,18 +322,22 @@ class ConferenceApi(remote.Service):
     """Conference API v0.1"""
 
     def _getCurrentUser(self):
-        """Gets the current logged in user's username"""
-        try:
-            user = endpoints.get_current_user()
-        except:
-            raise endpoints.UnauthorizedException('Authorization required')
-        return user
+        """Gets the current logged in user's username.
+           The service is instantiated per request, so the user is
+            validated once and reused by every call in a batch.
+        """
+        if not hasattr(self, '_current_user'):
+            try:
+                self._current_user = endpoints.get_current_user()
+            except:
+                raise endpoints.UnauthorizedException('Authorization required')
+        return self._current_user
 
     def _getCurrentUserProfile(self):
         """Gets the currently logged-in user's Profile entity"""
 
         try:
-            username = endpoints.get_current_user()
+            username = self._getCurrentUser()
         except:
             raise endpoints.UnauthorizedException('User is not logged in.')
 
@@ -133,10 +360,10 @@ class ConferenceApi(remote.Service):
 
         return max(set(lst), key=lst.count)
 
-    def _getEntityByWebSafeKey(self, websafe_key):
+    def _getEntityByWebSafeKey(self, websafe_key, **ctx_options):
         """Given a urlsafe key, return its matching entity"""
         try:
-            entity = ndb.Key(urlsafe=websafe_key).get()
+            entity = ndb.Key(urlsafe=websafe_key).get(**ctx_options)
         except:
             raise endpoints.NotFoundException(
                 'No entity found by this websafe key: %s' % websafe_key)
@@ -155,12 +382,115 @@ class ConferenceApi(remote.Service):
                 else:
                     setattr(cf, field.name, getattr(conf, field.name))
             elif field.name == "websafeKey":
-                setattr(cf, field.name, conf.key.urlsafe())
+                # archived conferences keep their live websafe key
+                setattr(cf, field.name, archive.hotKey(conf.key).urlsafe())
+            elif field.name == "archived":
+                setattr(cf, field.name, archive.isArchived(conf.key))
         if displayName:
             setattr(cf, 'organizerDisplayName', displayName)
         cf.check_initialized()
         return cf
 
+    @staticmethod
+    def _conferenceGeneration():
+        """Return the current conference generation counter."""
+        generation = memcache.get(MEMCACHE_CONFERENCE_GENERATION_KEY)
+        if generation is None:
+            # seed from the clock in milliseconds; an evicted counter only
+            #   comes back at a value already used if it had been bumped
+            #   more than once per millisecond on average since it was seeded
+            memcache.add(MEMCACHE_CONFERENCE_GENERATION_KEY,
+                         int(time.time() * 1000))
+            generation = memcache.get(MEMCACHE_CONFERENCE_GENERATION_KEY)
+        return generation
+
+    @staticmethod
+    def _bumpConferenceGeneration():
+        """Invalidate every cached queryConferences result."""
+        memcache.incr(MEMCACHE_CONFERENCE_GENERATION_KEY,
+                      initial_value=int(time.time() * 1000))
+        memcache.set(MEMCACHE_CONFERENCE_BUMPED_KEY, time.time())
+
+    @staticmethod
+    def _queryCacheTtl(ttl):
+        """Return how long to cache a conference query result: ttl,
+            or briefly if the generation was bumped too recently for
+            the query to be sure to see the write behind the bump.
+        """
+        bumped = memcache.get(MEMCACHE_CONFERENCE_BUMPED_KEY)
+        if bumped is not None and time.time() - bumped < QUERY_SETTLE_TIME:
+            return min(ttl, QUERY_UNSETTLED_TTL)
+        return ttl
+
+    @staticmethod
+    def _conferenceVersionKey(wsck):
+        """Return the memcache key holding a conference's version"""
+        return MEMCACHE_VERSION_TPL % ('conference', wsck)
+
+    @staticmethod
+    def _sessionsVersionKey(wsck):
+        """Return the memcache key holding the version of a conference's sessions"""
+        return MEMCACHE_VERSION_TPL % ('sessions', wsck)
+
+    def _bumpConferenceVersion(self, conf):
+        """Increment a conference's version before it is put;
+            memcache is updated once the write commits.
+        """
+        conf.version = (conf.version or 0) + 1
+        wsck = conf.key.urlsafe()
+        version = conf.version
+
+        def publish():
+            self._publishVersion(self._conferenceVersionKey(wsck), version)
+        ndb.get_context().call_on_commit(publish)
+
+    @staticmethod
+    def _publishVersion(version_key, version):
+        """Store a version in memcache unless a newer one is there;
+            commits can publish out of order, and an older version
+            would match ETags the entity has moved past.
+        """
+        client = memcache.Client()
+        for _ in range(3):
+            current = client.gets(version_key)
+            if current is None:
+                if client.add(version_key, version):
+                    return
+                continue
+            if current >= version or client.cas(version_key, version):
+                return
+        # contended; without a version no ETag matches until the next write
+        memcache.delete(version_key)
+
+    @staticmethod
+    def _sessionsVersion(wsck):
+        """Return the current version of a conference's sessions"""
+        version_key = ConferenceApi._sessionsVersionKey(wsck)
+        version = memcache.get(version_key)
+        if version is None:
+            # sessions have no version entity of their own; seed from
+            #   the clock so an evicted version is never reused
+            memcache.add(version_key, int(time.time()))
+            version = memcache.get(version_key)
+        return version
+
+    @staticmethod
+    def _bumpSessionsVersion(wsck):
+        """Mark a conference's sessions as changed; returns the new version"""
+        return memcache.incr(ConferenceApi._sessionsVersionKey(wsck),
+                             initial_value=int(time.time()))
+
+    def _notModified(self, version_key, prefix, if_none_match, reads_saved):
+        """Return True if the client's ETag matches the version in memcache"""
+        if not if_none_match:
+            return False
+        version = memcache.get(version_key)
+        if version is not None and ETAG_TPL % (prefix, version) == if_none_match:
+            stats.incrMulti({'conditionalGet.notModified': 1,
+                             'conditionalGet.readsSaved': reads_saved})
+            return True
+        return False
+
     def _createConferenceObject(self, request):
         """Create or update Conference object,
             returning ConferenceForm/request.
@@ -179,6 +509,8 @@ class ConferenceApi(remote.Service):
         # remove unnecessary values
         del data['websafeKey']
         del data['organizerDisplayName']
+        del data['etag']
+        del data['notModified']
 
         # add default values for those missing (both data model & outbound Message)
         for df in DEFAULTS:
@@ -209,16 +541,32 @@ class ConferenceApi(remote.Service):
         data['key'] = c_key
         data['organizerUserId'] = request.organizerUserId = user_id
 
-        Conference(**data).put()
+        conf = Conference(**data)
+        conf.put()
+        self._conferenceAdded(conf)
 
         # Send email to organizer confirming
-        # creation of Conference & return (modified) ConferenceForm
-        taskqueue.add(
-            params={'email': user.email(), 'conferenceInfo': repr(request)},
-            url='/tasks/send_confirmation_email')
+        # creation of Conference & return (modified) ConferenceForm;
+        # the task is named after the conference so a retry can't send twice
+        batch = taskutils.TaskBatch()
+        batch.add(taskutils.uniqueTask(
+            '/tasks/send_confirmation_email', 'confirm', c_key,
+            {'email': user.email(), 'conferenceInfo': repr(request)}))
+        batch.flushOnCommit()
 
         return request
 
+    @staticmethod
+    def _conferenceAdded(conf):
+        """Update the data derived from conferences for a new one"""
+        # invalidate cached queryConferences results
+        ConferenceApi._bumpConferenceGeneration()
+        facets.queueChange(None, facets.facetValues(conf))
+        # a new conference has no attendees to backfill
+        ConferenceAttendeeStats(key=attendance.statsKey(conf.key),
+                                backfill='DONE').put()
+        typeahead.addTerms({'city': [conf.city], 'topic': conf.topics})
+
     @ndb.transactional()
     def _updateConferenceObject(self, request):
         user = self._getCurrentUser()
@@ -239,6 +587,11 @@ class ConferenceApi(remote.Service):
             raise endpoints.ForbiddenException(
                 'Only the owner can update the conference.')
 
+        # remember the fields attendees are notified about, and facet values
+        before = dict((field, getattr(conf, field))
+                      for field in notifications.NOTIFIED_FIELDS)
+        facets_before = facets.facetValues(conf)
+
         # Not getting all the fields, so don't create a new object; just
         # copy relevant fields from ConferenceForm to Conference object
         for field in request.all_fields():
@@ -252,13 +605,34 @@ class ConferenceApi(remote.Service):
                         conf.month = data.month
                 # write to Conference object
                 setattr(conf, field.name, data)
+        self._bumpConferenceVersion(conf)
         conf.put()
+
+        # tell attendees about date or city changes; the job is a child
+        #   of the conference, so it commits together with the update
+        changes = notifications.describeChanges(before, conf)
+        if changes:
+            notifications.startNotificationJob(conf, changes)
+
+        # invalidate cached queryConferences results and the conference's
+        #   calendar feed, which is named after it, once the update commits
+        wsck = conf.key.urlsafe()
+
+        def invalidate():
+            self._bumpConferenceGeneration()
+            ical.invalidateConference(wsck)
+        ndb.get_context().call_on_commit(invalidate)
+        # the facet counters are updated by a task queued with the update
+        facets.queueChange(facets_before, facets.facetValues(conf))
+
         prof = ndb.Key(Profile, user_id).get()
         return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
 
     @endpoints.method(
         ConferenceForm, ConferenceForm,
         path='conference', http_method='POST', name='createConference')
+    @captured
+    @rateLimited(cost=2)
     def createConference(self, request):
         """Create new conference."""
 
@@ -267,36 +641,96 @@ class ConferenceApi(remote.Service):
     @endpoints.method(
         CONF_POST_REQUEST, ConferenceForm,
         path='conference/{websafeConferenceKey}', http_method='PUT', name='updateConference')
+    @captured
     def updateConference(self, request):
         """Update conference w/provided fields & return w/updated info."""
 
         return self._updateConferenceObject(request)
 
+    @staticmethod
+    def _loadConference(wsck, **ctx_options):
+        """Return a conference and its organizer's display name,
+            or (None, None) if there is no such conference.
+        """
+        conf = ndb.Key(urlsafe=wsck).get(**ctx_options)
+        if not conf:
+            return None, None
+        prof = archive.hotKey(conf.key.parent()).get(**ctx_options)
+        return conf, getattr(prof, 'displayName', None)
+
+    @staticmethod
+    def _loadConferenceVersion(wsck, version, **ctx_options):
+        """Load a conference for its cache entry at a version; a read
+            that comes back older than the version is retried strongly.
+        """
+        conf, display_name = ConferenceApi._loadConference(wsck, **ctx_options)
+        if conf and (conf.version or 0) < version:
+            conf, display_name = ConferenceApi._loadConference(wsck)
+        return conf, display_name
+
     @endpoints.method(
-        CONF_GET_REQUEST, ConferenceForm,
+        CONF_GET_CONDITIONAL_REQUEST, ConferenceForm,
         path='conference/{websafeConferenceKey}', http_method='GET', name='getConference')
+    @captured
+    @readConsistency
     def getConference(self, request):
-        """Return requested conference (by websafeConferenceKey)."""
+        """Return requested conference (by websafeConferenceKey).
+           If ifNoneMatch carries the current ETag, only notModified is returned.
+           Eventual reads may be served from the conference cache.
+        """
+
+        version_key = self._conferenceVersionKey(request.websafeConferenceKey)
+        # a match saves both the conference and the organizer profile reads
+        if self._notModified(version_key, 'conference', request.ifNoneMatch, 2):
+            return ConferenceForm(etag=request.ifNoneMatch, notModified=True)
 
         # get Conference object from request; bail if not found
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+        wsck = request.websafeConferenceKey
+        options = readOptions(self)
+        version = memcache.get(version_key)
+        if isEventual(self) and version is not None:
+            conf, display_name = singleflight.get(
+                MEMCACHE_CONFERENCE_TPL % (wsck, version),
+                lambda: self._loadConferenceVersion(wsck, version, **options),
+                ttl=CONFERENCE_TTL, soft_ttl=CONFERENCE_SOFT_TTL,
+                refresh=('conference', [wsck, version]))
+            published = True
+        else:
+            # without a published version there is no cache entry to
+            #   read; a strong read can publish one
+            conf, display_name = self._loadConference(wsck)
+            published = False
+        if not conf and request.includeArchived:
+            conf, display_name = self._loadConference(archive.archivedKey(
+                ndb.Key(urlsafe=request.websafeConferenceKey)).urlsafe(), **options)
+            # its version belongs to the archived copy, not this key
+            published = True
         if not conf:
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' % request.websafeConferenceKey)
-        prof = conf.key.parent().get()
+        if not published:
+            self._publishVersion(version_key, conf.version)
 
-        return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
+        cf = self._copyConferenceToForm(conf, display_name)
+        cf.etag = ETAG_TPL % ('conference', conf.version)
+        return cf
 
     @endpoints.method(
-        message_types.VoidMessage, ConferenceForms,
+        ARCHIVE_OPTION_REQUEST, ConferenceForms,
         path='getConferencesCreated', http_method='POST', name='getConferencesCreated')
+    @captured
+    @readConsistency
     def getConferencesCreated(self, request):
         """Return conferences created by user."""
 
         user = self._getCurrentUserProfile()
 
         # create ancestor query for all key matches for this user
-        confs = Conference.query(ancestor=user.key)
+        options = readOptions(self)
+        confs = Conference.query(ancestor=user.key).fetch(**options)
+        if request.includeArchived:
+            confs.extend(Conference.query(
+                ancestor=archive.archivedKey(user.key)).fetch(**options))
 
         # return set of ConferenceForm objects per Conference
         return ConferenceForms(
@@ -321,8 +755,6 @@ class ConferenceApi(remote.Service):
             q = q.order(Conference.name)
 
         for filtr in filters:
-            if filtr["field"] in ["month", "maxAttendees"]:
-                filtr["value"] = int(filtr["value"])
             formatted_query = ndb.query.FilterNode(filtr["field"], filtr["operator"], filtr["value"])
             q = q.filter(formatted_query)
             # print '_getQuery returns: %s' % q
@@ -355,6 +787,13 @@ class ConferenceApi(remote.Service):
                 raise endpoints.BadRequestException(
                     "Filter contains invalid field or operator.")
 
+            if filtr["field"] in INTEGER_FIELDS:
+                try:
+                    filtr["value"] = int(filtr["value"])
+                except (TypeError, ValueError):
+                    raise endpoints.BadRequestException(
+                        "Filter on %s requires an integer value." % filtr["field"])
+
             if filtr["operator"] != "=":
                 # check if inequality operation has been used in previous filters
                 # disallow the filter if inequality was performed on a different field before
@@ -369,13 +808,47 @@ class ConferenceApi(remote.Service):
 
         return result
 
+    def _filtersDigest(self, filters):
+        """Return a stable digest of formatted filters.
+           Filters are sorted so that the same set of filters submitted
+           in a different order shares one cache entry.
+        """
+        canonical = sorted((f["field"], f["operator"], f["value"]) for f in filters)
+        return hashlib.md5(json.dumps(canonical)).hexdigest()
+
+    def _queryConferenceKeys(self, request):
+        """Return the ordered Conference keys matching the request filters,
+            served from memcache when the same filters were run recently.
+        """
+        inequality_filter, filters = self._formatFilters(request.filters)
+        cache_key = QUERY_CACHE_TPL % (
+            self._conferenceGeneration(), self._filtersDigest(filters))
+
+        cached = memcache.get(cache_key)
+        if cached is not None:
+            # one query plus one index read per result avoided
+            stats.incrMulti({'queryConferences.hits': 1,
+                             'queryConferences.queryOpsSaved': 1 + len(cached)})
+            return [ndb.Key(urlsafe=wsck) for wsck in cached]
+
+        stats.incr('queryConferences.misses')
+        conf_keys = self._getQuery(request).fetch(keys_only=True)
+        memcache.set(cache_key, [key.urlsafe() for key in conf_keys],
+                     time=self._queryCacheTtl(QUERY_CACHE_TTL))
+        return conf_keys
+
     @endpoints.method(
         ConferenceQueryForms, ConferenceForms,
         path='queryConferences', http_method='POST', name='queryConferences')
+    @captured
+    @rateLimited(cost=1)
     def queryConferences(self, request):
         """Query for conferences."""
 
-        conferences = self._getQuery(request)
+        # cached keys are hydrated with get_multi,
+        #   which is served by ndb's own entity cache when possible
+        conferences = [conf for conf in ndb.get_multi(self._queryConferenceKeys(request))
+                       if conf is not None]
 
         # need to fetch organiser displayName from profiles
         # get all keys and use get_multi for speed
@@ -391,6 +864,179 @@ class ConferenceApi(remote.Service):
         return ConferenceForms(items=[self._copyConferenceToForm(conf,
                                names[conf.organizerUserId]) for conf in conferences])
 
+    @staticmethod
+    def _monthBuckets(first, last):
+        """Return the YYYYMM month buckets from date first to date last"""
+        buckets = []
+        year, month = first.year, first.month
+        while (year, month) <= (last.year, last.month):
+            buckets.append(year * 100 + month)
+            year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+        return buckets
+
+    def _upcomingPage(self, first, last, city, topic, page_size, page_token):
+        """Return (conferences, next page token) for conferences starting
+            from date first up to, not including, date last, soonest first.
+           Each month bucket is one query over the monthBucket/startDate
+            indexes; the page token names the bucket and a cursor within it.
+        """
+        buckets = self._monthBuckets(first, last)
+        bucket, cursor = buckets[0], None
+        if page_token:
+            try:
+                bucket, _, cursor = page_token.partition('|')
+                bucket = int(bucket)
+                cursor = Cursor(urlsafe=cursor) if cursor else None
+                buckets.index(bucket)
+            except Exception:
+                raise endpoints.BadRequestException('Invalid pageToken.')
+
+        conferences, next_token = [], None
+        for bucket in buckets[buckets.index(bucket):]:
+            q = Conference.query(Conference.monthBucket == bucket,
+                                 Conference.startDate >= first,
+                                 Conference.startDate < last)
+            if city:
+                q = q.filter(Conference.city == city)
+            if topic:
+                q = q.filter(Conference.topics == topic)
+            page, next_cursor, more = q.order(Conference.startDate).fetch_page(
+                page_size - len(conferences), start_cursor=cursor)
+            conferences.extend(page)
+            cursor = None
+            if len(conferences) >= page_size:
+                if more and next_cursor:
+                    next_token = '%d|%s' % (bucket, next_cursor.urlsafe())
+                elif bucket != buckets[-1]:
+                    next_token = '%d|' % buckets[buckets.index(bucket) + 1]
+                break
+        return conferences, next_token
+
+    @endpoints.method(
+        UPCOMING_REQUEST, ConferenceForms,
+        path='getUpcomingConferences', http_method='GET',
+        name='getUpcomingConferences')
+    @captured
+    def getUpcomingConferences(self, request):
+        """Return conferences starting in the next `days` days, soonest
+            first, optionally in one city and/or on one topic.
+           Pass nextPageToken back as pageToken for the following page.
+        """
+
+        days = max(1, min(request.days, MAX_UPCOMING_DAYS))
+        page_size = max(1, min(request.pageSize, MAX_UPCOMING_PAGE_SIZE))
+        first = date.today()
+        last = first + timedelta(days=days)
+
+        cache_key = None
+        if not request.pageToken:
+            cache_key = UPCOMING_CACHE_TPL % (
+                self._conferenceGeneration(),
+                hashlib.md5(json.dumps([str(first), days, request.city,
+                                        request.topic, page_size])).hexdigest())
+            cached = memcache.get(cache_key)
+            if cached is not None:
+                stats.incr('upcoming.firstPageHits')
+                return protojson.decode_message(ConferenceForms, cached)
+            stats.incr('upcoming.firstPageMisses')
+
+        conferences, next_token = self._upcomingPage(
+            first, last, request.city, request.topic, page_size, request.pageToken)
+
+        profiles = ndb.get_multi([ndb.Key(Profile, conf.organizerUserId)
+                                  for conf in conferences])
+        names = dict((profile.key.id(), profile.displayName)
+                     for profile in profiles if profile)
+
+        forms = ConferenceForms(
+            items=[self._copyConferenceToForm(conf, names.get(conf.organizerUserId))
+                   for conf in conferences],
+            nextPageToken=next_token)
+        if cache_key:
+            memcache.set(cache_key, protojson.encode_message(forms),
+                         time=self._queryCacheTtl(UPCOMING_CACHE_TTL))
+        return forms
+
+    @staticmethod
+    @ndb.transactional_tasklet
+    def _reputConference(conf_key):
+        """Get and put a conference in one transaction, so a registration
+            committing in between can't be overwritten by a stale copy.
+        """
+        conf = yield conf_key.get_async()
+        if conf:
+            yield conf.put_async()
+
+    @staticmethod
+    def _backfillMonthBuckets(cursor=None):
+        """Re-put one page of conferences so that monthBucket is indexed.
+           Returns the cursor for the next page, or None when done.
+        """
+        conf_keys, next_cursor, more = Conference.query().fetch_page(
+            MONTH_BUCKET_BACKFILL_PAGE_SIZE, start_cursor=cursor, keys_only=True)
+        # each in its own transaction, run in parallel
+        ndb.Future.wait_all([ConferenceApi._reputConference(conf_key)
+                             for conf_key in conf_keys])
+        return next_cursor if more else None
+
+    @endpoints.method(
+        ConferenceQueryForms, FacetCountForms,
+        path='getConferenceFacets', http_method='POST', name='getConferenceFacets')
+    @captured
+    def getConferenceFacets(self, request):
+        """Return how many conferences match each city, topic and month,
+            given equality filters on those fields.
+           The counts for a field ignore the filter on that field itself,
+            so they show what choosing another value would return.
+        """
+
+        inequality_filter, filters = self._formatFilters(request.filters)
+        constraints = {}
+        for filtr in filters:
+            if filtr["operator"] != "=" or filtr["field"] not in facets.FACET_FIELDS:
+                raise endpoints.BadRequestException(
+                    "Facets can only be filtered by CITY, TOPIC or MONTH equality.")
+            if filtr["field"] in constraints:
+                raise endpoints.BadRequestException(
+                    "Facets allow only one filter per field.")
+            constraints[filtr["field"]] = filtr["value"]
+
+        cache_key = FACETS_CACHE_TPL % (
+            self._conferenceGeneration(), self._filtersDigest(filters))
+        counts = memcache.get(cache_key)
+        if counts is None:
+            counts = []
+            for field in facets.FACET_FIELDS:
+                applied = [(f, v) for f, v in constraints.items() if f != field]
+                counts.extend((field, value, count) for value, count
+                              in sorted(facets.getCounts(applied, field).items()))
+            memcache.set(cache_key, counts, time=self._queryCacheTtl(QUERY_CACHE_TTL))
+
+        field_names = dict((name, api_name) for api_name, name in FIELDS.items())
+        return FacetCountForms(items=[
+            FacetCountForm(field=field_names[field], value=value, count=count)
+            for field, value, count in counts])
+
+    @staticmethod
+    def _applyFacetChange(change_id, before, after):
+        """Apply a conference's facet change; used by the facet task"""
+        facets.applyChange(change_id, before, after)
+        # facet counts are cached with the conference generation
+        ConferenceApi._bumpConferenceGeneration()
+
+    @staticmethod
+    def _reconcileFacets():
+        """Start a recount of the facet counters; used by the
+            reconciliation cron job
+        """
+        facets.startReconcile()
+
+    @staticmethod
+    def _reconcileFacetsStep(job_key, step):
+        """Run one step of a facet recount; used by its task chain"""
+        if facets.reconcileStep(job_key, step):
+            ConferenceApi._bumpConferenceGeneration()
+
 # - - - Profile - - - - - - - - - - - - - - - - - - -
 
     def _copyProfileToForm(self, prof):
@@ -442,6 +1088,7 @@ class ConferenceApi(remote.Service):
         # if saveProfile(), process user-modifyable fields
         # save_request is in ProfileMiniForm form
         if save_request:
+            old_size = prof.teeShirtSize
             for field in ('displayName', 'teeShirtSize'):
                 if hasattr(save_request, field):
                     val = getattr(save_request, field)
@@ -453,12 +1100,25 @@ class ConferenceApi(remote.Service):
                         #    setattr(prof, field, val)
                         prof.put()
 
+            # keep the t-shirt counts of attended conferences in step
+            if prof.teeShirtSize != old_size and prof.conferenceKeysToAttend:
+                batch = taskutils.TaskBatch()
+                batch.add(taskqueue.Task(
+                    url='/tasks/update_attendee_size',
+                    params={'wsck': prof.conferenceKeysToAttend,
+                            'profile': prof.key.urlsafe(),
+                            'change': uuid.uuid4().hex,
+                            'old_size': old_size,
+                            'new_size': prof.teeShirtSize}))
+                batch.flushOnCommit()
+
         # return ProfileForm
         return self._copyProfileToForm(prof)
 
     @endpoints.method(
         message_types.VoidMessage, ProfileForm,
         path='profile', http_method='GET', name='getProfile')
+    @captured
     def getProfile(self, request):
         """Return user profile."""
 
@@ -467,6 +1127,7 @@ class ConferenceApi(remote.Service):
     @endpoints.method(
         ProfileMiniForm, ProfileForm,
         path='profile', http_method='POST', name='saveProfile')
+    @captured
     def saveProfile(self, request):
         """Update & return user profile."""
 
@@ -475,9 +1136,9 @@ class ConferenceApi(remote.Service):
 # - - - Announcements - - - - - - - - - - - - - - - -
 
     @staticmethod
-    def _cacheAnnouncement():
-        """Create Announcement & assign to memcache; used by
-            memcache cron job & putAnnouncement().
+    def _buildAnnouncement():
+        """Return the announcement for nearly sold out conferences,
+            or "" if there are none.
         """
 
         confs = Conference.query(ndb.AND(
@@ -486,27 +1147,44 @@ class ConferenceApi(remote.Service):
         ).fetch(projection=[Conference.name])
 
         if confs:
-            # If there are almost sold out conferences,
-            # format announcement and set it in memcache
-            announcement = ANNOUNCEMENT_TPL % (
+            # If there are almost sold out conferences, format announcement
+            return ANNOUNCEMENT_TPL % (
                 ', '.join(conf.name for conf in confs))
-            memcache.set(MEMCACHE_ANNOUNCEMENTS_KEY, announcement)
-        else:
-            # If there are no sold out conferences,
-            # delete the memcache announcements entry
-            announcement = ""
-            memcache.delete(MEMCACHE_ANNOUNCEMENTS_KEY)
+        return ""
+
+    @staticmethod
+    def _cacheAnnouncement():
+        """Create Announcement & assign to memcache; used by
+            memcache cron job & putAnnouncement().
+           An empty announcement is cached too, so readers don't
+            fall through to the datastore while there is none.
+        """
+
+        announcement = ConferenceApi._buildAnnouncement()
+        singleflight.store(MEMCACHE_ANNOUNCEMENTS_KEY, announcement,
+                           ttl=ANNOUNCEMENT_TTL, soft_ttl=ANNOUNCEMENT_SOFT_TTL)
 
         return announcement
 
     @endpoints.method(
-        message_types.VoidMessage, StringMessage,
+        ANNOUNCEMENT_GET_REQUEST, AnnouncementMessage,
         path='conference/announcement/get',
         http_method='GET', name='getAnnouncement')
+    @captured
     def getAnnouncement(self, request):
         """Return Announcement from memcache."""
 
-        return StringMessage(data=memcache.get(MEMCACHE_ANNOUNCEMENTS_KEY) or "")
+        # rebuilt by a single caller if the cron job's value was lost
+        announcement = singleflight.get(
+            MEMCACHE_ANNOUNCEMENTS_KEY, ConferenceApi._buildAnnouncement,
+            ttl=ANNOUNCEMENT_TTL, soft_ttl=ANNOUNCEMENT_SOFT_TTL,
+            refresh=('announcement', []))
+        etag = ETAG_TPL % ('announcement', hashlib.md5(announcement.encode('utf-8')).hexdigest()[:16])
+        if request.ifNoneMatch == etag:
+            stats.incr('conditionalGet.notModified')
+            return AnnouncementMessage(etag=etag, notModified=True)
+
+        return AnnouncementMessage(data=announcement, etag=etag)
 
 # - - - Conference Registration - - - - - - - - - - -
     @ndb.transactional(xg=True)
@@ -538,6 +1216,8 @@ class ConferenceApi(remote.Service):
             # register user, take away one seat
             prof.conferenceKeysToAttend.append(wsck)
             conf.seatsAvailable -= 1
+            self._recordAttendance(conf.key, self._attendanceChanges([prof]))
+            self._bumpConferenceVersion(conf)
             retval = True
 
         # unregister
@@ -548,6 +1228,8 @@ class ConferenceApi(remote.Service):
                 # unregister user, add back one seat
                 prof.conferenceKeysToAttend.remove(wsck)
                 conf.seatsAvailable += 1
+                self._recordAttendance(conf.key, self._attendanceChanges([prof], -1))
+                self._bumpConferenceVersion(conf)
                 retval = True
             else:
                 retval = False
@@ -557,9 +1239,224 @@ class ConferenceApi(remote.Service):
         conf.put()
         return BooleanMessage(data=retval)
 
+    @staticmethod
+    def _recordAttendance(conf_key, changes, change_id=None):
+        """Apply attendance changes, (profile key, {t-shirt size: delta},
+            registrations) tuples, to a conference's attendee stats.
+            Call inside a transaction on the conference's entity group;
+            the stats share it, so they commit together.
+           A change_id already applied is skipped.
+        """
+        report = attendance.statsKey(conf_key).get() or \
+            ConferenceAttendeeStats(key=attendance.statsKey(conf_key))
+        if change_id:
+            if change_id in report.appliedChanges:
+                return
+            report.appliedChanges = (report.appliedChanges +
+                                     [change_id])[-APPLIED_CHANGES_KEPT:]
+
+        attendance.recordInBackfill(report, changes)
+        # count the attendees from before the stats existed, once
+        attendance.startBackfill(report)
+        attendance.applyChanges(report, changes)
+
+        registrations = sum(change[2] for change in changes)
+        if registrations:
+            today = datetime.utcnow().date().isoformat()
+            daily = dict(report.dailyRegistrations or {})
+            daily[today] = daily.get(today, 0) + registrations
+            report.dailyRegistrations = daily
+
+        report.put()
+
+    @staticmethod
+    def _changeAttendeeSize(wscks, wspk, change_id, old_size, new_size):
+        """Move one attendee from one t-shirt size to another in the
+            stats of every conference they attend; used by a task queue task.
+           Each conference records change_id with the move, so a retried
+            task skips the conferences it already moved the attendee in.
+        """
+        changes = [(ndb.Key(urlsafe=wspk) if wspk else None,
+                    {old_size: -1, new_size: 1}, 0)]
+        for wsck in wscks:
+            ndb.transaction(lambda: ConferenceApi._recordAttendance(
+                ndb.Key(urlsafe=wsck), changes, change_id))
+
+    @staticmethod
+    @ndb.transactional()
+    def _startAttendeeBackfill(conf_key):
+        """Start counting a conference's earlier attendees into its
+            stats, if no count was started"""
+        report = attendance.statsKey(conf_key).get() or \
+            ConferenceAttendeeStats(key=attendance.statsKey(conf_key))
+        if not report.backfill:
+            attendance.startBackfill(report)
+            report.put()
+
     @endpoints.method(
-        message_types.VoidMessage, ConferenceForms,
+        CONF_GET_REQUEST, AttendeeReportForm,
+        path='conference/{websafeConferenceKey}/attendeeReport',
+        http_method='GET', name='getConferenceAttendeeReport')
+    @captured
+    def getConferenceAttendeeReport(self, request):
+        """Return attendee counts by t-shirt size and registrations per day;
+            only available to the conference's organizer
+        """
+
+        user_id = getUserId(self._getCurrentUser())
+        conf_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+        conf, report = ndb.get_multi([conf_key, attendance.statsKey(conf_key)])
+        if not conf:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % request.websafeConferenceKey)
+        if user_id != conf.organizerUserId:
+            raise endpoints.ForbiddenException(
+                'Only the organizer can see the attendee report.')
+
+        if not report or not report.backfill:
+            self._startAttendeeBackfill(conf_key)
+        report = report or ConferenceAttendeeStats()
+        return AttendeeReportForm(
+            attendees=report.attendees,
+            counting=report.backfill != 'DONE',
+            sizes=[SizeCountForm(teeShirtSize=getattr(TeeShirtSize, size), count=count)
+                   for size, count in sorted(report.sizeCounts.items())],
+            registrations=[DailyCountForm(date=day, count=count)
+                           for day, count in sorted(report.dailyRegistrations.items())])
+
+    @staticmethod
+    def _attendanceChanges(profiles, sign=1):
+        """Return the attendance changes of adding (or removing) profiles"""
+        return [(prof.key, {prof.teeShirtSize: sign}, sign) for prof in profiles]
+
+    @ndb.transactional()
+    def _reserveSeats(self, conf_key, profiles):
+        """Take a seat from a conference for each profile, all or nothing,
+            recording them in the attendee stats in the same transaction
+        """
+        conf = conf_key.get()
+        if conf.seatsAvailable < len(profiles):
+            raise ConflictException(
+                "Only %d seats available for %d members."
+                % (conf.seatsAvailable, len(profiles)))
+        conf.seatsAvailable -= len(profiles)
+        self._recordAttendance(conf_key, self._attendanceChanges(profiles))
+        self._bumpConferenceVersion(conf)
+        conf.put()
+        return conf.seatsAvailable
+
+    @ndb.transactional()
+    def _releaseSeats(self, conf_key, profiles):
+        """Give back the seats reserved for profiles that weren't registered"""
+        conf = conf_key.get()
+        conf.seatsAvailable += len(profiles)
+        self._recordAttendance(conf_key, self._attendanceChanges(profiles, -1))
+        self._bumpConferenceVersion(conf)
+        conf.put()
+        return conf.seatsAvailable
+
+    @ndb.transactional(xg=True)
+    def _addConferenceToProfiles(self, profile_keys, wsck):
+        """Register a chunk of profiles for a conference.
+           Returns the profiles that were registered by this call.
+        """
+        added = []
+        profiles = [prof for prof in ndb.get_multi(profile_keys) if prof]
+        for prof in profiles:
+            if wsck not in prof.conferenceKeysToAttend:
+                prof.conferenceKeysToAttend.append(wsck)
+                added.append(prof)
+        ndb.put_multi(added)
+        return added
+
+    @endpoints.method(
+        GROUP_REGISTRATION_REQUEST, GroupRegistrationResultForm,
+        path='conference/{websafeConferenceKey}/group',
+        http_method='POST', name='registerGroupForConference')
+    @captured
+    @rateLimited(cost=5)
+    def registerGroupForConference(self, request):
+        """Register several profiles for a conference at once.
+            Organizer only.
+           Seats for the whole group are reserved, and recorded in the
+            attendee stats, in one transaction on the conference before
+            any profile is touched, so seats are never oversold; seats left
+            over by members who turn out to be registered already are given
+            back at the end.
+        """
+
+        user = self._getCurrentUser()
+        user_id = getUserId(user)
+        wsck = request.websafeConferenceKey
+
+        conf = ndb.Key(urlsafe=wsck).get()
+        if not conf:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % wsck)
+
+        # de-duplicate while keeping the order the members were given in
+        profile_ids = []
+        for profile_id in request.profileIds:
+            if profile_id not in profile_ids:
+                profile_ids.append(profile_id)
+
+        # registering takes seats in the members' names, so only the
+        #   organizer may do it for others
+        if user_id != conf.organizerUserId:
+            raise endpoints.ForbiddenException(
+                'Only the organizer can register a group.')
+
+        outcomes = {}
+        candidates = []
+        profiles = ndb.get_multi([ndb.Key(Profile, pid) for pid in profile_ids])
+        for profile_id, prof in zip(profile_ids, profiles):
+            if not prof:
+                outcomes[profile_id] = 'NO_PROFILE'
+            elif wsck in prof.conferenceKeysToAttend:
+                outcomes[profile_id] = 'ALREADY_REGISTERED'
+            else:
+                candidates.append(prof)
+
+        seats = conf.seatsAvailable
+        if candidates:
+            seats = self._reserveSeats(conf.key, candidates)
+
+        registered = 0
+        registered_ids = set()
+        for start in range(0, len(candidates), GROUP_REGISTRATION_CHUNK_SIZE):
+            chunk = [prof.key for prof in candidates[start:start + GROUP_REGISTRATION_CHUNK_SIZE]]
+            try:
+                added = self._addConferenceToProfiles(chunk, wsck)
+                missing_status = 'ALREADY_REGISTERED'
+            except Exception:
+                # the commit may still have gone through; count whoever is
+                #   registered now as using a seat, so nothing is oversold
+                logging.exception('Group registration chunk failed for %s', wsck)
+                added = [prof for prof in ndb.get_multi(chunk)
+                         if prof and wsck in prof.conferenceKeysToAttend]
+                missing_status = 'FAILED'
+            added_ids = set(prof.key.id() for prof in added)
+            for key in chunk:
+                # not added normally means the member registered on their own meanwhile
+                outcomes[key.id()] = 'REGISTERED' if key.id() in added_ids else missing_status
+            registered_ids.update(added_ids)
+            registered += len(added)
+
+        if registered < len(candidates):
+            seats = self._releaseSeats(conf.key, [prof for prof in candidates
+                                                  if prof.key.id() not in registered_ids])
+
+        return GroupRegistrationResultForm(
+            items=[GroupMemberResultForm(profileId=pid, status=outcomes[pid])
+                   for pid in profile_ids],
+            registered=registered,
+            seatsAvailable=seats)
+
+    @endpoints.method(
+        ARCHIVE_OPTION_REQUEST, ConferenceForms,
         path='conferences/attending', http_method='GET', name='getConferencesToAttend')
+    @captured
+    @readConsistency
     def getConferencesToAttend(self, request):
         """Get list of conferences that user has registered for."""
 
@@ -567,11 +1464,14 @@ class ConferenceApi(remote.Service):
 
         # build ndb.Keys() using the websafe keys inside prof.conferenceKeysToAttend
         conf_keys = [ndb.Key(urlsafe=wsck) for wsck in prof.conferenceKeysToAttend]
-        conferences = ndb.get_multi(conf_keys)
+        # archived conferences are only listed when asked for
+        options = readOptions(self)
+        conferences = [conf for conf in archive.getMulti(
+            conf_keys, request.includeArchived, **options) if conf is not None]
 
         # get organizers (users who create confs)
         organisers = [ndb.Key(Profile, conf.organizerUserId) for conf in conferences]
-        profiles = ndb.get_multi(organisers)
+        profiles = ndb.get_multi(organisers, **options)
 
         # put display names in a dict for easier fetching
         names = {}
@@ -586,6 +1486,8 @@ class ConferenceApi(remote.Service):
         CONF_GET_REQUEST, BooleanMessage,
         path='conference/{websafeConferenceKey}',
         http_method='POST', name='registerForConference')
+    @captured
+    @rateLimited(cost=1)
     def registerForConference(self, request):
         """Register user for selected conference."""
 
@@ -595,6 +1497,8 @@ class ConferenceApi(remote.Service):
         CONF_GET_REQUEST, BooleanMessage,
         path='conference/{websafeConferenceKey}',
         http_method='DELETE', name='unregisterFromConference')
+    @captured
+    @rateLimited(cost=1)
     def unregisterFromConference(self, request):
         """Unregister user for selected conference."""
 
@@ -602,13 +1506,19 @@ class ConferenceApi(remote.Service):
 
 # - - - Sessions - - - - - - - - - - - - - - - - - - -
 
-    def _copySessionToForm(self, session):
-        """Copy relevant fields from Session to SessionForm"""
+    def _copySessionToForm(self, session, highlights=None):
+        """Copy relevant fields from Session to SessionForm.
+           Lists get the summary form; highlights are only
+            included when passed in, for the detail form.
+        """
 
         sf = SessionForm()
         for field in sf.all_fields():
+            if field.name == 'highlights':
+                if highlights:
+                    sf.highlights = highlights
             # check session container to see if matching fields exist
-            if hasattr(session, field.name):
+            elif hasattr(session, field.name):
                 # convert time fields to string; just copy others
                 if field.name.endswith('Time'):
                     setattr(sf, field.name, getattr(session, field.name).strftime("%I:%M"))
@@ -619,85 +1529,329 @@ class ConferenceApi(remote.Service):
                     val_to_set = getattr(session, field.name)
                     setattr(sf, field.name, val_to_set)
             elif field.name == 'websafe_key':
-                setattr(sf, field.name, session.key.urlsafe())
+                setattr(sf, field.name, archive.hotKey(session.key).urlsafe())
         sf.check_initialized()
         return sf
 
-    def _createSessionObject(self, request):
-        """Given a SessionForm request, create a Session entity"""
+    def _sessionsFromForms(self, forms, conf_key):
+        """Return a (Session, SessionDetail or None) pair per SessionForm,
+            with keys allocated under the conference but not yet saved.
+        """
+        first, _ = Session.allocate_ids(size=len(forms), parent=conf_key)
+        sessions = []
+        for session_id, form in enumerate(forms, first):
+            # Copy values to data from request object
+            data = {name: getattr(form, name) for name in SESSION_FORM_FIELDS}
+
+            # convert startTime into datetime.time object
+            #   since Session Kind expects a ndb.TimeProperty
+            if data['startTime']:
+                data['startTime'] = datetime.strptime(data['startTime'], '%H:%M').time()
+
+            if data['date']:
+                data['date'] = datetime.strptime(data['date'][:10], "%Y-%m-%d").date()
+
+            # highlights go in a SessionDetail child, so that
+            #   reading lists of sessions doesn't load them
+            highlights = data.pop('highlights')
+
+            # the key has the parent conference embedded as the parent
+            data['key'] = ndb.Key(Session, session_id, parent=conf_key)
+            detail = None
+            if highlights:
+                detail = SessionDetail(key=self._sessionDetailKey(data['key']),
+                                       highlights=highlights)
+            sessions.append((Session(**data), detail))
+        return sessions
+
+    def _createSessions(self, parent_wsck, forms, allow_overlap=False):
+        """Create the sessions of a conference given SessionForms,
+            booking their rooms. Returns a (status, SessionForm) pair per
+            form, in order; status is CREATED, CONFLICT for a session
+            overlapping another one in its room (only created if
+            allow_overlap is set; either way its form lists the sessions
+            it overlaps in conflicts), or FAILED if it couldn't be saved.
+           Caches are invalidated for the sessions that were created even
+            when others failed.
+        """
 
         # get current user
         # returns a Profile object
         user = self._getCurrentUserProfile()
 
-        print request
-
         # get parent Conference entity using wsck from request
-        parent_conf = self._getEntityByWebSafeKey(request.parent_wsck)
+        parent_conf = self._getEntityByWebSafeKey(parent_wsck)
 
         # raise exception if current user is not author of this session's conference
         if not parent_conf.key.parent().get() == user:
             raise endpoints.UnauthorizedException(
                 "You must be the conference's author to create its sessions.")
 
-        # Allocate id for new Session entity
-        session_id = Session.allocate_ids(size=1, parent=parent_conf.key)[0]
-        session_key = ndb.Key(Session, session_id, parent=parent_conf.key)
-
-        # Copy values to data from request object
-        data = {field.name: getattr(request, field.name)
-                for field in request.all_fields()}
+        prepared = self._sessionsFromForms(forms, parent_conf.key)
+
+        # sessions without a room or a time can't clash and are saved
+        #   as they are; the others are booked room by room, in parallel
+        rooms = collections.OrderedDict()
+        locations = {}
+        unbooked = []
+        for i, (session, _) in enumerate(prepared):
+            room_key = self._roomScheduleKey(parent_conf.key, session.location)
+            if room_key and roomSlot(session):
+                rooms.setdefault(room_key, []).append(i)
+                locations.setdefault(room_key, session.location)
+            else:
+                unbooked.append(i)
+        self._ensureRoomSchedules(parent_conf.key, locations)
+
+        # in case a booking dies between reserving its slots and saving
+        #   its sessions, a delayed task releases the slots left unused
+        release = taskutils.TaskBatch()
+        for room_key, indexes in rooms.items():
+            release.add(self._releaseRoomSlotsTask(
+                room_key, [prepared[i][0].key for i in indexes]))
+        release.flush()
+
+        @ndb.tasklet
+        def saveUnbooked():
+            yield ndb.put_multi_async(
+                [entity for i in unbooked for entity in prepared[i] if entity])
+            raise ndb.Return([(True, [])] * len(unbooked))
+
+        bookings = [(indexes, self._bookRoom(room_key, [prepared[i] for i in indexes],
+                                             allow_overlap))
+                    for room_key, indexes in rooms.items()]
+        if unbooked:
+            bookings.append((unbooked, saveUnbooked()))
+        results = [None] * len(prepared)
+        failed = []
+        for indexes, future in bookings:
+            # one room failing doesn't undo the others, which are saved
+            #   and still need the caches below to be invalidated
+            try:
+                room_results = future.get_result()
+            except Exception:
+                logging.exception('Saving sessions of %s failed', parent_wsck)
+                failed.extend(indexes)
+                room_results = [(False, [])] * len(indexes)
+            for i, result in zip(indexes, room_results):
+                results[i] = result
+        if failed:
+            # a failed put may still have saved some of its sessions
+            try:
+                saved = ndb.get_multi([prepared[i][0].key for i in failed],
+                                      use_cache=False)
+            except Exception:
+                logging.exception('Checking the failed sessions of %s failed', parent_wsck)
+                saved = [None] * len(failed)
+            for i, session in zip(failed, saved):
+                if session:
+                    results[i] = (True, [])
+            failed = [i for i, session in zip(failed, saved) if not session]
+
+        created = [session for (session, _), (ok, _) in zip(prepared, results) if ok]
+        if created or failed:
+            version = self._bumpSessionsVersion(parent_wsck)
+            if not failed:
+                # sessions whose save failed may still be committed later,
+                #   so the new version's caches are rebuilt instead
+                self._addToCachedSchedule(parent_wsck, created, version)
+                self._addToCachedSessions(parent_wsck, created, version)
+            typeahead.addTerms({'speaker': [session.speaker for session in created]})
+            ical.invalidateConference(parent_wsck)
+
+            # create a task to update the featured speaker, if required;
+            #   sessions created in a burst share one task per conference
+            batch = taskutils.TaskBatch()
+            batch.add(self._featuredSpeakerTask(parent_conf.key))
+            batch.flushOnCommit()
+        conflicting = sum(1 for _, conflicts in results if conflicts)
+        if conflicting:
+            stats.incr('rooms.conflicts', conflicting)
+        if failed:
+            stats.incr('sessions.failedSaves', len(failed))
+
+        failed = set(failed)
+        session_forms = []
+        for i, ((session, detail), (ok, conflicts)) in enumerate(zip(prepared, results)):
+            sf = self._copySessionToForm(
+                session, highlights=detail.highlights if detail else None)
+            sf.conflicts = conflicts
+            if ok:
+                status = 'CREATED'
+            else:
+                # the allocated key was never used
+                sf.websafe_key = None
+                status = 'FAILED' if i in failed else 'CONFLICT'
+            session_forms.append((status, sf))
+        return session_forms
 
-        # remove fields which are not to be saved in the new Session entity
-        del data['websafe_key']
-        del data['parent_wsck']
+    @staticmethod
+    def _addToCachedSessions(wsck, sessions, version):
+        """Carry the cached sessions of the previous sessions version
+            over to the new one with newly created sessions added.
+        """
+        if version is None:
+            return
+        previous = memcache.get(MEMCACHE_SESSIONS_TPL % (wsck, version - 1))
+        if previous is None:
+            return
+        known = set(session.key for session in previous)
+        memcache.set(MEMCACHE_SESSIONS_TPL % (wsck, version),
+                     previous + [session for session in sessions
+                                 if session.key not in known],
+                     time=SCHEDULE_TTL)
 
-        # convert startTime into datetime.time object
-        #   since Session Kind expects a ndb.TimeProperty
-        if data['startTime']:
-            data['startTime'] = datetime.strptime(data['startTime'], '%H:%M').time()
+    @endpoints.method(
+        SESSION_POST_REQUEST, SessionForm,
+        path='createSession/{parent_wsck}', http_method='POST', name='createSession/')
+    @captured
+    @rateLimited(cost=2)
+    def createSession(self, request):
+        """Create a Session entity given a parent wsck.
+           A session overlapping another one in the same room is rejected,
+            unless allowOverlap is set.
+        """
 
-        if data['date']:
-            data['date'] = datetime.strptime(data['date'][:10], "%Y-%m-%d").date()
+        status, sf = self._createSessions(
+            request.parent_wsck, [request], request.allowOverlap)[0]
+        if status == 'FAILED':
+            raise endpoints.InternalServerErrorException(
+                'The session could not be saved; try again.')
+        if status == 'CONFLICT':
+            raise ConflictException(
+                'Room %s is already booked at that time by: %s'
+                % (request.location, ', '.join(sf.conflicts)))
+        return sf
 
-        # assign the key of the to-be-created Session entity to be 'session_key',
-        #   which has the parent_conf embedded as the parent.
-        data['key'] = session_key
+    @endpoints.method(
+        SESSIONS_POST_REQUEST, SessionResultForms,
+        path='createSessions/{parent_wsck}', http_method='POST', name='createSessions')
+    @captured
+    @rateLimited(cost=10)
+    def createSessions(self, request):
+        """Create several sessions of a conference at once.
+           Sessions are checked for overlaps with each other as well as
+            with the sessions already booked; one that overlaps is reported
+            as CONFLICT and not created, unless allowOverlap is set. A
+            session that couldn't be saved is reported as FAILED and can
+            be sent again.
+        """
 
-        # create the session entity
-        saved_session = Session(**data).put().get()
+        if not request.items:
+            raise endpoints.BadRequestException('No sessions given.')
+        if len(request.items) > MAX_BATCH_SESSIONS:
+            raise endpoints.BadRequestException(
+                'At most %d sessions can be created at once.' % MAX_BATCH_SESSIONS)
 
-        # create a task to update the featured speaker, if required.
-        taskqueue.add(
-            url="/tasks/check_featured_speaker",
-            params={'parent_wsck': request.parent_wsck, 'speaker': saved_session.speaker})
+        results = self._createSessions(
+            request.parent_wsck, request.items, request.allowOverlap)
+        return SessionResultForms(
+            items=[SessionResultForm(session=sf, status=status)
+                   for status, sf in results],
+            created=sum(1 for status, _ in results if status == 'CREATED'))
 
-        return self._copySessionToForm(session_key.get())
+    @staticmethod
+    def _sessionDetailKey(session_key):
+        """Return the key of a session's SessionDetail"""
+        return ndb.Key(SessionDetail, 1, parent=session_key)
 
     @endpoints.method(
-        endpoints.ResourceContainer(SessionForm, parent_wsck=messages.StringField(1)),
-        SessionForm,
-        path='createSession/{parent_wsck}', http_method='POST', name='createSession/')
-    def createSession(self, request):
-        """Create a Session entity given a parent wsck"""
+        SESSION_GET_REQUEST, SessionForm,
+        path='session/{websafeSessionKey}', http_method='GET', name='getSession')
+    @captured
+    def getSession(self, request):
+        """Return a session with its highlights"""
 
-        return self._createSessionObject(request)
+        try:
+            session_key = ndb.Key(urlsafe=request.websafeSessionKey)
+        except Exception:
+            raise endpoints.BadRequestException(
+                'Invalid session key: %s' % request.websafeSessionKey)
+        if session_key.kind() != 'Session':
+            raise endpoints.BadRequestException(
+                'Not a session key: %s' % request.websafeSessionKey)
+
+        session, detail = ndb.get_multi([session_key, self._sessionDetailKey(session_key)])
+        if not session:
+            raise endpoints.NotFoundException(
+                'No session found with key: %s' % request.websafeSessionKey)
+
+        # sessions created before SessionDetail keep highlights on the entity
+        highlights = detail.highlights if detail else session.highlights
+        return self._copySessionToForm(session, highlights=highlights)
+
+    @staticmethod
+    def _migrateSessionDetails(cursor=None):
+        """Move highlights of one page of older sessions into SessionDetail.
+           Returns the cursor for the next page, or None when done.
+        """
+        sessions, next_cursor, more = Session.query().fetch_page(
+            SESSION_MIGRATION_PAGE_SIZE, start_cursor=cursor)
+
+        to_put = []
+        for session in sessions:
+            if session.highlights:
+                to_put.append(SessionDetail(
+                    key=ConferenceApi._sessionDetailKey(session.key),
+                    highlights=session.highlights))
+                session.highlights = None
+                to_put.append(session)
+        ndb.put_multi(to_put)
+
+        return next_cursor if more else None
 
     # TASK 1b: COMPLETE
     @endpoints.method(
         GetConferenceForm, SessionForms,
         path='getConferenceSessions', http_method='GET', name='getConferenceSessions')
+    @captured
+    @readConsistency
     def getConferenceSessions(self, request):
-        """Given a conference, return its sessions"""
+        """Given a conference, return its sessions.
+           If ifNoneMatch carries the current ETag, only notModified is returned.
+           Eventual reads are served from the sessions cache, or else
+            queried without an ETag: the query may miss the latest write,
+            which the ETag would claim to include.
+        """
+
+        if self._notModified(self._sessionsVersionKey(request.websafeKey),
+                             'sessions', request.ifNoneMatch, 2):
+            return SessionForms(etag=request.ifNoneMatch, notModified=True)
+
+        # read the version before the sessions, so a concurrent
+        #   write can only make the returned ETag look older
+        version = self._sessionsVersion(request.websafeKey)
+        cache_key = MEMCACHE_SESSIONS_TPL % (request.websafeKey, version)
+        eventual = isEventual(self)
+        if eventual:
+            sessions = memcache.get(cache_key)
+            if sessions is not None:
+                stats.incr('sessions.cacheHits')
+                return SessionForms(items=[self._copySessionToForm(session)
+                                           for session in sessions],
+                                    etag=ETAG_TPL % ('sessions', version))
 
         # get the parent conference entity using the request.websafeKey
-        parent_conf = self._getEntityByWebSafeKey(request.websafeKey)
+        options = readOptions(self)
+        parent_conf = self._getEntityByWebSafeKey(request.websafeKey, **options)
+        if not parent_conf and request.includeArchived:
+            parent_conf = archive.archivedKey(
+                ndb.Key(urlsafe=request.websafeKey)).get(**options)
+        if not parent_conf:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % request.websafeKey)
 
         # query sessions using the parent_conf as ancestor
-        sessions = Session.query(ancestor=parent_conf.key)
+        sessions = Session.query(ancestor=parent_conf.key).fetch(**options)
+        if eventual:
+            stats.incr('sessions.eventualQueries')
+            return SessionForms(items=[self._copySessionToForm(session)
+                                       for session in sessions])
 
+        memcache.set(cache_key, sessions, time=SCHEDULE_TTL)
         return SessionForms(items=[self._copySessionToForm(session)
-                            for session in sessions])
+                                   for session in sessions],
+                            etag=ETAG_TPL % ('sessions', version))
 
     # TASK 1c: COMPLETE
     @endpoints.method(
@@ -705,16 +1859,19 @@ class ConferenceApi(remote.Service):
         SessionForms,
         path='getConferenceSessionsByType',
         http_method='POST', name='getConferenceSessionsByType')
+    @captured
+    @readConsistency
     def getConferenceSessionsByType(self, request):
         """Given a conference, return all sessions of a specified type"""
 
         # retrieve parent Conference entity
-        parent_conf = self._getEntityByWebSafeKey(request.parent_wsck)
+        options = readOptions(self)
+        parent_conf = self._getEntityByWebSafeKey(request.parent_wsck, **options)
 
         # query for sessions of a given session_type
         sessions = Session.query(
             ancestor=parent_conf.key).filter(
-            Session.session_type == request.session_type).fetch()
+            Session.session_type == request.session_type).fetch(**options)
 
         return SessionForms(items=[self._copySessionToForm(session)
                             for session in sessions])
@@ -722,6 +1879,8 @@ class ConferenceApi(remote.Service):
     @endpoints.method(
         SessionBySpeakerQueryForm, SessionForms,
         path='getSessionsBySpeaker', http_method='POST', name='getSessionsBySpeaker')
+    @captured
+    @rateLimited(cost=5)
     def getSessionsBySpeaker(self, request):
         """Returns all sessions given a particular speaker"""
 
@@ -734,9 +1893,36 @@ class ConferenceApi(remote.Service):
 
 # - - - Wishlist - - - - - - - - - - - - - - - - - - -
 
+    @staticmethod
+    @ndb.transactional()
+    def _addWishlistItem(user_key, session_websafe_key, parent_wsck):
+        """Add a session to a user's wishlist, unless it is there already.
+           The check and the write share a transaction on the user's
+            entity group, so two concurrent adds can't both pass the check.
+           Returns the new SessionWishlistItem key.
+        """
+        # check if user already added this Session to wishlist
+        session_in_wishlist = SessionWishlistItem.query(
+            ancestor=user_key).filter(
+            SessionWishlistItem.session_websafe_key == session_websafe_key).get()
+
+        if session_in_wishlist:
+            raise ConflictException('Session already found in wishlist.')
+
+        # create new key for SessionWishlistItem entity
+        #   with user.key as parent
+        session_wishlist_id = SessionWishlistItem.allocate_ids(
+            size=1, parent=user_key)[0]
+        return SessionWishlistItem(
+            key=ndb.Key(SessionWishlistItem, session_wishlist_id, parent=user_key),
+            session_websafe_key=session_websafe_key,
+            parent_wsck=parent_wsck).put()
+
     @endpoints.method(
         SessionWishlistItemForm, SessionWishlistItemForm,
         path='addSessionToWishlist', http_method='GET', name='addSessionToWishlist')
+    @captured
+    @rateLimited(cost=1)
     def addSessionToWishlist(self, request):
         """adds the session to the user's list of sessions wishlist"""
 
@@ -748,39 +1934,31 @@ class ConferenceApi(remote.Service):
         session_websafe_key = request.session_websafe_key
         session_to_add = self._getEntityByWebSafeKey(session_websafe_key)
 
-        # check if user already added this Session to wishlist
-        session_in_wishlist = SessionWishlistItem.query(
-            ancestor=user.key).filter(
-            SessionWishlistItem.session_websafe_key == session_websafe_key).get()
-
-        if session_in_wishlist:
-            raise ConflictException('Session already found in wishlist.')
-
-        # create new key for SessionWishlistItem entity
-        #   with user.key as parent
-        session_wishlist_id = SessionWishlistItem.allocate_ids(
-            size=1, parent=user.key)[0]
-        session_wishlist_key = ndb.Key(
-            SessionWishlistItem, session_wishlist_id, parent=user.key)
-
-        # prepare data to be used for creating new SessionWishlistItem entity
-        data = dict()
-        # overwrite the automatically-generated key
-        #   with our custom parental key
-        data['key'] = session_wishlist_key
-        data['session_websafe_key'] = session_websafe_key
-
         # the denormalized parent conference websafe key of this session
         #   used for easy query filtering in getSessionWishlistItem endpoint
-        data['parent_wsck'] = session_to_add.key.parent().get().key.urlsafe()
+        parent_wsck = session_to_add.key.parent().get().key.urlsafe()
 
-        SessionWishlistItem(**data).put()
+        item_key = self._addWishlistItem(user.key, session_websafe_key, parent_wsck)
+
+        # keep the cached agenda in step with the wishlist
+        self._addToCachedAgenda(user.key.id(), session_to_add)
+        ical.invalidateUser(user.key.id())
+
+        # count the new session as wishlisted with the user's others
+        batch = taskutils.TaskBatch()
+        batch.add(taskqueue.Task(
+            url='/tasks/update_recommendations',
+            params={'user': user.key.urlsafe(), 'session': session_websafe_key,
+                    'item': item_key.urlsafe()}))
+        batch.flushOnCommit()
 
         return request
 
     @endpoints.method(
         SessionWishlistQueryForm, SessionForms,
         path='getSessionsInWishlist', http_method='POST', name='getSessionsInWishlist')
+    @captured
+    @readConsistency
     def getSessionsInWishlist(self, request):
         """Given a conference,
             find all user's SessionWishlistItem in that conference
@@ -788,51 +1966,461 @@ class ConferenceApi(remote.Service):
 
         # get user and conference entities from request
         user = self._getCurrentUserProfile()
-        conference = self._getEntityByWebSafeKey(request.wsck)
+        options = readOptions(self)
+        conference = archive.getMulti([ndb.Key(urlsafe=request.wsck)],
+                                      request.includeArchived, **options)[0]
+        if not conference:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % request.wsck)
 
         # query for SessionWishlistItem entities
         #   using user as ancestor
-        #   and wsck as parent conference
+        #   and wsck as parent conference;
+        #   items of archived conferences are archived with them
+        ancestor = user.key
+        if archive.isArchived(conference.key):
+            ancestor = archive.archivedKey(user.key)
         wishlist = SessionWishlistItem.query(
-            ancestor=user.key).filter(
-            SessionWishlistItem.parent_wsck == conference.key.urlsafe()).fetch()
+            ancestor=ancestor).filter(
+            SessionWishlistItem.parent_wsck == request.wsck).fetch(**options)
 
         # get Session entities from wishlist
-        sessions = [ndb.Key(urlsafe=wishlist_item.session_websafe_key).get()
-                    for wishlist_item in wishlist]
+        sessions = archive.getMulti(
+            [ndb.Key(urlsafe=wishlist_item.session_websafe_key)
+             for wishlist_item in wishlist], request.includeArchived, **options)
 
         return SessionForms(items=[self._copySessionToForm(session)
-                                   for session in sessions])
+                                   for session in sessions if session is not None])
+
+    @endpoints.method(
+        message_types.VoidMessage, StringMessage,
+        path='getMyCalendarFeed', http_method='GET', name='getMyCalendarFeed')
+    @captured
+    def getMyCalendarFeed(self, request):
+        """Return the path of the user's wishlist calendar (.ics) feed"""
+
+        prof = self._getProfileFromUser()
+        if not prof.calendarToken:
+            prof.calendarToken = uuid.uuid4().hex
+            prof.put()
+
+        return StringMessage(data='/feeds/user/%s.ics' % prof.calendarToken)
+
+# - - - Recommendations - - - - - - - - - - - - - - - -
+
+    @endpoints.method(
+        RecommendedSessionsQueryForm, SessionForms,
+        path='getRecommendedSessions', http_method='POST', name='getRecommendedSessions')
+    @captured
+    def getRecommendedSessions(self, request):
+        """Return the sessions most often wishlisted together with a session"""
+
+        limit = max(1, min(request.limit or recommendations.TOP_K,
+                           recommendations.TOP_K))
+        wssks = recommendations.getNeighbors(request.session_websafe_key, limit)
+        sessions = ndb.get_multi([ndb.Key(urlsafe=wssk) for wssk in wssks])
+
+        return SessionForms(items=[self._copySessionToForm(session)
+                                   for session in sessions if session is not None])
+
+# - - - Agenda - - - - - - - - - - - - - - - - - - - -
+
+    def _buildAgendaIndex(self, sessions):
+        """Build the agenda index for a list of Session entities.
+           Dated sessions are kept sorted by start time;
+           sessions without a date or time cannot conflict and are kept apart.
+        """
+        index = {'dated': [], 'undated': []}
+        for session in sessions:
+            interval = sessionInterval(session)
+            if interval:
+                index['dated'].append(interval + (session.key.urlsafe(),))
+            else:
+                index['undated'].append(session.key.urlsafe())
+        index['dated'].sort()
+        return index
+
+    def _addToCachedAgenda(self, user_id, session):
+        """Insert a newly wishlisted session into the user's cached agenda.
+           If the agenda is not cached, or it changed underneath us,
+           drop it so the next getMyAgenda rebuilds it.
+        """
+        cache_key = MEMCACHE_AGENDA_TPL % user_id
+        client = memcache.Client()
+        index = client.gets(cache_key)
+        if index is None:
+            return
+
+        interval = sessionInterval(session)
+        if interval:
+            bisect.insort(index['dated'], interval + (session.key.urlsafe(),))
+        else:
+            index['undated'].append(session.key.urlsafe())
+
+        if not client.cas(cache_key, index):
+            memcache.delete(cache_key)
+
+    @endpoints.method(
+        message_types.VoidMessage, AgendaForm,
+        path='getMyAgenda', http_method='GET', name='getMyAgenda')
+    @captured
+    @rateLimited(cost=2)
+    def getMyAgenda(self, request):
+        """Return the user's wishlisted sessions across all conferences,
+            sorted by start time, with overlapping sessions flagged
+        """
+
+        user = self._getCurrentUserProfile()
+        cache_key = MEMCACHE_AGENDA_TPL % user.key.id()
+
+        index = memcache.get(cache_key)
+        if index is None:
+            wishlist = SessionWishlistItem.query(ancestor=user.key).fetch()
+            sessions = ndb.get_multi([ndb.Key(urlsafe=item.session_websafe_key)
+                                      for item in wishlist])
+            index = self._buildAgendaIndex(
+                [session for session in sessions if session is not None])
+            memcache.set(cache_key, index)
+
+        overlaps = findOverlaps(index['dated'])
+
+        ordered_keys = [entry[2] for entry in index['dated']] + index['undated']
+        sessions = ndb.get_multi([ndb.Key(urlsafe=wssk) for wssk in ordered_keys])
+
+        return AgendaForm(items=[
+            AgendaItemForm(session=self._copySessionToForm(session),
+                           conflicts=sorted(overlaps.get(wssk, ())))
+            for wssk, session in zip(ordered_keys, sessions) if session is not None])
+
+# - - - Rooms - - - - - - - - - - - - - - - - - - - - - -
+
+    @staticmethod
+    def _roomScheduleKey(conf_key, location):
+        """Return the key of the RoomSchedule of a conference's room,
+            or None if location names no room.
+        """
+        name = roomName(location)
+        if not name:
+            return None
+        return ndb.Key(RoomSchedule, '%s:%s' % (
+            archive.hotKey(conf_key).urlsafe(),
+            hashlib.sha1(name.encode('utf-8')).hexdigest()))
+
+    @staticmethod
+    def _ensureRoomSchedules(conf_key, locations):
+        """Return the RoomSchedules for a dict of {room key: location},
+            creating those missing from the conference's existing sessions.
+           That reads the whole conference once per room, the first time
+            a session is booked in it; bookings then keep it up to date.
+        """
+        keys = list(locations)
+        schedules = dict(zip(keys, ndb.get_multi(keys)))
+        missing = [key for key in keys if schedules[key] is None]
+        if not missing:
+            return schedules
+
+        slots = collections.defaultdict(list)
+        for session in Session.query(ancestor=conf_key):
+            room_key = ConferenceApi._roomScheduleKey(conf_key, session.location)
+            slot = roomSlot(session)
+            if room_key in schedules and slot:
+                slots[room_key].append((slot, session.duration or 0))
+
+        def insert(schedule):
+            @ndb.tasklet
+            def txn():
+                # a concurrent booking may have created it already
+                existing = yield schedule.key.get_async()
+                if existing:
+                    raise ndb.Return(existing)
+                yield schedule.put_async()
+                raise ndb.Return(schedule)
+            return ndb.transaction_async(txn)
+
+        futures = []
+        for key in missing:
+            room = sorted(slots[key])
+            futures.append((key, insert(RoomSchedule(
+                key=key, location=locations[key],
+                slots=[slot for slot, _ in room],
+                maxDuration=max([duration for _, duration in room] or [0])))))
+        for key, future in futures:
+            schedules[key] = future.get_result()
+        stats.incr('rooms.schedulesBuilt', len(missing))
+        return schedules
+
+    @staticmethod
+    @ndb.tasklet
+    def _bookRoom(room_key, prepared, allow_overlap):
+        """Book (Session, SessionDetail) pairs into a room and save them.
+           The slots are reserved in a transaction on the RoomSchedule
+            alone, a root entity, so bookings of different rooms never
+            contend; the booked sessions are saved after it commits. If
+            saving them fails, the slots of the sessions that weren't
+            saved are released again before the error is raised.
+           Returns a (created, websafe keys of overlapping sessions) pair
+            per session.
+        """
+        @ndb.tasklet
+        def txn():
+            schedule = yield room_key.get_async()
+            slots = list(schedule.slots)
+            results = []
+            for session, _ in prepared:
+                slot = roomSlot(session)
+                conflicts = [other[2] for other in slotConflicts(
+                    slots, schedule.maxDuration, slot[0], slot[1])]
+                if conflicts and not allow_overlap:
+                    results.append((False, conflicts))
+                    continue
+                bisect.insort(slots, slot)
+                schedule.maxDuration = max(schedule.maxDuration, session.duration or 0)
+                results.append((True, conflicts))
+            if len(slots) != len(schedule.slots):
+                schedule.slots = slots
+                yield schedule.put_async()
+            raise ndb.Return(results)
+
+        results = yield ndb.transaction_async(txn)
+        booked = [pair for pair, (ok, _) in zip(prepared, results) if ok]
+        if booked:
+            try:
+                yield ndb.put_multi_async(
+                    [entity for pair in booked for entity in pair if entity])
+            except Exception:
+                # the release yields, which can replace the exception being handled
+                exc_info = sys.exc_info()
+                logging.exception('Saving sessions booked in %s failed', room_key.id())
+                yield ConferenceApi._releaseRoomSlots(
+                    room_key, [session.key for session, _ in booked])
+                raise exc_info[0], exc_info[1], exc_info[2]
+        raise ndb.Return(results)
+
+    @staticmethod
+    @ndb.tasklet
+    def _releaseRoomSlots(room_key, session_keys):
+        """Remove from a room's schedule the slots of the given sessions
+            that don't exist.
+        """
+        sessions = yield ndb.get_multi_async(session_keys, use_cache=False)
+        missing = set(key.urlsafe() for key, session in zip(session_keys, sessions)
+                      if session is None)
+        if not missing:
+            return
+
+        @ndb.tasklet
+        def txn():
+            schedule = yield room_key.get_async()
+            if not schedule:
+                return
+            slots = [slot for slot in schedule.slots if slot[2] not in missing]
+            if len(slots) != len(schedule.slots):
+                schedule.slots = slots
+                yield schedule.put_async()
+
+        yield ndb.transaction_async(txn)
+        stats.incr('rooms.slotsReleased', len(missing))
+
+    @staticmethod
+    def _releaseRoomSlotsTask(room_key, session_keys):
+        """Return a delayed task releasing the slots of the given
+            sessions that haven't been saved by then.
+        """
+        return taskqueue.Task(
+            url='/tasks/release_room_slots',
+            params={'room': room_key.urlsafe(),
+                    'session': [key.urlsafe() for key in session_keys]},
+            countdown=ROOM_RELEASE_DELAY)
+
+    @endpoints.method(
+        ROOM_SCHEDULE_REQUEST, SessionForms,
+        path='conference/{websafeConferenceKey}/room',
+        http_method='GET', name='getRoomSchedule')
+    @captured
+    def getRoomSchedule(self, request):
+        """Return the sessions booked in a room of a conference, by start
+            time; each lists the sessions it overlaps in conflicts.
+        """
+
+        try:
+            conf_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+        except Exception:
+            raise endpoints.BadRequestException(
+                'Invalid conference key: %s' % request.websafeConferenceKey)
+        room_key = self._roomScheduleKey(conf_key, request.location)
+        if not room_key:
+            raise endpoints.BadRequestException('A location is required.')
+
+        schedule = self._ensureRoomSchedules(conf_key, {room_key: request.location})[room_key]
+        overlaps = findOverlaps([tuple(slot) for slot in schedule.slots])
+        sessions = ndb.get_multi([ndb.Key(urlsafe=slot[2]) for slot in schedule.slots])
+
+        items = []
+        for slot, session in zip(schedule.slots, sessions):
+            if session:
+                sf = self._copySessionToForm(session)
+                sf.conflicts = sorted(overlaps.get(slot[2], []))
+                items.append(sf)
+        return SessionForms(items=items)
+
+# - - - Happening Now - - - - - - - - - - - - - - - - - -
+
+    @staticmethod
+    def _buildSchedule(wsck):
+        """Return a conference's dated sessions as sorted
+            (start, end, session key) entries.
+        """
+        sessions = Session.query(ancestor=ndb.Key(urlsafe=wsck)).fetch()
+        return sorted(sessionInterval(session) + (session.key.urlsafe(),)
+                      for session in sessions if sessionInterval(session))
+
+    @staticmethod
+    def _getSchedule(wsck):
+        """Return (entries, start times, longest duration) of a conference's
+            schedule, from instance memory, memcache or the datastore.
+           Only one request at a time rebuilds a missing schedule, so the
+            opening rush is served from memcache rather than the datastore.
+        """
+        now = time.time()
+        with _local_schedules_lock:
+            local = _local_schedules.get(wsck)
+        if local and now - local['checked'] < SCHEDULE_LOCAL_TTL:
+            stats.incr('schedule.localHits')
+            return local['entries'], local['starts'], local['maxDuration']
+
+        version = ConferenceApi._sessionsVersion(wsck)
+        if not local or local['version'] != version:
+            entries = singleflight.get(
+                MEMCACHE_SCHEDULE_TPL % (wsck, version),
+                lambda: ConferenceApi._buildSchedule(wsck),
+                ttl=SCHEDULE_TTL, soft_ttl=SCHEDULE_TTL)
+            local = {'version': version, 'entries': entries,
+                     'starts': [entry[0] for entry in entries],
+                     'maxDuration': max([entry[1] - entry[0] for entry in entries]
+                                        or [timedelta(0)])}
+        else:
+            # shared with other threads; replace rather than update it
+            local = dict(local)
+        local['checked'] = now
+
+        with _local_schedules_lock:
+            _local_schedules.pop(wsck, None)
+            _local_schedules[wsck] = local
+            while len(_local_schedules) > MAX_LOCAL_SCHEDULES:
+                _local_schedules.popitem(last=False)
+        return local['entries'], local['starts'], local['maxDuration']
+
+    @staticmethod
+    def _addToCachedSchedule(wsck, sessions, version):
+        """Carry the cached schedule of the previous sessions version
+            over to the new one with newly created sessions inserted.
+           If it isn't cached, the next read rebuilds it instead.
+        """
+        if version is None:
+            return
+        previous = memcache.get(MEMCACHE_SCHEDULE_TPL % (wsck, version - 1))
+        if not isinstance(previous, tuple):
+            return
+
+        entries = list(previous[0])
+        known = set(entry[2] for entry in entries)
+        for session in sessions:
+            interval = sessionInterval(session)
+            wssk = session.key.urlsafe()
+            # a rebuild racing with the write may already include the session
+            if interval and wssk not in known:
+                bisect.insort(entries, interval + (wssk,))
+        singleflight.store(MEMCACHE_SCHEDULE_TPL % (wsck, version), entries,
+                           ttl=SCHEDULE_TTL, soft_ttl=SCHEDULE_TTL)
+        stats.incr('schedule.incrementalUpdates')
+
+    @endpoints.method(
+        SESSIONS_AT_REQUEST, SessionsAtForm,
+        path='conference/{websafeConferenceKey}/sessionsAt',
+        http_method='GET', name='getSessionsAt')
+    @captured
+    def getSessionsAt(self, request):
+        """Return the sessions of a conference in progress at a time
+            (YYYY-MM-DDTHH:MM, conference local time, like session times)
+            and up to limit sessions starting in the next window minutes.
+           Conferences don't record a timezone, so without a time the
+            current UTC time is used, shifted by utcOffset minutes: pass
+            the conference's offset from UTC to get its local now.
+        """
+
+        try:
+            at = (datetime.strptime(request.at, '%Y-%m-%dT%H:%M') if request.at
+                  else datetime.utcnow() + timedelta(minutes=request.utcOffset))
+            ndb.Key(urlsafe=request.websafeConferenceKey)
+        except Exception:
+            raise endpoints.BadRequestException(
+                'Expected a conference key and a time like 2016-03-01T14:30.')
+        limit = max(0, min(request.limit, MAX_SESSIONS_AT_LIMIT))
+
+        entries, starts, max_duration = self._getSchedule(
+            request.websafeConferenceKey)
+        in_progress, up_next = sessionsAt(
+            entries, starts, max_duration, at,
+            timedelta(minutes=max(0, request.window)), limit)
+
+        sessions = ndb.get_multi([ndb.Key(urlsafe=entry[2])
+                                  for entry in in_progress + up_next])
+        # a session deleted since the schedule was cached is left out
+        forms = [self._copySessionToForm(session) if session else None
+                 for session in sessions]
+        return SessionsAtForm(
+            inProgress=[form for form in forms[:len(in_progress)] if form],
+            upNext=[form for form in forms[len(in_progress):] if form])
 
 # - - - Get Featured Speaker - - - - - - - - - - - - - - -
 
     @staticmethod
-    def _checkFeaturedSpeaker(wsck, speaker):
-        """Check to see if a speaker is in more than one sessions in a conference"""
+    def _featuredSpeakerTask(conf_key):
+        """Return the coalesced featured speaker task for a conference"""
+        return taskutils.coalescedTask(
+            '/tasks/check_featured_speaker', 'featured', conf_key,
+            {'parent_wsck': conf_key.urlsafe()})
 
-        # get the session's parent conference
-        parent_conf = ndb.Key(urlsafe=wsck).get()
+    @staticmethod
+    def _checkFeaturedSpeaker(wsck):
+        """Feature the speaker with the most sessions in a conference,
+            if they speak at more than one.
+           Recounts every speaker in one projection query, so any number
+           of session creations merged into one task cost a single query.
+        """
 
-        # count of all sessions in this conference by the speaker
-        sessions_count = Session.query(
-            ancestor=parent_conf.key).filter(
-            Session.speaker == speaker).count()
+        # count all sessions in this conference by speaker
+        speakers = Counter(sess.speaker for sess in Session.query(
+            ancestor=ndb.Key(urlsafe=wsck)).fetch(projection=[Session.speaker]))
 
-        # update memcache if session count by speaker is greater than 1
-        if sessions_count > 1:
-            memcache.delete('featured_speaker')
-            memcache.add('featured_speaker', speaker)
+        # update memcache if session count by speaker is greater than 1;
+        #   the entity is what memcache is refilled from if evicted
+        if speakers:
+            speaker, sessions_count = speakers.most_common(1)[0]
+            if sessions_count > 1:
+                FeaturedSpeaker(id=FEATURED_SPEAKER_ID, speaker=speaker,
+                                parent_wsck=wsck).put()
+                singleflight.store(MEMCACHE_FEATURED_SPEAKER_KEY, speaker)
 
         return
 
+    @staticmethod
+    def _loadFeaturedSpeaker():
+        """Return the featured speaker stored in the datastore, or None"""
+        return getattr(ndb.Key(FeaturedSpeaker, FEATURED_SPEAKER_ID).get(),
+                       'speaker', None)
+
     @endpoints.method(
         message_types.VoidMessage, StringMessage,
         path='getFeaturedSpeaker', http_method='POST', name='getFeaturedSpeaker')
+    @captured
     def getFeaturedSpeaker(self, request):
         """Retrieve the featured speaker from memcache"""
 
         # get featured speaker from memcache
-        featured_speaker = memcache.get('featured_speaker')
+        featured_speaker = singleflight.get(
+            MEMCACHE_FEATURED_SPEAKER_KEY, ConferenceApi._loadFeaturedSpeaker,
+            refresh=('featuredSpeaker', []))
 
         # handle no featured speaker
         if not featured_speaker:
@@ -849,6 +2437,8 @@ class ConferenceApi(remote.Service):
         message_types.VoidMessage, SessionForm,
         path='getMostWishlistedSessions',
         http_method='GET', name='getMostWishlistedSessions')
+    @captured
+    @rateLimited(cost=20)
     def getMostWishlistedSessions(self, request):
         """Returns the most wishlisted session"""
 
@@ -871,6 +2461,8 @@ class ConferenceApi(remote.Service):
     @endpoints.method(
         message_types.VoidMessage, StringMessage,
         path='getBusiestSpeaker', http_method='GET', name='getBusiestSpeaker')
+    @captured
+    @rateLimited(cost=20)
     def getBusiestSpeaker(self, request):
         """Return the busiest speaker;
             one who speaks at the most sessions across all conferences
@@ -891,6 +2483,8 @@ class ConferenceApi(remote.Service):
     @endpoints.method(
         message_types.VoidMessage, SessionForms,
         path='doubleInequalityFilter', http_method='GET', name='doubleInequalityFilter')
+    @captured
+    @rateLimited(cost=10)
     def doubleInequalityFilter(self, request):
         """ Queries for non-workshop sessions before 7PM.
             Handling queries with multiple inequality filters.
@@ -917,6 +2511,275 @@ class ConferenceApi(remote.Service):
         return SessionForms(items=[self._copySessionToForm(sess)
                             for sess in matching_sessions])
 
+# - - - Batch - - - - - - - - - - - - - - - - - - - -
+
+    def _prefetchBatchEntities(self, requests):
+        """Fetch the caller's Profile and every entity named by a websafe
+            key in the decoded sub-requests, all in parallel.
+           The results land in ndb's request-scoped context cache, so the
+            sub-requests' own gets are served without further RPCs.
+        """
+        keys = set()
+        user = self._getCurrentUser()
+        if user:
+            keys.add(ndb.Key(Profile, getUserId(user)))
+        for request in requests:
+            for field in BATCH_KEY_FIELDS:
+                wsk = getattr(request, field, None)
+                if wsk:
+                    try:
+                        keys.add(ndb.Key(urlsafe=wsk))
+                    except Exception:
+                        # reported by the sub-request itself
+                        pass
+        ndb.Future.wait_all(ndb.get_multi_async(keys))
+
+    @endpoints.method(
+        BatchRequestForm, BatchResponseForm,
+        path='batch', http_method='POST', name='batch')
+    def batch(self, request):
+        """Run several ConferenceApi calls in one round trip.
+           Each item names a method and carries its JSON request body;
+            each result carries an HTTP-style status and a JSON body or error.
+        """
+
+        if len(request.items) > MAX_BATCH_ITEMS:
+            raise endpoints.BadRequestException(
+                'A batch can hold at most %d calls.' % MAX_BATCH_ITEMS)
+
+        # decode every sub-request up front
+        calls = []
+        for item in request.items:
+            method = getattr(self, item.method, None)
+            remote_info = getattr(method, 'remote', None)
+            if item.method == 'batch' or remote_info is None:
+                calls.append((item, None, None, 'Unknown method: %s' % item.method))
+                continue
+            try:
+                sub_request = protojson.decode_message(
+                    remote_info.request_type, item.body or '{}')
+            except Exception as e:
+                calls.append((item, None, None, 'Invalid request body: %s' % e))
+                continue
+            calls.append((item, method, sub_request, None))
+
+        self._prefetchBatchEntities(
+            [sub_request for _, _, sub_request, _ in calls if sub_request])
+
+        results = []
+        for item, method, sub_request, error in calls:
+            if error:
+                results.append(BatchResponseItem(id=item.id, status=400, error=error))
+                continue
+            try:
+                response = method(sub_request)
+                results.append(BatchResponseItem(
+                    id=item.id, status=200, body=protojson.encode_message(response)))
+            except endpoints.ServiceException as e:
+                results.append(BatchResponseItem(
+                    id=item.id, status=e.http_status, error=str(e)))
+            except Exception as e:
+                results.append(BatchResponseItem(
+                    id=item.id, status=500, error=str(e)))
+
+        return BatchResponseForm(items=results)
+
+# - - - Archive - - - - - - - - - - - - - - - - - - -
+
+    @staticmethod
+    def _queueArchival():
+        """Enqueue a task to archive each finished conference;
+            used by the archival cron job. Returns the number queued.
+        """
+        day = datetime.now().strftime('%Y%m%d')
+        tasks = [taskqueue.Task(url='/tasks/archive_conference',
+                                params={'wsck': conf_key.urlsafe()},
+                                name='archive-%s-%s' % (conf_key.urlsafe(), day))
+                 for conf_key in archive.archiveCandidates()]
+        return len(taskutils.addTasks('default', tasks))
+
+    @staticmethod
+    def _moveConference(wsck, to_archive=True):
+        """Move a conference into or out of the archive,
+            keeping facet counts and caches in step.
+        """
+        hot_key = archive.hotKey(ndb.Key(urlsafe=wsck))
+        source_key = hot_key if to_archive else archive.archivedKey(hot_key)
+        conf = source_key.get()
+        if not conf:
+            # already moved
+            return
+
+        archive.moveConference(hot_key, to_archive)
+
+        values = facets.facetValues(conf)
+        if to_archive:
+            facets.queueChange(values, None)
+        else:
+            facets.queueChange(None, values)
+            # a restored conference stays live until it is archived by hand
+            conf = hot_key.get()
+            conf.keepLive = True
+            conf.put()
+
+        wsck = hot_key.urlsafe()
+        ConferenceApi._bumpConferenceGeneration()
+        memcache.delete_multi([MEMCACHE_CONFERENCE_TPL % (wsck, conf.version),
+                               ConferenceApi._conferenceVersionKey(wsck),
+                               ConferenceApi._sessionsVersionKey(wsck)])
+        ical.invalidateConference(wsck)
+
+    @endpoints.method(
+        CONF_GET_REQUEST, BooleanMessage,
+        path='conference/{websafeConferenceKey}/restore',
+        http_method='POST', name='restoreConference')
+    @captured
+    def restoreConference(self, request):
+        """Bring an archived conference, its sessions and wishlist
+            items back into the live data. Organizer only.
+        """
+        user_id = getUserId(self._getCurrentUser())
+
+        conf_key = archive.archivedKey(ndb.Key(urlsafe=request.websafeConferenceKey))
+        conf = conf_key.get()
+        if not conf:
+            raise endpoints.NotFoundException(
+                'No archived conference found with key: %s'
+                % request.websafeConferenceKey)
+        if user_id != conf.organizerUserId:
+            raise endpoints.ForbiddenException(
+                'Only the owner can restore the conference.')
+
+        taskqueue.add(url='/tasks/restore_conference',
+                      params={'wsck': request.websafeConferenceKey})
+        return BooleanMessage(data=True)
+
+# - - - Clone - - - - - - - - - - - - - - - - - - - -
+
+    @staticmethod
+    def _copyCloneJobToForm(job):
+        """Copy a CloneJob to CloneJobForm"""
+        return CloneJobForm(websafeKey=job.key.urlsafe(),
+                            websafeConferenceKey=job.target,
+                            status=job.status,
+                            copied=job.copied,
+                            total=job.total)
+
+    @endpoints.method(
+        CLONE_POST_REQUEST, CloneJobForm,
+        path='conference/{websafeConferenceKey}/clone',
+        http_method='POST', name='cloneConference')
+    @captured
+    @rateLimited(cost=10)
+    def cloneConference(self, request):
+        """Copy a conference and all its sessions to a new conference,
+            moving their dates by offsetDays. Organizer only.
+           The sessions of a large agenda are copied in the background;
+            poll getCloneJob until its status is DONE.
+        """
+        user_id = getUserId(self._getCurrentUser())
+
+        source = self._getEntityByWebSafeKey(request.websafeConferenceKey)
+        if not isinstance(source, Conference):
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % request.websafeConferenceKey)
+        if user_id != source.organizerUserId:
+            raise endpoints.ForbiddenException(
+                'Only the owner can clone the conference.')
+
+        offset = timedelta(days=request.offsetDays)
+        data = source.to_dict(exclude=['monthBucket', 'updated', 'version',
+                                       'keepLive', 'seatsAvailable', 'sessions'])
+        for field in ('startDate', 'endDate'):
+            if data[field]:
+                data[field] += offset
+        data['month'] = data['startDate'].month if data['startDate'] else 0
+        data['seatsAvailable'] = data['maxAttendees']
+        if request.name:
+            data['name'] = request.name
+
+        p_key = ndb.Key(Profile, user_id)
+        c_id = Conference.allocate_ids(size=1, parent=p_key)[0]
+        conf = Conference(key=ndb.Key(Conference, c_id, parent=p_key), **data)
+        conf.put()
+        self._conferenceAdded(conf)
+
+        job = clone.startJob(source.key, conf.key, request.offsetDays)
+        stats.incr('clone.started')
+        return self._copyCloneJobToForm(job)
+
+    @endpoints.method(
+        CLONE_JOB_GET_REQUEST, CloneJobForm,
+        path='cloneJob/{websafeJobKey}', http_method='GET', name='getCloneJob')
+    def getCloneJob(self, request):
+        """Return the progress of a cloneConference call"""
+        user_id = getUserId(self._getCurrentUser())
+
+        job = self._getEntityByWebSafeKey(request.websafeJobKey)
+        if not isinstance(job, CloneJob):
+            raise endpoints.NotFoundException(
+                'No clone job found with key: %s' % request.websafeJobKey)
+        if ndb.Key(urlsafe=job.target).parent().id() != user_id:
+            raise endpoints.ForbiddenException(
+                'Only the owner can see the clone job.')
+        return self._copyCloneJobToForm(job)
+
+    @staticmethod
+    def _finishClone(job_key):
+        """Recompute what is derived from a clone's sessions, once,
+            after the last of them has been copied.
+           Speakers reach the typeahead index with its periodic rebuild.
+        """
+        job = job_key.get()
+        if not job or job.status != 'DONE':
+            return
+
+        wsck = job.target
+        conf_key = ndb.Key(urlsafe=wsck)
+        # room schedules built while the copy ran miss the later sessions;
+        #   drop them so the next booking rebuilds them from all sessions
+        room_keys = set(ConferenceApi._roomScheduleKey(conf_key, session.location)
+                        for session in Session.query(ancestor=conf_key).fetch(
+                            projection=[Session.location]))
+        ndb.delete_multi([key for key in room_keys if key])
+
+        ConferenceApi._bumpSessionsVersion(wsck)
+        ical.invalidateConference(wsck)
+        ConferenceApi._checkFeaturedSpeaker(wsck)
+        stats.incr('clone.finished')
+
+# - - - Typeahead - - - - - - - - - - - - - - - - - -
+
+    @endpoints.method(
+        TYPEAHEAD_REQUEST, TypeaheadForm,
+        path='typeahead/{field}', http_method='GET', name='getTypeahead')
+    def getTypeahead(self, request):
+        """Complete a prefix of a city, topic or speaker from the
+            in-instance index; most popular terms first
+        """
+        if request.field not in typeahead.FIELDS:
+            raise endpoints.BadRequestException(
+                'field must be one of: %s' % ', '.join(typeahead.FIELDS))
+        limit = max(1, min(request.limit, typeahead.TOP_K))
+        return TypeaheadForm(terms=typeahead.lookup(
+            request.field, request.prefix or '', limit))
+
+# - - - Monitoring - - - - - - - - - - - - - - - - - -
+
+    @endpoints.method(
+        message_types.VoidMessage, StringMessage,
+        path='getServiceStats', http_method='GET', name='getServiceStats')
+    def getServiceStats(self, request):
+        """Return the monitoring counters as a JSON object"""
+
+        counters = stats.getAll()
+        counters['queue.default.depth'] = taskutils.queueDepth()
+        counters['queryConferences.hitRatio'] = stats.ratio(
+            counters.get('queryConferences.hits', 0),
+            counters.get('queryConferences.misses', 0))
+
+        return StringMessage(data=json.dumps(counters, sort_keys=True))
+
 # - - - Playground - - - - - - - - - - - - - - - - - - -
     @endpoints.method(
         message_types.VoidMessage, ConferenceForms,
@@ -943,4 +2806,9 @@ class ConferenceApi(remote.Service):
         return ConferenceForms(items=[])
 
 
+# recomputes the singleflight refresh task can run
+singleflight.register('conference', ConferenceApi._loadConferenceVersion)
+singleflight.register('announcement', ConferenceApi._buildAnnouncement)
+singleflight.register('featuredSpeaker', ConferenceApi._loadFeaturedSpeaker)
+
 api = endpoints.api_server([ConferenceApi])
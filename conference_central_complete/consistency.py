@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+
+"""consistency.py
+
+Conference Central read consistency for get and list endpoints
+
+Gets and ancestor queries are strongly consistent by default: they wait
+for pending writes to their entity group to apply, and may not be served
+from caches that can lag the datastore. Anonymous browsing doesn't need
+that. An endpoint decorated with @readConsistency takes a `consistency`
+request field, STRONG or EVENTUAL, defaulting per endpoint to
+settings.READ_CONSISTENCY; readOptions() turns the call's mode into ndb
+options, and the endpoint decides which caches it may serve from.
+
+Reads that guard writes always stay strong and never take the
+decorator: seat and registration checks, wishlist duplicate checks
+(ConferenceApi._addWishlistItem) and room bookings all read inside
+transactions. Non-ancestor queries
+(queryConferences, getSessionsBySpeaker) are eventually consistent
+whatever the mode.
+
+"""
+
+import functools
+
+from google.appengine.ext import ndb
+
+from models import ReadConsistency
+from settings import READ_CONSISTENCY, READ_CONSISTENCY_DEFAULT
+
+
+def readConsistency(func):
+    """Decorator for ConferenceApi endpoint methods;
+        place it below @endpoints.method.
+    """
+    default = ReadConsistency(
+        READ_CONSISTENCY.get(func.__name__, READ_CONSISTENCY_DEFAULT))
+
+    @functools.wraps(func)
+    def wrapper(self, request):
+        # batch calls several endpoints on one service instance
+        previous = getattr(self, '_consistency', None)
+        self._consistency = getattr(request, 'consistency', None) or default
+        try:
+            return func(self, request)
+        finally:
+            self._consistency = previous
+    return wrapper
+
+
+def isEventual(api):
+    """Return True if the current call of a service may read eventually."""
+    return getattr(api, '_consistency', None) == ReadConsistency.EVENTUAL
+
+
+def readOptions(api):
+    """Return the ndb options for reads in the current call of a service."""
+    if isEventual(api):
+        return {'read_policy': ndb.EVENTUAL_CONSISTENCY}
+    return {}
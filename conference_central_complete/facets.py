@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+
+"""facets.py
+
+Conference Central sharded facet counters for the conference filters
+
+For every combination of equality filters on city, topics and month,
+and every value of another of those fields, a counter holds the number
+of conferences matching the filters with that value. Counters are
+sharded so that creating conferences with popular values doesn't
+serialize on one entity.
+
+A conference write queues one task with its facet values before and
+after (queueChange), in the write's transaction when there is one; the
+task applies the 8T+4 increments (T topics) off the request's path.
+Each change goes to shards picked from its id, which the shards
+remember, so a retried task doesn't count twice.
+
+A reconciliation job recounts the counters from scratch as a chain of
+tasks, like snapshot.py, each queued in the same transaction that
+records the job's progress:
+
+    COUNTING   each step counts one page of conferences into
+               FacetRecount entities, which record the step that last
+               added to them, so a retried step doesn't count twice
+    WRITING    each step stores one page of recounts in shard 0
+    PRUNING    each step zeroes the other shards of one page of
+               shards, and deletes shards of counters with no recount
+    CLEANING   each step deletes one page of recounts
+
+Increments that land while the recount runs may be lost; the next
+recount picks them up.
+
+"""
+
+import hashlib
+import itertools
+import json
+import random
+import uuid
+
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from models import Conference
+from models import FacetCounterShard
+from models import FacetReconcileJob
+from models import FacetRecount
+
+FACET_FIELDS = ('city', 'topics', 'month')
+NUM_SHARDS = 10
+APPLIED_KEPT = 50           # change ids remembered per shard
+RECONCILE_PAGE_SIZE = 100   # entities read per reconciliation step
+PUT_BATCH_SIZE = 500
+RECONCILE_PHASES = ('COUNTING', 'WRITING', 'PRUNING', 'CLEANING')
+# the queries of the later phases are eventually consistent; give them
+#   time to see the entities the previous phase wrote
+PHASE_DELAY = 60
+
+
+def facetValues(conf):
+    """Return a dict of facet field -> list of values for a Conference."""
+    return {'city': [conf.city] if conf.city else [],
+            'topics': list(set(conf.topics or [])),
+            'month': [conf.month] if conf.month else []}
+
+
+def groupId(constraints, field):
+    """Return the counter group for a set of (field, value) equality
+        constraints and the field being counted.
+    """
+    canonical = json.dumps([sorted(constraints), field])
+    return hashlib.md5(canonical.encode('utf-8')).hexdigest()
+
+
+def _counters(values):
+    """Yield (group, value) for every counter a conference contributes to."""
+    for field in FACET_FIELDS:
+        others = [other for other in FACET_FIELDS if other != field]
+        # each other field is either unconstrained or equal to one of its values
+        options = [[None] + [(other, v) for v in values[other]] for other in others]
+        for combination in itertools.product(*options):
+            constraints = [c for c in combination if c is not None]
+            group = groupId(constraints, field)
+            for value in values[field]:
+                yield group, unicode(value)
+
+
+def counterDeltas(before, after):
+    """Return {(group, value): delta} to move a conference from the
+        before facet values to the after ones; either may be None.
+    """
+    deltas = {}
+    for values, sign in ((before, -1), (after, 1)):
+        if values:
+            for counter in _counters(values):
+                deltas[counter] = deltas.get(counter, 0) + sign
+    return dict((counter, delta) for counter, delta in deltas.items() if delta)
+
+
+def _shardKey(group, value, shard):
+    """Return the key of one shard of a counter."""
+    return ndb.Key(FacetCounterShard, '%s|%s|%d' % (group, value, shard))
+
+
+def _shardFor(change_id, group, value):
+    """Return the shard a change goes to: random without a change id,
+        else fixed by it, so a retry finds the shard it already updated.
+    """
+    if not change_id:
+        return random.randint(0, NUM_SHARDS - 1)
+    digest = hashlib.md5(('%s|%s|%s' % (change_id, group, value)).encode('utf-8'))
+    return int(digest.hexdigest()[:8], 16) % NUM_SHARDS
+
+
+@ndb.transactional_tasklet
+def _incrShard(group, value, delta, change_id=None):
+    """Add delta to one shard of a counter, unless it has the change already."""
+    key = _shardKey(group, value, _shardFor(change_id, group, value))
+    shard = yield key.get_async()
+    if shard is None:
+        shard = FacetCounterShard(key=key, group=group, value=value)
+    if change_id:
+        if change_id in shard.applied:
+            return
+        shard.applied = (shard.applied + [change_id])[-APPLIED_KEPT:]
+    shard.count += delta
+    yield shard.put_async()
+
+
+def applyDeltas(deltas, change_id=None):
+    """Apply counter deltas, each to one shard, in parallel."""
+    ndb.Future.wait_all([_incrShard(group, value, delta, change_id)
+                         for (group, value), delta in deltas.items()])
+
+
+def queueChange(before, after):
+    """Queue a task moving a conference's counts from the before facet
+        values to the after ones; either may be None. Inside a
+        transaction, the task is only queued if it commits.
+    """
+    if not counterDeltas(before, after):
+        return
+    taskqueue.add(url='/tasks/apply_facet_change',
+                  params={'change': uuid.uuid4().hex,
+                          'before': json.dumps(before),
+                          'after': json.dumps(after)},
+                  transactional=ndb.in_transaction())
+
+
+def applyChange(change_id, before, after):
+    """Apply a change queued by queueChange."""
+    applyDeltas(counterDeltas(before, after), change_id)
+
+
+def getCounts(constraints, field):
+    """Return {value: count} for a field under equality constraints."""
+    counts = {}
+    for shard in FacetCounterShard.query(
+            FacetCounterShard.group == groupId(constraints, field)):
+        counts[shard.value] = counts.get(shard.value, 0) + shard.count
+    return dict((value, count) for value, count in counts.items() if count > 0)
+
+
+def startReconcile():
+    """Create a FacetReconcileJob and queue its first step."""
+    job = FacetReconcileJob()
+    _queueFirstStep(job)
+    return job
+
+
+@ndb.transactional()
+def _queueFirstStep(job):
+    job.put()
+    taskqueue.add(url='/tasks/reconcile_facets',
+                  params={'job': job.key.urlsafe(), 'step': 0},
+                  transactional=True)
+
+
+def _recountKey(job_id, group, value):
+    return ndb.Key(FacetRecount, '%d|%s|%s' % (job_id, group, value))
+
+
+def _phaseQuery(job):
+    """Return the query a phase of the job pages through."""
+    if job.status == 'COUNTING':
+        return Conference.query()
+    if job.status == 'PRUNING':
+        return FacetCounterShard.query()
+    return FacetRecount.query(FacetRecount.job == job.key.id())
+
+
+def reconcileStep(job_key, step):
+    """Run one step of a recount and queue the next.
+       Returns True if the step finished the job.
+    """
+    job = job_key.get()
+    if not job or job.status not in RECONCILE_PHASES or job.step != step:
+        # finished, or a duplicate of a step that already ran
+        return False
+
+    cursor = Cursor(urlsafe=job.cursor) if job.cursor else None
+    page, next_cursor, more = _phaseQuery(job).fetch_page(
+        RECONCILE_PAGE_SIZE, start_cursor=cursor)
+
+    job_id = job_key.id()
+    if job.status == 'COUNTING':
+        totals = {}
+        for conf in page:
+            for counter in _counters(facetValues(conf)):
+                totals[counter] = totals.get(counter, 0) + 1
+        _addRecounts(job_id, step, totals)
+    elif job.status == 'WRITING':
+        # the whole count goes in shard 0
+        _putBatches([FacetCounterShard(key=_shardKey(recount.group, recount.value, 0),
+                                       group=recount.group, value=recount.value,
+                                       count=recount.count)
+                     for recount in page])
+    elif job.status == 'PRUNING':
+        recounts = ndb.get_multi([_recountKey(job_id, shard.group, shard.value)
+                                  for shard in page])
+        to_put, to_delete = [], []
+        for shard, recount in zip(page, recounts):
+            if recount is None:
+                # no conference has this counter any more
+                to_delete.append(shard.key)
+            elif not shard.key.id().endswith('|0') and shard.count:
+                shard.count = 0
+                to_put.append(shard)
+        _putBatches(to_put)
+        ndb.delete_multi(to_delete)
+    else:
+        ndb.delete_multi([recount.key for recount in page])
+
+    return _advance(job_key, step,
+                    next_cursor.urlsafe() if more and next_cursor else None)
+
+
+def _putBatches(entities):
+    for start in range(0, len(entities), PUT_BATCH_SIZE):
+        ndb.put_multi(entities[start:start + PUT_BATCH_SIZE])
+
+
+def _addRecounts(job_id, step, totals):
+    """Add one step's counts to the job's FacetRecount entities,
+        skipping those a previous try of the step already added to.
+    """
+    counters = sorted(totals)
+    for start in range(0, len(counters), PUT_BATCH_SIZE):
+        chunk = counters[start:start + PUT_BATCH_SIZE]
+        keys = [_recountKey(job_id, group, value) for group, value in chunk]
+        entities = []
+        for (group, value), key, recount in zip(chunk, keys, ndb.get_multi(keys)):
+            recount = recount or FacetRecount(key=key, job=job_id,
+                                              group=group, value=value)
+            if recount.step >= step:
+                continue
+            recount.count += totals[(group, value)]
+            recount.step = step
+            entities.append(recount)
+        ndb.put_multi(entities)
+
+
+@ndb.transactional()
+def _advance(job_key, step, next_cursor):
+    """Record a finished step and queue the next one, atomically.
+       Returns True if the job is done.
+    """
+    job = job_key.get()
+    if job.step != step:
+        return False
+
+    job.cursor = next_cursor
+    job.step += 1
+    countdown = 0
+    if not next_cursor:
+        phase = RECONCILE_PHASES.index(job.status) + 1
+        job.status = RECONCILE_PHASES[phase] if phase < len(RECONCILE_PHASES) else 'DONE'
+        countdown = PHASE_DELAY
+    if job.status != 'DONE':
+        taskqueue.add(url='/tasks/reconcile_facets',
+                      params={'job': job_key.urlsafe(), 'step': job.step},
+                      countdown=countdown, transactional=True)
+    job.put()
+    return job.status == 'DONE'
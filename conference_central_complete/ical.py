@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+
+"""ical.py
+
+Conference Central iCalendar (.ics) feeds of conference sessions and of
+users' wishlisted sessions
+
+Calendar apps poll feeds every few minutes, so rendered feeds are kept
+in memcache (compressed) until a session, wishlist or conference write
+invalidates them; a poll of an unchanged feed costs no datastore reads.
+
+Feeds are cached under a version of their source that an invalidation
+increments, like the sessions cache: a render that read the sessions
+before a write stores the stale feed under the old version, where no
+poll after the write looks for it.
+
+"""
+
+import time
+import zlib
+from email.utils import formatdate
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from models import Profile
+from models import Session
+from models import SessionWishlistItem
+from schedule import sessionInterval
+import stats
+
+FEED_CACHE_TPL = 'ical:%s:%s:%s'
+FEED_VERSION_TPL = 'icalversion:%s:%s'
+FEED_TOKEN_CACHE_TPL = 'icaltoken:%s'
+FEED_CACHE_TTL = 24 * 60 * 60
+MAX_CACHED_BYTES = 1000000      # memcache's value size limit
+PRODID = '-//Conference Central//Sessions//EN'
+TIME_FORMAT = '%Y%m%dT%H%M%S'
+
+stats.register('ical.hits', 'ical.renders')
+
+
+def _escape(text):
+    """Escape a TEXT value as RFC 5545 requires."""
+    return (text.replace('\\', '\\\\').replace(';', '\\;')
+            .replace(',', '\\,').replace('\n', '\\n'))
+
+
+def _fold(line):
+    """Fold a content line into lines of at most 75 octets."""
+    encoded = line.encode('utf-8')
+    if len(encoded) <= 75:
+        return encoded + '\r\n'
+    parts = []
+    while encoded:
+        # never split inside a multi-byte character
+        cut = min(len(encoded), 75 if not parts else 74)
+        while cut < len(encoded) and (ord(encoded[cut]) & 0xC0) == 0x80:
+            cut -= 1
+        parts.append(encoded[:cut])
+        encoded = encoded[cut:]
+    return '\r\n '.join(parts) + '\r\n'
+
+
+def _renderChunks(name, sessions, host):
+    """Yield the feed a few lines at a time, sessions in start order."""
+    yield ''.join(_fold(line) for line in (
+        u'BEGIN:VCALENDAR', u'VERSION:2.0', u'PRODID:%s' % PRODID,
+        u'CALSCALE:GREGORIAN', u'X-WR-CALNAME:%s' % _escape(name)))
+
+    stamp = time.strftime(TIME_FORMAT + 'Z', time.gmtime())
+    timed = sorted(((interval, session) for interval, session in
+                    ((sessionInterval(session), session) for session in sessions)
+                    if interval), key=lambda pair: pair[0])
+    for (start, end), session in timed:
+        lines = [u'BEGIN:VEVENT',
+                 u'UID:%s@%s' % (session.key.urlsafe(), host),
+                 u'DTSTAMP:%s' % stamp,
+                 u'DTSTART:%s' % start.strftime(TIME_FORMAT),
+                 u'DTEND:%s' % end.strftime(TIME_FORMAT),
+                 u'SUMMARY:%s' % _escape(session.name)]
+        if session.location:
+            lines.append(u'LOCATION:%s' % _escape(session.location))
+        lines.append(u'DESCRIPTION:%s' % _escape(
+            u'%s (%s)' % (session.speaker, session.session_type)))
+        lines.append(u'END:VEVENT')
+        yield ''.join(_fold(line) for line in lines)
+
+    yield _fold(u'END:VCALENDAR')
+
+
+def _feedKey(kind, feed_id):
+    """Return the memcache key of the current version of a feed;
+        read it before loading the feed's sessions.
+    """
+    version_key = FEED_VERSION_TPL % (kind, feed_id)
+    version = memcache.get(version_key)
+    if version is None:
+        # seed from the clock so an evicted version is unlikely to be reused
+        memcache.add(version_key, int(time.time() * 1000))
+        version = memcache.get(version_key)
+    return FEED_CACHE_TPL % (kind, feed_id, version)
+
+
+def _invalidate(kind, feed_id):
+    """Increment a feed's version, so the next poll renders it again."""
+    memcache.incr(FEED_VERSION_TPL % (kind, feed_id),
+                  initial_value=int(time.time() * 1000))
+
+
+def conferenceFeedKey(wsck):
+    """Return the memcache key of a conference's feed."""
+    return _feedKey('conference', wsck)
+
+
+def userFeedKey(user_id):
+    """Return the memcache key of a user's wishlist feed."""
+    return _feedKey('user', user_id)
+
+
+def invalidateConference(wsck):
+    """Move a conference's feed to a new version; call after it or its
+        sessions change.
+    """
+    _invalidate('conference', wsck)
+
+
+def invalidateUser(user_id):
+    """Move a user's feed to a new version; call after their wishlist changes."""
+    _invalidate('user', user_id)
+
+
+def getCachedFeed(cache_key):
+    """Return (etag, last_modified, compressed body) or None."""
+    feed = memcache.get(cache_key)
+    if feed is not None:
+        stats.incr('ical.hits')
+    return feed
+
+
+def renderFeed(cache_key, name, sessions, host, out):
+    """Write a feed to out as it is rendered, then cache it.
+       Returns (etag, last_modified) of the feed.
+    """
+    stats.incr('ical.renders')
+    compressor = zlib.compressobj()
+    compressed = []
+    size = 0
+    for chunk in _renderChunks(name, sessions, host):
+        out.write(chunk)
+        compressed.append(compressor.compress(chunk))
+        size += len(chunk)
+    compressed.append(compressor.flush())
+    body = ''.join(compressed)
+
+    etag = '"%x-%x"' % (zlib.crc32(body) & 0xffffffff, size)
+    last_modified = formatdate(time.time(), usegmt=True)
+    if len(body) < MAX_CACHED_BYTES:
+        memcache.set(cache_key, (etag, last_modified, body), time=FEED_CACHE_TTL)
+    return etag, last_modified
+
+
+def decompress(body):
+    """Return the text of a cached feed body."""
+    return zlib.decompress(body)
+
+
+def conferenceSessions(wsck):
+    """Return the name and sessions of a conference, or (None, None)."""
+    conf_key = ndb.Key(urlsafe=wsck)
+    conf = conf_key.get()
+    if not conf:
+        return None, None
+    return conf.name, Session.query(ancestor=conf_key).fetch()
+
+
+def profileIdForToken(token):
+    """Return the id of the Profile owning a feed token, or None."""
+    cache_key = FEED_TOKEN_CACHE_TPL % token
+    profile_id = memcache.get(cache_key)
+    if profile_id is None:
+        profile_key = Profile.query(Profile.calendarToken == token).get(keys_only=True)
+        if not profile_key:
+            return None
+        profile_id = profile_key.id()
+        memcache.set(cache_key, profile_id)
+    return profile_id
+
+
+def wishlistSessions(profile_id):
+    """Return the sessions in a user's wishlist."""
+    items = SessionWishlistItem.query(ancestor=ndb.Key(Profile, profile_id)).fetch()
+    sessions = ndb.get_multi([ndb.Key(urlsafe=item.session_websafe_key)
+                              for item in items])
+    return [session for session in sessions if session is not None]
@@ -12,10 +12,23 @@ created by wesc on 2014 may 24
 
 __author__ = 'wesc+api@google.com (Wesley Chun)'
 
+import json
+
 import webapp2
-from google.appengine.api import app_identity
-from google.appengine.api import mail
+from google.appengine.api import taskqueue
+from google.appengine.api import users
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
 from conference import ConferenceApi
+from utils import getUserId
+import attendance
+import clone
+import ical
+import notifications
+import recommendations
+import singleflight
+import snapshot
+import typeahead
 
 
 class SetAnnouncementHandler(webapp2.RequestHandler):
@@ -25,12 +38,132 @@ class SetAnnouncementHandler(webapp2.RequestHandler):
         self.response.set_status(204)
 
 
+class ReconcileFacetsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Start a recount of the conference facet counters."""
+        ConferenceApi._reconcileFacets()
+        self.response.set_status(204)
+
+
+class ReconcileFacetsStepHandler(webapp2.RequestHandler):
+    def post(self):
+        """Run one step of a facet recount and queue the next."""
+        ConferenceApi._reconcileFacetsStep(
+            ndb.Key(urlsafe=self.request.get('job')),
+            int(self.request.get('step')))
+        self.response.set_status(204)
+
+
+class ApplyFacetChangeHandler(webapp2.RequestHandler):
+    def post(self):
+        """Move a conference's facet counts to its new values."""
+        ConferenceApi._applyFacetChange(
+            self.request.get('change'),
+            json.loads(self.request.get('before')),
+            json.loads(self.request.get('after')))
+        self.response.set_status(204)
+
+
+class BuildRecommendationsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Start a rebuild of the co-wishlist session recommendations."""
+        recommendations.startRebuild()
+        self.response.set_status(204)
+
+
+class BuildRecommendationsStepHandler(webapp2.RequestHandler):
+    def post(self):
+        """Run one step of a recommendations rebuild and queue the next."""
+        recommendations.rebuildStep(ndb.Key(urlsafe=self.request.get('job')),
+                                    int(self.request.get('step')))
+        self.response.set_status(204)
+
+
+class ArchiveConferencesHandler(webapp2.RequestHandler):
+    def get(self):
+        """Queue the archival of conferences that have ended."""
+        ConferenceApi._queueArchival()
+        self.response.set_status(204)
+
+
+class ArchiveConferenceHandler(webapp2.RequestHandler):
+    def post(self):
+        """Move a conference and its entities into the archive."""
+        ConferenceApi._moveConference(self.request.get('wsck'))
+        self.response.set_status(204)
+
+
+class RestoreConferenceHandler(webapp2.RequestHandler):
+    def post(self):
+        """Move a conference and its entities back out of the archive."""
+        ConferenceApi._moveConference(self.request.get('wsck'), to_archive=False)
+        self.response.set_status(204)
+
+
+class RebuildTypeaheadHandler(webapp2.RequestHandler):
+    def get(self):
+        """Rebuild the typeahead snapshots from the datastore."""
+        typeahead.rebuild()
+        self.response.set_status(204)
+
+
+class StartSnapshotHandler(webapp2.RequestHandler):
+    def get(self):
+        """Start a snapshot export; incremental unless full=1 is passed."""
+        snapshot.startJob(full=self.request.get('full') == '1')
+        self.response.set_status(204)
+
+
+class ExportSnapshotHandler(webapp2.RequestHandler):
+    def post(self):
+        """Export one page of a snapshot and queue the next."""
+        snapshot.exportStep(ndb.Key(urlsafe=self.request.get('job')),
+                            int(self.request.get('step')))
+        self.response.set_status(204)
+
+
+class CloneConferenceHandler(webapp2.RequestHandler):
+    def post(self):
+        """Copy one page of a clone's sessions and queue the next."""
+        clone.cloneStep(ndb.Key(urlsafe=self.request.get('job')),
+                        int(self.request.get('step')))
+        self.response.set_status(204)
+
+
+class FinishCloneHandler(webapp2.RequestHandler):
+    def post(self):
+        """Recompute the derived data of a finished clone."""
+        ConferenceApi._finishClone(ndb.Key(urlsafe=self.request.get('job')))
+        self.response.set_status(204)
+
+
+class UpdateRecommendationsHandler(webapp2.RequestHandler):
+    def post(self):
+        """Add a newly wishlisted session to the recommendations."""
+        recommendations.addToIndex(
+            ndb.Key(urlsafe=self.request.get('user')),
+            self.request.get('session'),
+            self.request.get('item') or None)
+        self.response.set_status(204)
+
+
+class RefreshCacheHandler(webapp2.RequestHandler):
+    def post(self):
+        """Refresh a singleflight value due for refresh."""
+        singleflight.refreshStep(
+            self.request.get('key'),
+            self.request.get('name'),
+            json.loads(self.request.get('args')),
+            int(self.request.get('ttl')),
+            int(self.request.get('soft_ttl')))
+        self.response.set_status(204)
+
+
 class SendConfirmationEmailHandler(webapp2.RequestHandler):
     def post(self):
         """Send email confirming Conference creation."""
-        mail.send_mail(
-            'noreply@%s.appspotmail.com' % (
-                app_identity.get_application_id()),     # from
+        notifications.getMailSender().send(
+            notifications.senderAddress(),              # from
             self.request.get('email'),                  # to
             'You created a new Conference!',            # subj
             'Hi, you have created a following '         # body
@@ -41,19 +174,225 @@ class SendConfirmationEmailHandler(webapp2.RequestHandler):
 
 class FeaturedSpeakerHandler(webapp2.RequestHandler):
     def post(self):
-        """Updates featured speaker after a session is created"""
+        """Updates featured speaker after sessions are created"""
 
         # get parent_wsck from taskqueue
         parent_wsck = self.request.get('parent_wsck')
-        speaker = self.request.get('speaker')
 
-        # use parent wsck to check featured speaker
-        ConferenceApi._checkFeaturedSpeaker(parent_wsck, speaker)
+        # use parent wsck to recount the conference's speakers
+        ConferenceApi._checkFeaturedSpeaker(parent_wsck)
+        self.response.set_status(204)
+
+
+class ReleaseRoomSlotsHandler(webapp2.RequestHandler):
+    def post(self):
+        """Release the room slots of sessions a booking never saved"""
+        ConferenceApi._releaseRoomSlots(
+            ndb.Key(urlsafe=self.request.get('room')),
+            [ndb.Key(urlsafe=wssk) for wssk in self.request.get_all('session')]
+        ).get_result()
+        self.response.set_status(204)
+
+
+class MigrateSessionDetailsHandler(webapp2.RequestHandler):
+    def post(self):
+        """Move one page of session highlights into SessionDetail,
+            then queue the next page.
+        """
+        cursor = self.request.get('cursor')
+        next_cursor = ConferenceApi._migrateSessionDetails(
+            Cursor(urlsafe=cursor) if cursor else None)
+        if next_cursor:
+            taskqueue.add(url='/tasks/migrate_session_details',
+                          params={'cursor': next_cursor.urlsafe()})
+        self.response.set_status(204)
+
+
+class BackfillMonthBucketsHandler(webapp2.RequestHandler):
+    def post(self):
+        """Index monthBucket for one page of conferences,
+            then queue the next page.
+        """
+        cursor = self.request.get('cursor')
+        next_cursor = ConferenceApi._backfillMonthBuckets(
+            Cursor(urlsafe=cursor) if cursor else None)
+        if next_cursor:
+            taskqueue.add(url='/tasks/backfill_month_buckets',
+                          params={'cursor': next_cursor.urlsafe()})
+        self.response.set_status(204)
+
+
+class UpdateAttendeeSizeHandler(webapp2.RequestHandler):
+    def post(self):
+        """Move an attendee to their new t-shirt size in conference stats"""
+        ConferenceApi._changeAttendeeSize(
+            self.request.get_all('wsck'),
+            self.request.get('profile') or None,
+            self.request.get('change') or None,
+            self.request.get('old_size'),
+            self.request.get('new_size'))
+        self.response.set_status(204)
+
+
+class ExportAttendeesHandler(webapp2.RequestHandler):
+    def _organizerKey(self, wskey, kind):
+        """Return the key for wskey if it is a kind entity under a
+            conference the signed-in user organizes, else abort.
+        """
+        try:
+            key = ndb.Key(urlsafe=wskey)
+        except Exception:
+            self.abort(404)
+        if key.kind() != kind:
+            self.abort(404)
+        conf_key = key if kind == 'Conference' else key.parent()
+        conf = conf_key.get() if conf_key else None
+        user = users.get_current_user()
+        if not conf or not user or getUserId(user) != conf.organizerUserId:
+            self.abort(403)
+        return key
+
+    def writeJob(self, job):
+        """Write an export's progress, and its files once done, as JSON."""
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.out.write(json.dumps({
+            'job': job.key.urlsafe(),
+            'status': job.status,
+            'rows': job.rows,
+            'files': attendance.chunkNames(job) if job.status == 'DONE' else [],
+        }))
+
+    def post(self):
+        """Start exporting a conference's attendees as CSV or NDJSON
+            files, one page of profiles per task; organizer only.
+        """
+        conf_key = self._organizerKey(self.request.get('wsck'), 'Conference')
+        fmt = self.request.get('format', 'csv')
+        if fmt not in attendance.EXPORT_FORMATS:
+            self.abort(400)
+        self.response.set_status(202)
+        self.writeJob(attendance.startExport(conf_key, fmt))
+
+    def get(self):
+        """Return the progress of an export, and its files once done."""
+        job_key = self._organizerKey(self.request.get('job'), 'AttendeeExportJob')
+        self.writeJob(job_key.get())
+
+
+class ExportAttendeesStepHandler(webapp2.RequestHandler):
+    def post(self):
+        """Export one page of attendees and queue the next."""
+        attendance.exportStep(ndb.Key(urlsafe=self.request.get('job')),
+                              int(self.request.get('step')))
+        self.response.set_status(204)
+
+
+class BackfillAttendeeStatsHandler(webapp2.RequestHandler):
+    def post(self):
+        """Count one page of a conference's attendees into its stats."""
+        attendance.backfillStep(ndb.Key(urlsafe=self.request.get('conf')),
+                                int(self.request.get('step')))
+        self.response.set_status(204)
+
+
+class CalendarFeedHandler(webapp2.RequestHandler):
+    def serveFeed(self, cache_key, load):
+        """Serve a feed from memcache, answering conditional requests with
+            304, or render it from load() -> (name, sessions) and cache it.
+        """
+        self.response.headers['Content-Type'] = 'text/calendar; charset=utf-8'
+        self.response.headers['Cache-Control'] = 'private, max-age=300'
+
+        feed = ical.getCachedFeed(cache_key)
+        if feed:
+            etag, last_modified, body = feed
+            self.response.headers['ETag'] = etag
+            self.response.headers['Last-Modified'] = last_modified
+            if (self.request.headers.get('If-None-Match') == etag or
+                    self.request.headers.get('If-Modified-Since') == last_modified):
+                self.response.set_status(304)
+                return
+            self.response.out.write(ical.decompress(body))
+            return
+
+        name, sessions = load()
+        if name is None:
+            self.abort(404)
+        etag, last_modified = ical.renderFeed(
+            cache_key, name, sessions, self.request.host, self.response.out)
+        self.response.headers['ETag'] = etag
+        self.response.headers['Last-Modified'] = last_modified
+
+
+class ConferenceFeedHandler(CalendarFeedHandler):
+    def get(self, wsck):
+        """Serve the calendar feed of a conference's sessions."""
+        def load():
+            try:
+                return ical.conferenceSessions(wsck)
+            except Exception:
+                return None, None
+        self.serveFeed(ical.conferenceFeedKey(wsck), load)
+
+
+class UserFeedHandler(CalendarFeedHandler):
+    def get(self, token):
+        """Serve the calendar feed of a user's wishlisted sessions."""
+        profile_id = ical.profileIdForToken(token)
+        if not profile_id:
+            self.abort(404)
+        self.serveFeed(ical.userFeedKey(profile_id),
+                       lambda: ('My sessions', ical.wishlistSessions(profile_id)))
+
+
+class NotifyAttendeesHandler(webapp2.RequestHandler):
+    def post(self):
+        """Queue notification mail for one page of a conference's attendees"""
+        cursor = self.request.get('cursor')
+        notifications.fanOutPage(
+            ndb.Key(urlsafe=self.request.get('job')),
+            int(self.request.get('page', 0)),
+            Cursor(urlsafe=cursor) if cursor else None)
+        self.response.set_status(204)
+
+
+class SendNotificationHandler(webapp2.RequestHandler):
+    def post(self):
+        """Send one chunk of a conference change notification"""
+        notifications.sendChunk(
+            ndb.Key(urlsafe=self.request.get('job')),
+            self.request.get_all('profile'))
         self.response.set_status(204)
 
 
 app = webapp2.WSGIApplication([
     ('/crons/set_announcement', SetAnnouncementHandler),
+    ('/crons/reconcile_facets', ReconcileFacetsHandler),
+    ('/crons/build_recommendations', BuildRecommendationsHandler),
+    ('/crons/archive_conferences', ArchiveConferencesHandler),
+    ('/crons/start_snapshot', StartSnapshotHandler),
+    ('/crons/rebuild_typeahead', RebuildTypeaheadHandler),
+    ('/tasks/export_snapshot', ExportSnapshotHandler),
+    ('/tasks/reconcile_facets', ReconcileFacetsStepHandler),
+    ('/tasks/apply_facet_change', ApplyFacetChangeHandler),
+    ('/tasks/build_recommendations', BuildRecommendationsStepHandler),
+    ('/tasks/clone_conference', CloneConferenceHandler),
+    ('/tasks/finish_clone', FinishCloneHandler),
+    ('/tasks/archive_conference', ArchiveConferenceHandler),
+    ('/tasks/restore_conference', RestoreConferenceHandler),
     ('/tasks/send_confirmation_email', SendConfirmationEmailHandler),
-    ('/tasks/check_featured_speaker', FeaturedSpeakerHandler)
+    ('/tasks/refresh_cache', RefreshCacheHandler),
+    ('/tasks/check_featured_speaker', FeaturedSpeakerHandler),
+    ('/tasks/release_room_slots', ReleaseRoomSlotsHandler),
+    ('/tasks/migrate_session_details', MigrateSessionDetailsHandler),
+    ('/tasks/backfill_month_buckets', BackfillMonthBucketsHandler),
+    ('/tasks/update_attendee_size', UpdateAttendeeSizeHandler),
+    ('/tasks/backfill_attendee_stats', BackfillAttendeeStatsHandler),
+    ('/tasks/export_attendees', ExportAttendeesStepHandler),
+    ('/tasks/update_recommendations', UpdateRecommendationsHandler),
+    ('/tasks/notify_attendees', NotifyAttendeesHandler),
+    ('/tasks/send_notification', SendNotificationHandler),
+    ('/exports/attendees', ExportAttendeesHandler),
+    (r'/feeds/conference/([\w-]+)\.ics', ConferenceFeedHandler),
+    (r'/feeds/user/(\w+)\.ics', UserFeedHandler)
 ], debug=True)
@@ -23,12 +23,23 @@ class ConflictException(endpoints.ServiceException):
     http_status = httplib.CONFLICT
 
 
+class RateLimitExceededException(endpoints.ServiceException):
+    """RateLimitExceededException -- exception mapped to HTTP 503 response.
+        Endpoints turns a 429 into a 404, so throttled calls get the
+        status Google API clients already retry with backoff.
+    """
+    http_status = httplib.SERVICE_UNAVAILABLE
+
+
 class Profile(ndb.Model):
     """Profile -- User profile object"""
     displayName = ndb.StringProperty()
     mainEmail = ndb.StringProperty()
     teeShirtSize = ndb.StringProperty(default='NOT_SPECIFIED')
     conferenceKeysToAttend = ndb.StringProperty(repeated=True)
+    # secret part of the user's calendar feed URL
+    calendarToken = ndb.StringProperty()
+    updated = ndb.DateTimeProperty(auto_now=True)
 
 
 class ProfileMiniForm(messages.Message):
@@ -64,11 +75,24 @@ class TeeShirtSize(messages.Enum):
     XXXL_W = 15
 
 
+class ReadConsistency(messages.Enum):
+    """ReadConsistency -- consistency of an endpoint's reads"""
+    STRONG = 1
+    EVENTUAL = 2
+
+
 class StringMessage(messages.Message):
     """StringMessage-- outbound (single) string message"""
     data = messages.StringField(1, required=True)
 
 
+class AnnouncementMessage(messages.Message):
+    """AnnouncementMessage-- outbound announcement with its ETag"""
+    data = messages.StringField(1)
+    etag = messages.StringField(2)
+    notModified = messages.BooleanField(3)
+
+
 class BooleanMessage(messages.Message):
     """BooleanMessage-- outbound Boolean value message"""
     data = messages.BooleanField(1)
@@ -82,11 +106,121 @@ class Conference(ndb.Model):
     topics = ndb.StringProperty(repeated=True)
     city = ndb.StringProperty()
     startDate = ndb.DateProperty()
-    month = ndb.IntegerProperty()  # TODO: do we need for indexing like Java?
+    month = ndb.IntegerProperty()  # month of year, for the MONTH filter
+    # YYYYMM of startDate; partitions date range queries by month
+    monthBucket = ndb.ComputedProperty(
+        lambda self: self.startDate.year * 100 + self.startDate.month
+        if self.startDate else None)
     endDate = ndb.DateProperty()
     maxAttendees = ndb.IntegerProperty()
     seatsAvailable = ndb.IntegerProperty()
     sessions = ndb.StringProperty(repeated=True)
+    version = ndb.IntegerProperty(default=0, indexed=False)
+    # set when restored from the archive, so it isn't archived again
+    keepLive = ndb.BooleanProperty(default=False, indexed=False)
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+
+class ConferenceAttendeeStats(ndb.Model):
+    """ConferenceAttendeeStats -- attendee aggregates kept up to date on
+        registration and profile changes. Ancestor: Conference entity
+    """
+    attendees = ndb.IntegerProperty(default=0, indexed=False)
+    # teeShirtSize name -> number of attendees
+    sizeCounts = ndb.JsonProperty(default={})
+    # 'YYYY-MM-DD' -> registrations less cancellations that day
+    dailyRegistrations = ndb.JsonProperty(default={})
+    # ids of the latest t-shirt size changes applied, so a retried
+    #   task doesn't apply one twice
+    appliedChanges = ndb.JsonProperty(default=[])
+    # None until the attendees from before the stats are counted,
+    #   then RUNNING and DONE (attendance.py)
+    backfill = ndb.StringProperty(indexed=False)
+
+
+class AttendeeStatsBackfill(ndb.Model):
+    """AttendeeStatsBackfill -- progress of counting a conference's
+        attendees into its stats (attendance.py). Ancestor: Conference entity
+    """
+    status = ndb.StringProperty(default='RUNNING', indexed=False)
+    cursor = ndb.StringProperty(indexed=False)
+    step = ndb.IntegerProperty(default=0, indexed=False)
+    # id of the last Profile counted; profiles are paged in key order
+    lastProfile = ndb.StringProperty(indexed=False)
+    attendees = ndb.IntegerProperty(default=0, indexed=False)
+    sizeCounts = ndb.JsonProperty(default={})
+
+
+class AttendeeExportJob(ndb.Model):
+    """AttendeeExportJob -- progress of one attendee export task chain
+        (attendance.py). Ancestor: Conference entity
+    """
+    format = ndb.StringProperty(indexed=False)
+    prefix = ndb.StringProperty(indexed=False)
+    started = ndb.DateTimeProperty(indexed=False)
+    status = ndb.StringProperty(default='RUNNING', indexed=False)
+    cursor = ndb.StringProperty(indexed=False)
+    step = ndb.IntegerProperty(default=0, indexed=False)
+    chunks = ndb.IntegerProperty(default=0, indexed=False)
+    rows = ndb.IntegerProperty(default=0, indexed=False)
+
+
+class NotificationJob(ndb.Model):
+    """NotificationJob -- fan-out of a conference change to its attendees.
+        Ancestor: Conference entity
+    """
+    subject = ndb.StringProperty(indexed=False)
+    body = ndb.TextProperty()
+    status = ndb.StringProperty(default='PENDING')
+    pagesQueued = ndb.IntegerProperty(default=0)
+    recipientsQueued = ndb.IntegerProperty(default=0)
+    sent = ndb.IntegerProperty(default=0)
+    skipped = ndb.IntegerProperty(default=0)
+    failed = ndb.IntegerProperty(default=0)  # failed attempts; chunks are retried
+    created = ndb.DateTimeProperty(auto_now_add=True)
+
+
+class SnapshotJob(ndb.Model):
+    """SnapshotJob -- progress of one snapshot export task chain"""
+    started = ndb.DateTimeProperty()
+    # incremental jobs export entities updated since this time
+    since = ndb.DateTimeProperty(indexed=False)
+    prefix = ndb.StringProperty(indexed=False)
+    status = ndb.StringProperty(default='RUNNING')
+    kindIndex = ndb.IntegerProperty(default=0, indexed=False)
+    cursor = ndb.StringProperty(indexed=False)
+    chunk = ndb.IntegerProperty(default=0, indexed=False)
+    step = ndb.IntegerProperty(default=0, indexed=False)
+    rows = ndb.JsonProperty(default={})
+    chunks = ndb.JsonProperty(default={})
+
+
+class CloneJob(ndb.Model):
+    """CloneJob -- progress of copying a conference's sessions
+        into its clone (clone.py)
+    """
+    source = ndb.StringProperty(indexed=False)  # websafe conference keys
+    target = ndb.StringProperty(indexed=False)
+    offsetDays = ndb.IntegerProperty(default=0, indexed=False)
+    status = ndb.StringProperty(default='RUNNING')
+    cursor = ndb.StringProperty(indexed=False)
+    step = ndb.IntegerProperty(default=0, indexed=False)
+    copied = ndb.IntegerProperty(default=0, indexed=False)
+    total = ndb.IntegerProperty(default=0, indexed=False)
+    created = ndb.DateTimeProperty(auto_now_add=True)
+
+
+class TypeaheadSnapshot(ndb.Model):
+    """TypeaheadSnapshot -- the completion terms of one field with their
+        weights, as stored by typeahead.PrefixIndex.dump(). Id: field name
+    """
+    data = ndb.BlobProperty()
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+
+class TypeaheadForm(messages.Message):
+    """TypeaheadForm -- completions for a prefix, most popular first"""
+    terms = messages.StringField(1, repeated=True)
 
 
 class ConferenceForm(messages.Message):
@@ -103,16 +237,88 @@ class ConferenceForm(messages.Message):
     endDate = messages.StringField(10)  # DateTimeField()
     websafeKey = messages.StringField(11)
     organizerDisplayName = messages.StringField(12)
+    etag = messages.StringField(13)
+    notModified = messages.BooleanField(14)
+    archived = messages.BooleanField(15)
 
 
 class GetConferenceForm(messages.Message):
     """For retrieving a Conference, given a websafe key"""
     websafeKey = messages.StringField(1, required=True)
+    ifNoneMatch = messages.StringField(2)
+    includeArchived = messages.BooleanField(3, default=False)
+    consistency = messages.EnumField('ReadConsistency', 4)
 
 
 class ConferenceForms(messages.Message):
     """ConferenceForms -- multiple Conference outbound form message"""
     items = messages.MessageField(ConferenceForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
+
+
+class CloneConferenceForm(messages.Message):
+    """CloneConferenceForm -- inbound form to clone a conference;
+        dates move by offsetDays, and the name is kept unless given
+    """
+    offsetDays = messages.IntegerField(1, required=True)
+    name = messages.StringField(2)
+
+
+class CloneJobForm(messages.Message):
+    """CloneJobForm -- outbound progress of a conference clone;
+        status is RUNNING or DONE
+    """
+    websafeKey = messages.StringField(1)
+    websafeConferenceKey = messages.StringField(2)
+    status = messages.StringField(3)
+    copied = messages.IntegerField(4)
+    total = messages.IntegerField(5)
+
+
+class FacetCounterShard(ndb.Model):
+    """FacetCounterShard -- one shard of a conference facet counter.
+        group identifies the applied filters plus the faceted field.
+    """
+    group = ndb.StringProperty()
+    value = ndb.StringProperty(indexed=False)
+    count = ndb.IntegerProperty(default=0, indexed=False)
+    # ids of the latest changes applied to the shard, so a retried
+    #   task doesn't apply one twice
+    applied = ndb.JsonProperty(default=[])
+
+
+class FacetReconcileJob(ndb.Model):
+    """FacetReconcileJob -- progress of one facet recount task chain
+        (facets.py)
+    """
+    status = ndb.StringProperty(default='COUNTING')
+    cursor = ndb.StringProperty(indexed=False)
+    step = ndb.IntegerProperty(default=0, indexed=False)
+    started = ndb.DateTimeProperty(auto_now_add=True)
+
+
+class FacetRecount(ndb.Model):
+    """FacetRecount -- the recounted total of one facet counter while a
+        FacetReconcileJob runs. Key name: job id|group|value
+    """
+    job = ndb.IntegerProperty()
+    group = ndb.StringProperty(indexed=False)
+    value = ndb.StringProperty(indexed=False)
+    count = ndb.IntegerProperty(default=0, indexed=False)
+    # step of the job that last added to the count
+    step = ndb.IntegerProperty(default=-1, indexed=False)
+
+
+class FacetCountForm(messages.Message):
+    """FacetCountForm -- number of conferences with one field value"""
+    field = messages.StringField(1)
+    value = messages.StringField(2)
+    count = messages.IntegerField(3)
+
+
+class FacetCountForms(messages.Message):
+    """FacetCountForms -- facet counts outbound form message"""
+    items = messages.MessageField(FacetCountForm, 1, repeated=True)
 
 
 class ConferenceQueryForm(messages.Message):
@@ -133,6 +339,7 @@ class ConferenceQueryForms(messages.Message):
 class Session(ndb.Model):
     """Session -- sessions within a conference."""
     name = ndb.StringProperty(required=True)
+    # only sessions created before SessionDetail existed still use this
     highlights = ndb.TextProperty()
     speaker = ndb.StringProperty(required=True)
     date = ndb.DateProperty()
@@ -140,6 +347,15 @@ class Session(ndb.Model):
     duration = ndb.IntegerProperty()
     session_type = ndb.StringProperty(required=True)
     location = ndb.StringProperty()
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+
+class SessionDetail(ndb.Model):
+    """SessionDetail -- the large fields of a session, kept out of the
+        Session entity so lists of sessions stay small to read.
+        Ancestor: Session entity
+    """
+    highlights = ndb.TextProperty()
 
 
 class SessionForm(messages.Message):
@@ -153,16 +369,53 @@ class SessionForm(messages.Message):
     session_type = messages.StringField(7, required=True)
     location = messages.StringField(8)
     websafe_key = messages.StringField(9)
+    conflicts = messages.StringField(10, repeated=True)
 
 
 class SessionForms(messages.Message):
     """Multiple SessionForm inbound form message"""
     items = messages.MessageField(SessionForm, 1, repeated=True)
+    etag = messages.StringField(2)
+    notModified = messages.BooleanField(3)
+
+
+class SessionResultForm(messages.Message):
+    """SessionResultForm -- outcome of one session in a batch create;
+        status is CREATED, CONFLICT or FAILED
+    """
+    session = messages.MessageField(SessionForm, 1)
+    status = messages.StringField(2)
+
+
+class SessionResultForms(messages.Message):
+    """SessionResultForms -- outcome of a batch create, in request order"""
+    items = messages.MessageField(SessionResultForm, 1, repeated=True)
+    created = messages.IntegerField(2)
+
+
+class RoomSchedule(ndb.Model):
+    """RoomSchedule -- the sessions booked in one room of a conference,
+        as [start, end, websafe session key] slots sorted by start, with
+        times formatted as YYYY-MM-DDTHH:MM. Root entity, one per
+        conference and room, so each room is booked in its own entity
+        group (see ConferenceApi._bookRoom).
+    """
+    location = ndb.StringProperty(indexed=False)
+    slots = ndb.JsonProperty(default=[])
+    maxDuration = ndb.IntegerProperty(default=0, indexed=False)  # minutes
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+
+class SessionsAtForm(messages.Message):
+    """Sessions in progress at a time, and the ones starting next"""
+    inProgress = messages.MessageField(SessionForm, 1, repeated=True)
+    upNext = messages.MessageField(SessionForm, 2, repeated=True)
 
 
 class SessionByTypeQueryForm(messages.Message):
     """Outbound message - Used by getConferenceSessionsByType."""
     session_type = messages.StringField(1)
+    consistency = messages.EnumField('ReadConsistency', 2)
 
 
 class SessionBySpeakerQueryForm(messages.Message):
@@ -170,12 +423,58 @@ class SessionBySpeakerQueryForm(messages.Message):
     speaker = messages.StringField(1)
 
 
+class FeaturedSpeaker(ndb.Model):
+    """FeaturedSpeaker -- the current featured speaker; a single entity
+        that memcache is refilled from when the cached value is lost.
+    """
+    speaker = ndb.StringProperty(indexed=False)
+    parent_wsck = ndb.StringProperty(indexed=False)
+
+
 class SessionWishlistItem(ndb.Model):
     """This represents a wishlist item. Ancestor: Profile entity"""
     session_websafe_key = ndb.StringProperty()
     # the parent conference entity of the session;
     #    used for comparison in getSessionsInWishlist
     parent_wsck = ndb.StringProperty()
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+
+class SessionNeighbors(ndb.Model):
+    """SessionNeighbors -- sessions most often wishlisted together with
+        one session. Key name: the session's websafe key
+    """
+    # [[session websafe key, number of users who wishlisted both], ...]
+    neighbors = ndb.JsonProperty(default=[])
+    # websafe keys of the latest wishlist items counted in since the
+    #   last rebuild, so a retried update task doesn't count one twice
+    recentItems = ndb.JsonProperty(default=[])
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+
+class RecommendationJob(ndb.Model):
+    """RecommendationJob -- progress of one recommendations rebuild
+        task chain (recommendations.py)
+    """
+    status = ndb.StringProperty(default='COUNTING')
+    cursor = ndb.StringProperty(indexed=False)
+    step = ndb.IntegerProperty(default=0, indexed=False)
+    # the last user of the previous page, whose items may continue
+    carryUser = ndb.StringProperty(indexed=False)
+    carry = ndb.JsonProperty(default=[])
+    items = ndb.IntegerProperty(default=0, indexed=False)
+    sessions = ndb.IntegerProperty(default=0, indexed=False)
+    started = ndb.DateTimeProperty(auto_now_add=True)
+
+
+class NeighborCounts(ndb.Model):
+    """NeighborCounts -- co-wishlist counts of one session while a
+        RecommendationJob is counting. Key name: job id:session websafe key
+    """
+    job = ndb.IntegerProperty()
+    # step of the job that last added to the counts
+    step = ndb.IntegerProperty(default=-1, indexed=False)
+    counts = ndb.JsonProperty(default={}, compressed=True)
 
 
 class SessionWishlistItemForm(messages.Message):
@@ -186,3 +485,90 @@ class SessionWishlistItemForm(messages.Message):
 class SessionWishlistQueryForm(messages.Message):
     """For querying all sessions in a conference that a user is interested in."""
     wsck = messages.StringField(1)
+    includeArchived = messages.BooleanField(2, default=False)
+    consistency = messages.EnumField('ReadConsistency', 3)
+
+
+class RecommendedSessionsQueryForm(messages.Message):
+    """For asking which sessions are wishlisted together with a session."""
+    session_websafe_key = messages.StringField(1, required=True)
+    limit = messages.IntegerField(2, default=10)
+
+
+class AgendaItemForm(messages.Message):
+    """A wishlisted session in the user's agenda, with the sessions it overlaps."""
+    session = messages.MessageField(SessionForm, 1)
+    conflicts = messages.StringField(2, repeated=True)
+
+
+class AgendaForm(messages.Message):
+    """AgendaForm -- time-sorted agenda outbound form message"""
+    items = messages.MessageField(AgendaItemForm, 1, repeated=True)
+
+
+class BatchRequestItem(messages.Message):
+    """One call to a ConferenceApi method inside a batch.
+       body is the JSON request message, as it would be sent on its own.
+    """
+    id = messages.StringField(1)
+    method = messages.StringField(2, required=True)
+    body = messages.StringField(3)
+
+
+class BatchRequestForm(messages.Message):
+    """BatchRequestForm -- batch of calls inbound form message"""
+    items = messages.MessageField(BatchRequestItem, 1, repeated=True)
+
+
+class BatchResponseItem(messages.Message):
+    """The result of one call in a batch; body is the JSON response message."""
+    id = messages.StringField(1)
+    status = messages.IntegerField(2)
+    body = messages.StringField(3)
+    error = messages.StringField(4)
+
+
+class BatchResponseForm(messages.Message):
+    """BatchResponseForm -- batch results outbound form message"""
+    items = messages.MessageField(BatchResponseItem, 1, repeated=True)
+
+
+class GroupRegistrationForm(messages.Message):
+    """GroupRegistrationForm -- profile ids to register together"""
+    profileIds = messages.StringField(1, repeated=True)
+
+
+class GroupMemberResultForm(messages.Message):
+    """Outcome of a group registration for one member.
+       status is REGISTERED, ALREADY_REGISTERED, NO_PROFILE or FAILED.
+    """
+    profileId = messages.StringField(1)
+    status = messages.StringField(2)
+
+
+class GroupRegistrationResultForm(messages.Message):
+    """GroupRegistrationResultForm -- group registration outbound form message"""
+    items = messages.MessageField(GroupMemberResultForm, 1, repeated=True)
+    registered = messages.IntegerField(2)
+    seatsAvailable = messages.IntegerField(3)
+
+
+class SizeCountForm(messages.Message):
+    """SizeCountForm -- number of attendees with one t-shirt size"""
+    teeShirtSize = messages.EnumField('TeeShirtSize', 1)
+    count = messages.IntegerField(2)
+
+
+class DailyCountForm(messages.Message):
+    """DailyCountForm -- net registrations on one day"""
+    date = messages.StringField(1)
+    count = messages.IntegerField(2)
+
+
+class AttendeeReportForm(messages.Message):
+    """AttendeeReportForm -- attendee aggregates outbound form message"""
+    attendees = messages.IntegerField(1)
+    sizes = messages.MessageField(SizeCountForm, 2, repeated=True)
+    registrations = messages.MessageField(DailyCountForm, 3, repeated=True)
+    # attendees from before the stats are still being counted
+    counting = messages.BooleanField(4)
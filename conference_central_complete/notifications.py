@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+
+"""notifications.py
+
+Conference Central batched fan-out of conference change notifications.
+
+A conference update starts a NotificationJob. The job is worked through
+by two kinds of task:
+    /tasks/notify_attendees   pages through the attendees with a cursor
+                              and queues one mail task per chunk
+    /tasks/send_notification  sends one chunk of messages; runs on the
+                              rate-limited 'mail' queue (see queue.yaml)
+
+Mail tasks carry profile ids, not addresses: the addresses are read from
+the profiles when the mail is sent, and only profiles still attending
+the job's conference are mailed.
+
+"""
+
+import logging
+
+from google.appengine.api import app_identity, mail, memcache, taskqueue
+from google.appengine.ext import ndb
+
+from models import Profile
+from models import NotificationJob
+import taskutils
+
+ATTENDEE_PAGE_SIZE = 100    # attendees read per fan-out task
+MAIL_CHUNK_SIZE = 20        # messages sent per mail task
+MAIL_QUEUE = 'mail'
+
+# memcache marker per (job, recipient) so retried tasks don't resend
+DEDUP_TPL = 'notified:%s:%s'
+DEDUP_TTL = 7 * 24 * 60 * 60
+
+NOTIFIED_FIELDS = ('startDate', 'endDate', 'city')
+CHANGE_SUBJECT_TPL = 'Conference update: %s'
+CHANGE_BODY_TPL = ('Hi, a conference you are attending has changed:\r\n\r\n'
+                   '%s\r\n\r\n%s')
+
+
+class MailSender(object):
+    """Sends mail through the App Engine mail API.
+       Tests can install a local stand-in with setMailSender().
+    """
+
+    def send(self, sender, to, subject, body):
+        mail.send_mail(sender, to, subject, body)
+
+
+_mail_sender = MailSender()
+
+
+def setMailSender(mail_sender):
+    """Install the object used to send mail; returns the previous one."""
+    global _mail_sender
+    previous, _mail_sender = _mail_sender, mail_sender
+    return previous
+
+
+def getMailSender():
+    """Return the object currently used to send mail."""
+    return _mail_sender
+
+
+def senderAddress():
+    """Return the no-reply address mail is sent from."""
+    return 'noreply@%s.appspotmail.com' % app_identity.get_application_id()
+
+
+def describeChanges(before, conf):
+    """Return a list of 'field: old -> new' lines for notified fields
+        that differ between the before dict and the Conference.
+    """
+    return ['%s: %s -> %s' % (field, before[field], getattr(conf, field))
+            for field in NOTIFIED_FIELDS
+            if before[field] != getattr(conf, field)]
+
+
+def startNotificationJob(conf, changes):
+    """Create a NotificationJob for a changed conference and queue its
+        first fan-out task. Safe to call inside the transaction that
+        updated the conference: the job shares its entity group and the
+        task is only enqueued if the transaction commits.
+    """
+    job = NotificationJob(
+        parent=conf.key,
+        subject=CHANGE_SUBJECT_TPL % conf.name,
+        body=CHANGE_BODY_TPL % (conf.name, '\r\n'.join(changes)))
+    job.put()
+    taskqueue.add(url='/tasks/notify_attendees',
+                  params={'job': job.key.urlsafe(), 'page': 0},
+                  transactional=ndb.in_transaction())
+    return job
+
+
+def _taskName(prefix, job_key, *parts):
+    """Build a task name unique to a job and position.
+       Retried tasks regenerate the same names, so the queue drops the duplicates.
+    """
+    return '-'.join([prefix, job_key.urlsafe()] + [str(part) for part in parts])
+
+
+@ndb.transactional()
+def _updateJob(job_key, **deltas):
+    """Add deltas to the job's counters; a 'status' keyword is set as-is."""
+    job = job_key.get()
+    status = deltas.pop('status', None)
+    for name, delta in deltas.items():
+        setattr(job, name, getattr(job, name) + delta)
+    if status:
+        job.status = status
+    job.put()
+    return job
+
+
+def fanOutPage(job_key, page, cursor=None):
+    """Read one page of attendees and queue mail tasks for them,
+        then queue the task for the following page.
+    """
+    wsck = job_key.parent().urlsafe()
+    profiles, next_cursor, more = Profile.query(
+        Profile.conferenceKeysToAttend == wsck).fetch_page(
+        ATTENDEE_PAGE_SIZE, start_cursor=cursor)
+
+    profile_ids = [prof.key.id() for prof in profiles if prof.mainEmail]
+    chunks = {}
+    for start in range(0, len(profile_ids), MAIL_CHUNK_SIZE):
+        chunk = profile_ids[start:start + MAIL_CHUNK_SIZE]
+        chunks[_taskName('notify', job_key, page, start)] = chunk
+
+    # a retried fan-out task finds its mail tasks already queued,
+    #   so only count recipients in tasks added by this run
+    queued = taskutils.addTasks(MAIL_QUEUE, [
+        taskqueue.Task(url='/tasks/send_notification', name=name,
+                       params={'job': job_key.urlsafe(), 'profile': chunk})
+        for name, chunk in chunks.items()]) if chunks else []
+
+    if more and next_cursor:
+        taskutils.addTasks('default', [
+            taskqueue.Task(
+                url='/tasks/notify_attendees',
+                name=_taskName('fanout', job_key, page + 1),
+                params={'job': job_key.urlsafe(),
+                        'page': page + 1,
+                        'cursor': next_cursor.urlsafe()})])
+        status = 'RUNNING'
+    else:
+        status = 'QUEUED'
+
+    if queued or not chunks:
+        _updateJob(job_key, pagesQueued=1,
+                   recipientsQueued=sum(len(chunks[task.name]) for task in queued),
+                   status=status)
+
+
+def sendChunk(job_key, profile_ids):
+    """Send the job's message to a chunk of attendees, by profile id.
+       Profiles no longer attending the job's conference are skipped.
+       Raises if any message failed, so the task queue retries the chunk;
+       recipients already sent to are skipped on the retry.
+    """
+    job = job_key.get()
+    wsck = job_key.parent().urlsafe()
+    sender = senderAddress()
+    sent = skipped = 0
+    failures = []
+
+    profiles = ndb.get_multi([ndb.Key(Profile, pid) for pid in profile_ids])
+    emails = [prof.mainEmail for prof in profiles
+              if prof and prof.mainEmail and wsck in prof.conferenceKeysToAttend]
+    skipped += len(profile_ids) - len(emails)
+
+    for email in emails:
+        dedup_key = DEDUP_TPL % (job_key.urlsafe(), email)
+        if not memcache.add(dedup_key, True, time=DEDUP_TTL):
+            skipped += 1
+            continue
+        try:
+            _mail_sender.send(sender, email, job.subject, job.body)
+            sent += 1
+        except Exception as e:
+            memcache.delete(dedup_key)
+            failures.append(email)
+            logging.warning('Notification to %s failed: %s', email, e)
+
+    _updateJob(job_key, sent=sent, skipped=skipped, failed=len(failures))
+
+    if failures:
+        raise RuntimeError('%d notifications failed; retrying chunk'
+                           % len(failures))
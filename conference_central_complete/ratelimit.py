@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+"""ratelimit.py
+
+Conference Central per-user, per-endpoint rate limiting with
+token buckets stored in memcache
+
+Each call to a rate limited endpoint takes one token from the caller's
+bucket for that endpoint and `cost` tokens from the caller's shared
+bucket ('*'). Both buckets are checked before either is debited, so a
+rejected call takes nothing. Limits are configured by RATE_LIMITS in
+settings.py.
+
+Rejected calls get a 503 with the time to wait in the message:
+Endpoints v1 only passes a few 4xx statuses through and would turn a
+429 into a 404.
+
+"""
+
+import functools
+import os
+import time
+
+import endpoints
+from google.appengine.api import memcache
+
+from models import RateLimitExceededException
+from settings import RATE_LIMITS, RATE_LIMIT_DEFAULT
+from utils import getUserId
+import stats
+
+RATE_LIMIT_NAMESPACE = 'ratelimit'
+CAS_RETRIES = 3
+MAX_BLOCKED_KEYS = 10000
+
+# in-instance fast path: bucket key -> time before which it is still empty,
+#   so a client that keeps hammering an empty bucket costs no memcache RPC
+_blocked_until = {}
+
+stats.register('ratelimit.allowed', 'ratelimit.rejected')
+
+
+def _callerId():
+    """Return the user id of the caller, or their address if anonymous."""
+    user = endpoints.get_current_user()
+    if user:
+        return getUserId(user)
+    return 'ip:%s' % os.environ.get('REMOTE_ADDR', '')
+
+
+def _tokens(state, limit, now):
+    """Return the tokens in a bucket's (tokens, stamp) state, refilled to now."""
+    rate, capacity = limit
+    if state is None:
+        return capacity
+    tokens, stamp = state
+    return min(capacity, tokens + (now - stamp) * rate)
+
+
+def _debit(client, bucket_key, cost, limit, state):
+    """Take cost tokens from a bucket already found to hold them."""
+    rate, capacity = limit
+    # an idle bucket is full again after capacity / rate seconds
+    ttl = int(capacity / rate) + 1
+    for _ in range(CAS_RETRIES):
+        now = time.time()
+        # a concurrent call may have taken the tokens since the check;
+        #   the call was admitted, so the bucket just runs empty
+        value = (max(0, _tokens(state, limit, now) - cost), now)
+        if state is None:
+            stored = client.add(bucket_key, value, time=ttl,
+                                namespace=RATE_LIMIT_NAMESPACE)
+        else:
+            stored = client.cas(bucket_key, value, time=ttl,
+                                namespace=RATE_LIMIT_NAMESPACE)
+        if stored:
+            return
+        state = client.gets(bucket_key, namespace=RATE_LIMIT_NAMESPACE)
+    # heavy contention on one bucket; let the call through
+    #   rather than failing it on a memcache race
+
+
+def _takeAll(buckets):
+    """Try to take tokens from several buckets, given as
+        (bucket key, cost, (rate, capacity)) tuples, all or none.
+       Returns the number of seconds to wait, or 0 if the tokens were taken.
+    """
+    now = time.time()
+    waits = [_blocked_until[key] - now for key, _, _ in buckets
+             if _blocked_until.get(key, 0) > now]
+    if waits:
+        return max(waits)
+    if len(_blocked_until) > MAX_BLOCKED_KEYS:
+        for key, until in _blocked_until.items():
+            if until <= now:
+                _blocked_until.pop(key, None)
+
+    client = memcache.Client()
+    states = client.get_multi([key for key, _, _ in buckets], for_cas=True,
+                              namespace=RATE_LIMIT_NAMESPACE)
+
+    # check every bucket before taking from any
+    wait = 0
+    for key, cost, limit in buckets:
+        tokens = _tokens(states.get(key), limit, now)
+        if tokens < cost:
+            _blocked_until[key] = now + (cost - tokens) / limit[0]
+            wait = max(wait, (cost - tokens) / limit[0])
+    if wait:
+        return wait
+
+    for key, cost, limit in buckets:
+        _debit(client, key, cost, limit, states.get(key))
+    return 0
+
+
+def rateLimited(cost=1):
+    """Decorator for ConferenceApi endpoint methods;
+        place it below @endpoints.method.
+    """
+    def decorator(func):
+        endpoint = func.__name__
+        rejected_counter = 'ratelimit.rejected.%s' % endpoint
+        stats.register(rejected_counter)
+
+        @functools.wraps(func)
+        def wrapper(self, request):
+            caller = _callerId()
+            wait = _takeAll([
+                ('%s:%s' % (endpoint, caller), 1,
+                 RATE_LIMITS.get(endpoint, RATE_LIMIT_DEFAULT)),
+                ('*:%s' % caller, cost, RATE_LIMITS['*'])])
+            if wait:
+                stats.incrMulti({'ratelimit.rejected': 1, rejected_counter: 1})
+                raise RateLimitExceededException(
+                    'Rate limit exceeded for %s; retry in %d seconds.'
+                    % (endpoint, int(wait) + 1))
+            stats.incr('ratelimit.allowed')
+            return func(self, request)
+        return wrapper
+    return decorator
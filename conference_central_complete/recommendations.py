@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+
+"""recommendations.py
+
+Conference Central "people who wishlisted this also wishlisted" index
+
+A rebuild job counts how often each pair of sessions shares a wishlist
+and stores the TOP_K strongest neighbors of each session, one
+SessionNeighbors entity per session, so serving recommendations is a
+single get. addSessionToWishlist updates the affected entities between
+rebuilds.
+
+The rebuild is a chain of tasks, like snapshot.py, each queued in the
+same transaction that records the job's progress:
+
+    counting    each step reads one page of SessionWishlistItem in key
+                order, so each user's items arrive together, counts the
+                pairs of the page's users, and adds them to one
+                NeighborCounts entity per session; a user whose items
+                run past the page is carried over to the next step
+    publishing  each step turns one page of NeighborCounts into
+                SessionNeighbors and deletes them
+
+Memory per step is bounded by the page, and by PRUNE_AT counters per
+session. A NeighborCounts entity records the step that last added to
+it, so a retried step doesn't count a page twice. bench_recommendations.py
+measures the counting.
+
+"""
+
+import heapq
+
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from models import NeighborCounts
+from models import RecommendationJob
+from models import SessionNeighbors
+from models import SessionWishlistItem
+
+TOP_K = 20              # neighbors stored per session
+PRUNE_AT = 200          # counters kept per session while building
+MAX_USER_ITEMS = 200    # wishlist items per user used for pairs
+SCAN_PAGE_SIZE = 1000   # wishlist items counted per step
+PUBLISH_PAGE_SIZE = 500
+PUT_BATCH_SIZE = 500
+RECENT_ITEMS = 50       # wishlist items remembered per session between rebuilds
+# the publishing query is eventually consistent; give it time to
+#   see the last counts written
+PUBLISH_DELAY = 60
+
+
+def _prune(counter, prune_at):
+    """Return a counter, cut down to its strongest half if it
+        has outgrown prune_at counters.
+    """
+    if len(counter) <= prune_at:
+        return counter
+    return dict(heapq.nlargest(prune_at // 2, counter.items(),
+                               key=lambda item: item[1]))
+
+
+def _top(counter, top_k=TOP_K):
+    """Return the top_k [neighbor, count] pairs of a counter."""
+    return [[other, count] for other, count in heapq.nlargest(
+        top_k, counter.items(), key=lambda item: item[1])]
+
+
+class CooccurrenceIndex(object):
+    """Sparse session co-occurrence counts with bounded memory.
+       Each session keeps at most PRUNE_AT counters; when it outgrows
+       that, the weakest half are dropped. Counts of strong neighbors
+       are exact, while rare pairs may be undercounted.
+    """
+
+    def __init__(self, top_k=TOP_K, prune_at=PRUNE_AT):
+        self.top_k = top_k
+        self.prune_at = prune_at
+        self.counts = {}
+
+    def addWishlist(self, sessions):
+        """Count every pair of sessions in one user's wishlist."""
+        sessions = sorted(set(sessions))[:MAX_USER_ITEMS]
+        for session in sessions:
+            counter = self.counts.setdefault(session, {})
+            for other in sessions:
+                if other != session:
+                    counter[other] = counter.get(other, 0) + 1
+            if len(counter) > self.prune_at:
+                self.counts[session] = _prune(counter, self.prune_at)
+
+    def neighbors(self, session):
+        """Return the top_k [neighbor, count] pairs of a session."""
+        return _top(self.counts.get(session, {}), self.top_k)
+
+
+def startRebuild():
+    """Create a RecommendationJob and queue its first step."""
+    job = RecommendationJob()
+    _queueFirstStep(job)
+    return job
+
+
+@ndb.transactional()
+def _queueFirstStep(job):
+    job.put()
+    taskqueue.add(url='/tasks/build_recommendations',
+                  params={'job': job.key.urlsafe(), 'step': 0},
+                  transactional=True)
+
+
+def rebuildStep(job_key, step):
+    """Run one step of a rebuild, then queue the next."""
+    job = job_key.get()
+    if not job or job.step != step:
+        # finished, or a duplicate of a step that already ran
+        return
+    if job.status == 'COUNTING':
+        _countStep(job, step)
+    elif job.status == 'PUBLISHING':
+        _publishStep(job, step)
+
+
+def _countsKey(job_id, session):
+    return ndb.Key(NeighborCounts, '%d:%s' % (job_id, session))
+
+
+def _countStep(job, step):
+    """Count the pairs of one page of wishlist items."""
+    cursor = Cursor(urlsafe=job.cursor) if job.cursor else None
+    items, next_cursor, more = SessionWishlistItem.query().order(
+        SessionWishlistItem.key).fetch_page(SCAN_PAGE_SIZE, start_cursor=cursor)
+
+    # [[user websafe key, [session websafe key, ...]], ...] in key order
+    wishlists = [[job.carryUser, list(job.carry)]] if job.carryUser else []
+    for item in items:
+        user = item.key.parent().urlsafe()
+        if not wishlists or wishlists[-1][0] != user:
+            wishlists.append([user, []])
+        wishlists[-1][1].append(item.session_websafe_key)
+    # the last user may have more items on the next page
+    carry_user, carry = wishlists.pop() if more and wishlists else (None, [])
+
+    # a page can't give a session more neighbors than it has items
+    index = CooccurrenceIndex(prune_at=SCAN_PAGE_SIZE + len(job.carry))
+    for _, sessions in wishlists:
+        index.addWishlist(sessions)
+    _addCounts(job.key.id(), step, index.counts)
+
+    _advance(job.key, step, next_cursor.urlsafe() if more and next_cursor else None,
+             items=len(items), carry_user=carry_user, carry=carry)
+
+
+def _addCounts(job_id, step, counts):
+    """Add one step's counts to the job's NeighborCounts entities,
+        skipping those a previous try of the step already added to.
+    """
+    sessions = sorted(counts)
+    for start in range(0, len(sessions), PUT_BATCH_SIZE):
+        chunk = sessions[start:start + PUT_BATCH_SIZE]
+        keys = [_countsKey(job_id, session) for session in chunk]
+        entities = []
+        for session, key, entity in zip(chunk, keys, ndb.get_multi(keys)):
+            entity = entity or NeighborCounts(key=key, job=job_id)
+            if entity.step >= step:
+                continue
+            # a copy: a new entity's counts is the property's shared default
+            merged = dict(entity.counts or {})
+            for other, count in counts[session].items():
+                merged[other] = merged.get(other, 0) + count
+            entity.counts = _prune(merged, PRUNE_AT)
+            entity.step = step
+            entities.append(entity)
+        ndb.put_multi(entities)
+
+
+def _publishStep(job, step):
+    """Store the neighbors of one page of sessions."""
+    cursor = Cursor(urlsafe=job.cursor) if job.cursor else None
+    page, next_cursor, more = NeighborCounts.query(
+        NeighborCounts.job == job.key.id()).fetch_page(
+        PUBLISH_PAGE_SIZE, start_cursor=cursor)
+
+    ndb.put_multi([SessionNeighbors(id=counts.key.id().split(':', 1)[1],
+                                    neighbors=_top(counts.counts))
+                   for counts in page])
+    ndb.delete_multi([counts.key for counts in page])
+
+    _advance(job.key, step, next_cursor.urlsafe() if more and next_cursor else None,
+             sessions=len(page))
+
+
+@ndb.transactional()
+def _advance(job_key, step, next_cursor, items=0, sessions=0,
+             carry_user=None, carry=()):
+    """Record a finished step and queue the next one, atomically."""
+    job = job_key.get()
+    if job.step != step:
+        return
+
+    job.items += items
+    job.sessions += sessions
+    job.carryUser, job.carry = carry_user, list(carry)
+    job.cursor = next_cursor
+    job.step += 1
+    countdown = 0
+    if not next_cursor:
+        if job.status == 'COUNTING':
+            job.status = 'PUBLISHING'
+            countdown = PUBLISH_DELAY
+        else:
+            job.status = 'DONE'
+    if job.status != 'DONE':
+        taskqueue.add(url='/tasks/build_recommendations',
+                      params={'job': job_key.urlsafe(), 'step': job.step},
+                      countdown=countdown, transactional=True)
+    job.put()
+
+
+def _bump(neighbors, session, delta=1):
+    """Add delta to a session's score in a neighbors list,
+        keeping the list sorted and at most TOP_K long.
+    """
+    scores = dict((other, count) for other, count in neighbors)
+    scores[session] = scores.get(session, 0) + delta
+    return _top(scores)
+
+
+def addToIndex(user_key, wssk, item=None):
+    """Update the index for a session a user just added to their wishlist:
+        it becomes a neighbor of each session already in the wishlist,
+        and each of them becomes a neighbor of it.
+       item is the websafe key of the new SessionWishlistItem; entities
+        that already counted it are left alone, so a retry is harmless.
+    """
+    others = set(wishlisted.session_websafe_key for wishlisted in
+                 SessionWishlistItem.query(ancestor=user_key))
+    others.discard(wssk)
+    others = sorted(others)[:MAX_USER_ITEMS]
+    if not others:
+        return
+
+    keys = [ndb.Key(SessionNeighbors, session) for session in [wssk] + others]
+    entities = [entity or SessionNeighbors(key=key)
+                for key, entity in zip(keys, ndb.get_multi(keys))]
+
+    changed = []
+    for i, entity in enumerate(entities):
+        if item and item in entity.recentItems:
+            continue
+        if i == 0:
+            for other in others:
+                entity.neighbors = _bump(entity.neighbors, other)
+        else:
+            entity.neighbors = _bump(entity.neighbors, wssk)
+        if item:
+            entity.recentItems = (entity.recentItems + [item])[-RECENT_ITEMS:]
+        changed.append(entity)
+    ndb.put_multi(changed)
+
+
+def getNeighbors(wssk, limit=TOP_K):
+    """Return up to limit websafe keys of sessions wishlisted with wssk."""
+    entity = ndb.Key(SessionNeighbors, wssk).get()
+    if not entity:
+        return []
+    return [other for other, _ in entity.neighbors[:limit]]
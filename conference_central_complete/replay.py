@@ -0,0 +1,406 @@
+#!/usr/bin/env python
+
+"""replay.py
+
+Conference Central replay of captured traffic against local stubs
+
+Reads the CAPTURE lines written by capture.py (from exported request
+logs), seeds an in-memory datastore and memcache with deterministic
+sample data, and calls ConferenceApi the way the capture did: same
+endpoints, same request messages, same gaps between calls, sped up or
+slowed down by --speed, from --concurrency worker threads. For every
+endpoint it reports call counts, errors, latency percentiles and the
+number of API RPCs (datastore, memcache, task queue...) per call.
+
+To compare two code versions, replay the same capture on each and pass
+the first run's report to the second:
+
+    python replay.py --sdk ~/google_appengine capture.log --out before.json
+    (check out the other version)
+    python replay.py --sdk ~/google_appengine capture.log --compare before.json
+
+Websafe keys and user ids in the capture are mapped onto the seeded
+entities in order of first appearance, so every run with the same
+capture and --seed sees the same data. Tasks are queued but not run.
+
+"""
+
+import argparse
+import collections
+import json
+import os
+import random
+import sys
+import threading
+import time
+from datetime import date
+from datetime import time as dtime
+from datetime import timedelta
+
+CAPTURE_PREFIX = 'CAPTURE '
+REPLAY_APP_ID = 'replay'
+REPLAY_EMAIL_TPL = 'user%d@replay.test'
+KEY_MASK_PREFIX = 'key:'    # capture.KEY_MASK_TPL
+
+
+def _setupPaths(sdk):
+    """Put the App Engine SDK and this app on sys.path."""
+    sys.path.insert(0, sdk)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    lib = os.path.join(sdk, 'lib')
+    for name in sorted(os.listdir(lib)):
+        if name.startswith('endpoints-') and os.path.join(lib, name) not in sys.path:
+            sys.path.append(os.path.join(lib, name))
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+def loadCapture(path):
+    """Return the captured calls in a log file, oldest first."""
+    calls = []
+    with open(path) as f:
+        for line in f:
+            start = line.find(CAPTURE_PREFIX + '{')
+            if start != -1:
+                calls.append(json.loads(line[start + len(CAPTURE_PREFIX):]))
+    calls.sort(key=lambda call: call['at'])
+    return calls
+
+
+class Seeder(object):
+    """Creates deterministic sample data and maps captured
+        ids and keys onto it.
+    """
+
+    def __init__(self, seed, conferences, sessions_per_conference):
+        self.rng = random.Random(seed)
+        self.num_conferences = conferences
+        self.sessions_per_conference = sessions_per_conference
+        self.users = {}         # masked id -> local email
+        self.keys = {}          # captured websafe key -> local websafe key
+        self.pools = {}         # kind -> seeded websafe keys
+        self.used = collections.Counter()
+
+    def user(self, masked):
+        """Return the local email standing in for a masked user id."""
+        if masked not in self.users:
+            self.users[masked] = REPLAY_EMAIL_TPL % len(self.users)
+        return self.users[masked]
+
+    def key(self, wsk):
+        """Return the local websafe key standing in for a captured one,
+            masked (capture.maskKey) or, in older captures, as it was.
+        """
+        from google.appengine.ext import ndb
+        if wsk not in self.keys:
+            try:
+                if wsk.startswith(KEY_MASK_PREFIX):
+                    kind = wsk.split(':')[1]
+                else:
+                    kind = ndb.Key(urlsafe=wsk).kind()
+            except Exception:
+                # not a key; the call will fail the same way it did live
+                return wsk
+            pool = self.pools.get(kind)
+            if not pool:
+                return wsk
+            self.keys[wsk] = pool[self.used[kind] % len(pool)]
+            self.used[kind] += 1
+        return self.keys[wsk]
+
+    def mapRequest(self, data, key_fields):
+        """Rewrite captured ids and keys in a decoded request in place."""
+        from capture import MASK_PREFIX
+        if isinstance(data, list):
+            return [self.mapRequest(item, key_fields) for item in data]
+        if isinstance(data, dict):
+            for name, value in data.items():
+                if name in key_fields and isinstance(value, basestring):
+                    data[name] = self.key(value)
+                elif name == 'body' and isinstance(value, basestring):
+                    # a batch call's sub-request
+                    try:
+                        data[name] = json.dumps(
+                            self.mapRequest(json.loads(value), key_fields))
+                    except ValueError:
+                        pass
+                else:
+                    data[name] = self.mapRequest(value, key_fields)
+            return data
+        if isinstance(data, basestring) and data.startswith(KEY_MASK_PREFIX):
+            return self.key(data)
+        if isinstance(data, basestring) and data.startswith(MASK_PREFIX):
+            return self.user(data)
+        return data
+
+    def seed(self, callers):
+        """Write profiles for the callers, conferences with sessions,
+            registrations and wishlists.
+        """
+        from google.appengine.ext import ndb
+        from models import Conference, Profile, Session, SessionWishlistItem
+
+        emails = [self.user(caller) for caller in callers if caller]
+        emails = emails or [REPLAY_EMAIL_TPL % 0]
+        profiles = [Profile(id=email, mainEmail=email,
+                            displayName=email.split('@')[0],
+                            teeShirtSize=self.rng.choice(['M_M', 'M_L', 'W_S']))
+                    for email in emails]
+
+        cities = ['London', 'Paris', 'Tokyo', 'Chicago', 'Berlin']
+        topics = ['Web', 'Mobile', 'Cloud', 'Data', 'Security']
+        speakers = ['Speaker %d' % i for i in range(max(10, self.num_conferences))]
+        types = ['lecture', 'workshop', 'keynote']
+        today = date.today()
+
+        conferences, sessions = [], []
+        for i in range(self.num_conferences):
+            organizer = self.rng.choice(profiles)
+            start = today + timedelta(days=self.rng.randint(-20, 200))
+            max_attendees = self.rng.choice([50, 100, 500])
+            conf = Conference(
+                key=ndb.Key(Conference, i + 1, parent=organizer.key),
+                name='Conference %d' % i,
+                organizerUserId=organizer.key.id(),
+                city=self.rng.choice(cities),
+                topics=self.rng.sample(topics, 2),
+                startDate=start, endDate=start + timedelta(days=2),
+                month=start.month, maxAttendees=max_attendees,
+                seatsAvailable=max_attendees)
+            conferences.append(conf)
+            for j in range(self.sessions_per_conference):
+                sessions.append(Session(
+                    parent=conf.key, name='Session %d-%d' % (i, j),
+                    speaker=self.rng.choice(speakers),
+                    date=start + timedelta(days=j % 2),
+                    startTime=dtime(9 + j % 8), duration=60,
+                    session_type=self.rng.choice(types),
+                    location='Room %d' % (j % 4)))
+
+        for profile in profiles:
+            for conf in self.rng.sample(conferences, min(3, len(conferences))):
+                profile.conferenceKeysToAttend.append(conf.key.urlsafe())
+                conf.seatsAvailable -= 1
+        ndb.put_multi(profiles + conferences)
+        ndb.put_multi(sessions)
+
+        wishlist = []
+        for profile in profiles:
+            for session in self.rng.sample(sessions, min(5, len(sessions))):
+                wishlist.append(SessionWishlistItem(
+                    parent=profile.key,
+                    session_websafe_key=session.key.urlsafe(),
+                    parent_wsck=session.key.parent().urlsafe()))
+        ndb.put_multi(wishlist)
+
+        self.pools = {
+            'Conference': [conf.key.urlsafe() for conf in conferences],
+            'Session': [session.key.urlsafe() for session in sessions],
+            'Profile': [profile.key.urlsafe() for profile in profiles],
+        }
+
+
+class RpcCounter(object):
+    """Counts API RPCs per service, per thread."""
+
+    def __init__(self):
+        self.local = threading.local()
+
+    def hook(self, service, call, request, response):
+        counts = getattr(self.local, 'counts', None)
+        if counts is not None:
+            counts[service] += 1
+
+    def start(self):
+        self.local.counts = collections.Counter()
+
+    def stop(self):
+        counts, self.local.counts = self.local.counts, None
+        return counts
+
+
+def _percentile(values, fraction):
+    """Return a percentile of a non-empty list of numbers."""
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def replay(calls, seeder, speed, concurrency):
+    """Replay calls against ConferenceApi and return the per-endpoint report."""
+    import endpoints
+    from google.appengine.api import apiproxy_stub_map
+    from google.appengine.api import users
+    from protorpc import protojson
+    from conference import BATCH_KEY_FIELDS
+    from conference import ConferenceApi
+
+    # each worker thread replays as the caller of its current call
+    current = threading.local()
+
+    def currentUser():
+        email = getattr(current, 'email', None)
+        return users.User(email, 'replay.test') if email else None
+    endpoints.get_current_user = currentUser
+
+    rpcs = RpcCounter()
+    apiproxy_stub_map.apiproxy.GetPostCallHooks().Append('replay_rpcs', rpcs.hook)
+
+    # decode everything before the clock starts
+    prepared = []
+    for call in calls:
+        method = getattr(ConferenceApi, call['endpoint'], None)
+        if method is None:
+            continue
+        data = seeder.mapRequest(call['request'], BATCH_KEY_FIELDS)
+        request = protojson.decode_message(method.remote.request_type, json.dumps(data))
+        prepared.append((call, request,
+                         seeder.user(call['caller']) if call['caller'] else None))
+
+    results = collections.defaultdict(list)
+    lock = threading.Lock()
+    queue = collections.deque(prepared)
+    first_at = calls[0]['at'] if calls else 0
+    started = time.time()
+
+    def worker():
+        from google.appengine.ext import ndb
+        while True:
+            with lock:
+                if not queue:
+                    return
+                call, request, email = queue.popleft()
+            if speed:
+                delay = started + (call['at'] - first_at) / speed - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            current.email = email
+            ndb.get_context().clear_cache()
+            rpcs.start()
+            t0 = time.time()
+            try:
+                getattr(ConferenceApi(), call['endpoint'])(request)
+                status = 'OK'
+            except endpoints.ServiceException as e:
+                status = e.__class__.__name__
+            except Exception:
+                status = 'InternalServerError'
+            latency = (time.time() - t0) * 1000
+            counts = rpcs.stop()
+            with lock:
+                results[call['endpoint']].append((latency, counts, status))
+
+    threads = [threading.Thread(target=worker) for _ in range(max(1, concurrency))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    report = {}
+    for endpoint, rows in sorted(results.items()):
+        latencies = [latency for latency, _, _ in rows]
+        services = collections.Counter()
+        for _, counts, _ in rows:
+            services.update(counts)
+        report[endpoint] = {
+            'calls': len(rows),
+            'errors': sum(1 for _, _, status in rows if status != 'OK'),
+            'p50Ms': round(_percentile(latencies, 0.5), 2),
+            'p95Ms': round(_percentile(latencies, 0.95), 2),
+            'meanMs': round(sum(latencies) / len(latencies), 2),
+            'rpcsPerCall': dict((service, round(float(count) / len(rows), 2))
+                                for service, count in sorted(services.items())),
+        }
+    return report
+
+
+def printReport(report, baseline=None):
+    """Print the report, with deltas against a baseline report."""
+    for endpoint, row in sorted(report.items()):
+        before = (baseline or {}).get(endpoint)
+        line = '%-30s %5d calls %4d errors  p50 %8.2fms  p95 %8.2fms' % (
+            endpoint, row['calls'], row['errors'], row['p50Ms'], row['p95Ms'])
+        if before:
+            line += '  (p50 %+.2fms, p95 %+.2fms)' % (
+                row['p50Ms'] - before['p50Ms'], row['p95Ms'] - before['p95Ms'])
+        print line
+        services = set(row['rpcsPerCall']) | set((before or {}).get('rpcsPerCall', {}))
+        for service in sorted(services):
+            count = row['rpcsPerCall'].get(service, 0)
+            text = '    %-26s %8.2f rpcs/call' % (service, count)
+            if before:
+                text += '  (%+.2f)' % (count - before['rpcsPerCall'].get(service, 0))
+            print text
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('capture', help='log file holding CAPTURE lines')
+    parser.add_argument('--sdk', default=os.environ.get('GAE_SDK', ''),
+                        help='path to the App Engine Python SDK')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='replay speed; 2 is twice as fast, 0 as fast as possible')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--conferences', type=int, default=100)
+    parser.add_argument('--sessions', type=int, default=10,
+                        help='sessions per seeded conference')
+    parser.add_argument('--no-rate-limits', action='store_true',
+                        help='disable rate limiting, e.g. for accelerated replays')
+    parser.add_argument('--out', help='write the report as JSON to this file')
+    parser.add_argument('--compare', help='report JSON of an earlier run')
+    args = parser.parse_args()
+
+    if not args.sdk:
+        parser.error('--sdk or GAE_SDK is required')
+    _setupPaths(args.sdk)
+    os.environ['APPLICATION_ID'] = REPLAY_APP_ID
+
+    from google.appengine.datastore import datastore_stub_util
+    from google.appengine.ext import testbed
+
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.setup_env(app_id=REPLAY_APP_ID, overwrite=True)
+    bed.init_datastore_v3_stub(
+        consistency_policy=datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+            probability=1, seed=args.seed))
+    bed.init_memcache_stub()
+    bed.init_taskqueue_stub(root_path=os.path.dirname(os.path.abspath(__file__)))
+    bed.init_mail_stub()
+    bed.init_urlfetch_stub()
+    bed.init_app_identity_stub()
+    bed.init_user_stub()
+
+    import settings
+    settings.CAPTURE_ENABLED = False
+    if args.no_rate_limits:
+        import ratelimit
+        for name in list(ratelimit.RATE_LIMITS):
+            ratelimit.RATE_LIMITS[name] = (1e9, 1e9)
+        ratelimit.RATE_LIMIT_DEFAULT = (1e9, 1e9)
+
+    calls = loadCapture(args.capture)
+    seeder = Seeder(args.seed, args.conferences, args.sessions)
+    seeder.seed(sorted(set(call['caller'] for call in calls if call['caller'])))
+    # count the seeded conferences; the testbed doesn't run the recount's
+    #   task chain, so run its steps here
+    import facets
+    job = facets.startReconcile()
+    while not facets.reconcileStep(job.key, job.key.get().step):
+        pass
+
+    report = replay(calls, seeder, args.speed, args.concurrency)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    printReport(report, baseline)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    bed.deactivate()
+
+
+if __name__ == '__main__':
+    main()
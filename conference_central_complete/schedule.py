@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+"""schedule.py
+
+Conference Central helpers for working with Session time intervals
+
+"""
+
+import bisect
+import heapq
+from datetime import datetime, timedelta
+
+SLOT_TIME_FORMAT = '%Y-%m-%dT%H:%M'
+
+
+def sessionInterval(session):
+    """Return the (start, end) datetimes of a Session,
+        or None if the session has no date or start time.
+    """
+    # time(0, 0) is false in Python 2, so test for None explicitly
+    if session.date is None or session.startTime is None:
+        return None
+    start = datetime.combine(session.date, session.startTime)
+    return start, start + timedelta(minutes=session.duration or 0)
+
+
+def findOverlaps(intervals):
+    """Return a dict mapping each interval id to the set of ids it overlaps.
+       intervals is a list of (start, end, id) tuples sorted by start.
+
+       Sweeps the intervals in start order, keeping the intervals still
+       in progress in a heap ordered by end time, so the cost is
+       O(n log n + number of overlapping pairs) instead of O(n^2).
+    """
+    overlaps = {}
+    active = []
+    for start, end, item_id in intervals:
+        # retire everything that finished before this interval began
+        while active and active[0][0] <= start:
+            heapq.heappop(active)
+        for _, other_id in active:
+            overlaps.setdefault(item_id, set()).add(other_id)
+            overlaps.setdefault(other_id, set()).add(item_id)
+        heapq.heappush(active, (end, item_id))
+    return overlaps
+
+
+def sessionsAt(entries, starts, max_duration, at, window, limit):
+    """Return the entries in progress at a datetime, and at most limit
+        entries starting within window after it.
+       entries is a list of (start, end, ...) tuples sorted by start,
+       starts their start times and max_duration the longest end - start.
+       Only sessions that started within max_duration of `at` can still
+       be running, so both lookups are binary searches plus a short scan.
+    """
+    first = bisect.bisect_right(starts, at - max_duration)
+    now = bisect.bisect_right(starts, at)
+    in_progress = [entry for entry in entries[first:now] if entry[1] > at]
+    horizon = bisect.bisect_right(starts, at + window, lo=now)
+    return in_progress, entries[now:min(horizon, now + limit)]
+
+
+def roomName(location):
+    """Return the form locations are matched on,
+        so 'Room 1' and ' room  1' are the same room.
+    """
+    return u' '.join((location or u'').lower().split())
+
+
+def roomSlot(session):
+    """Return the [start, end, websafe key] RoomSchedule slot of a Session,
+        or None if the session has no date or start time.
+    """
+    interval = sessionInterval(session)
+    if not interval:
+        return None
+    return [interval[0].strftime(SLOT_TIME_FORMAT),
+            interval[1].strftime(SLOT_TIME_FORMAT), session.key.urlsafe()]
+
+
+def slotConflicts(slots, max_duration, start, end):
+    """Return the slots overlapping [start, end).
+       slots is a list of [start, end, key] sorted by start, none longer
+       than max_duration minutes. Only slots starting within max_duration
+       before `start` can still be running then, so this is two binary
+       searches plus a scan of the slots in that window.
+    """
+    earliest = (datetime.strptime(start, SLOT_TIME_FORMAT) -
+                timedelta(minutes=max_duration)).strftime(SLOT_TIME_FORMAT)
+    lo = bisect.bisect_left(slots, [earliest])
+    hi = bisect.bisect_left(slots, [end])
+    return [slot for slot in slots[lo:hi] if slot[1] > start]
@@ -16,3 +16,40 @@ WEB_CLIENT_ID = '758860597214-emqhrs3hv1gccgv85ectif0abf604rk9.apps.googleuserco
 ANDROID_CLIENT_ID = 'replace with Android client ID'
 IOS_CLIENT_ID = 'replace with iOS client ID'
 ANDROID_AUDIENCE = WEB_CLIENT_ID
+
+# Token bucket rate limits as (tokens refilled per second, bucket size).
+# '*' is each user's budget across all endpoints, charged each endpoint's
+# cost; the other entries limit calls to one endpoint per user.
+RATE_LIMITS = {
+    '*': (5.0, 60),
+    'registerForConference': (0.5, 10),
+    'unregisterFromConference': (0.5, 10),
+    'addSessionToWishlist': (1.0, 20),
+    'getBusiestSpeaker': (0.05, 3),
+    'getMostWishlistedSessions': (0.05, 3),
+}
+RATE_LIMIT_DEFAULT = (2.0, 30)
+
+# Default read consistency of the endpoints taking a `consistency` field
+# (consistency.py). Eventual reads don't wait for recent writes to apply
+# and may be served from caches, so they can miss a write made a moment
+# ago; endpoints listing the caller's own data stay STRONG so users see
+# their changes at once. bench_consistency.py measures the difference.
+READ_CONSISTENCY = {
+    'getConference': 'EVENTUAL',
+    'getConferenceSessions': 'EVENTUAL',
+    'getConferenceSessionsByType': 'EVENTUAL',
+}
+READ_CONSISTENCY_DEFAULT = 'STRONG'
+
+# Traffic capture for replay.py, off by default. Sampled endpoint calls
+# are logged with user ids and free text masked; the salt keeps masked
+# ids from being reversed by hashing known email addresses.
+CAPTURE_ENABLED = False
+CAPTURE_SAMPLE_RATE = 1.0
+CAPTURE_SALT = 'replace with a random string'
+
+# Snapshot exports (snapshot.py) go to this Cloud Storage bucket,
+# or to SNAPSHOT_LOCAL_DIR when it is None, e.g. on the dev server.
+SNAPSHOT_BUCKET = None
+SNAPSHOT_LOCAL_DIR = '/tmp/conference-snapshots'
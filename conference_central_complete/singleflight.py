@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+
+"""singleflight.py
+
+Conference Central dogpile protection for memcache-backed reads
+
+Values are stored with a soft expiry ahead of their memcache expiry.
+Once the soft expiry passes, the first caller to win a lease key
+refreshes the value while everyone, itself included, keeps serving the
+cached one. Values whose recompute is registered under a name (register)
+are refreshed by a task, off the request's path; others inline by the
+lease holder. On a hard miss, the lease holder recomputes and other
+callers wait briefly for its result instead of all going to the
+datastore at once.
+
+A value that must change when its source does belongs under a key that
+includes the source's version, so a recompute that read the old source
+can only ever store under the old key.
+
+"""
+
+import json
+import time
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+
+import stats
+
+LEASE_TPL = 'lease:%s'
+LEASE_TTL = 10          # seconds a crashed recompute can hold the lease
+WAIT_TIMEOUT = 1.0      # seconds a caller waits for another's recompute
+WAIT_INTERVAL = 0.05
+DEFAULT_TTL = 60 * 60
+DEFAULT_SOFT_TTL = 50 * 60
+
+# recompute functions a task can refresh a value with, by name
+REFRESHERS = {}
+
+stats.register('singleflight.hits', 'singleflight.staleServed',
+               'singleflight.recomputes', 'singleflight.waits',
+               'singleflight.backgroundRefreshes')
+
+
+def register(name, recompute):
+    """Register a recompute function for background refreshes."""
+    REFRESHERS[name] = recompute
+
+
+def store(key, value, ttl=DEFAULT_TTL, soft_ttl=DEFAULT_SOFT_TTL):
+    """Cache a value, to be refreshed after soft_ttl seconds."""
+    memcache.set(key, (value, time.time() + soft_ttl), time=ttl)
+
+
+def get(key, recompute, ttl=DEFAULT_TTL, soft_ttl=DEFAULT_SOFT_TTL,
+        refresh=None):
+    """Return the cached value for key, calling recompute() at most
+        once across all callers when it is missing or due for refresh.
+       refresh is (name, args) of a registered recompute function
+        equivalent to recompute(); if given, a value due for refresh is
+        refreshed by a task instead of in this request.
+    """
+    entry = memcache.get(key)
+    if not isinstance(entry, tuple):
+        # missing, or written by code that doesn't use this module
+        entry = None
+    if entry is not None:
+        value, refresh_at = entry
+        if time.time() < refresh_at:
+            stats.incr('singleflight.hits')
+            return value
+        if not memcache.add(LEASE_TPL % key, True, time=LEASE_TTL):
+            # someone else is refreshing; the old value is good enough
+            stats.incr('singleflight.staleServed')
+            return value
+        if refresh:
+            try:
+                _queueRefresh(key, refresh, ttl, soft_ttl)
+                return value
+            except taskqueue.Error:
+                # refresh inline rather than hold the lease for nothing
+                pass
+        return _recompute(key, recompute, ttl, soft_ttl)
+
+    if memcache.add(LEASE_TPL % key, True, time=LEASE_TTL):
+        return _recompute(key, recompute, ttl, soft_ttl)
+
+    # another caller holds the lease; wait for its result
+    stats.incr('singleflight.waits')
+    deadline = time.time() + WAIT_TIMEOUT
+    while time.time() < deadline:
+        time.sleep(WAIT_INTERVAL)
+        entry = memcache.get(key)
+        if isinstance(entry, tuple):
+            return entry[0]
+
+    # the lease holder is too slow or died; don't fail the request
+    return _recompute(key, recompute, ttl, soft_ttl)
+
+
+def _recompute(key, recompute, ttl, soft_ttl):
+    """Recompute and store a value, then release the lease."""
+    stats.incr('singleflight.recomputes')
+    try:
+        value = recompute()
+        store(key, value, ttl, soft_ttl)
+    finally:
+        memcache.delete(LEASE_TPL % key)
+    return value
+
+
+def _queueRefresh(key, refresh, ttl, soft_ttl):
+    """Queue a task to refresh a value; the caller holds the lease,
+        which the task releases.
+    """
+    name, args = refresh
+    stats.incr('singleflight.backgroundRefreshes')
+    taskqueue.add(url='/tasks/refresh_cache',
+                  params={'key': key, 'name': name, 'args': json.dumps(args),
+                          'ttl': ttl, 'soft_ttl': soft_ttl})
+
+
+def refreshStep(key, name, args, ttl, soft_ttl):
+    """Refresh a value with a registered recompute function;
+        used by the refresh task.
+    """
+    _recompute(key, lambda: REFRESHERS[name](*args), ttl, soft_ttl)
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+
+"""snapshot.py
+
+Conference Central snapshot export of the datastore for offline analytics
+
+A SnapshotJob exports Conference, Session, Profile and SessionWishlistItem
+as gzipped NDJSON, one chunk file per page of EXPORT_PAGE_SIZE entities:
+
+    <prefix>/<Kind>/part-00000.ndjson.gz
+    <prefix>/manifest.json
+
+Each task exports one page and queues the next in the same transaction
+that records the job's cursor, so the chain resumes where it stopped
+after a failure and memory use doesn't grow with the dataset. A retried
+task rewrites the same chunk file.
+
+An incremental job only exports entities whose `updated` time is at or
+after the start of the previous completed job. Deleted entities are not
+tracked; take a full snapshot to drop them.
+
+Files go to Cloud Storage when SNAPSHOT_BUCKET is set in settings.py,
+and to SNAPSHOT_LOCAL_DIR otherwise (the dev server and tests).
+
+"""
+
+import gzip
+import json
+import os
+from cStringIO import StringIO
+from datetime import date, datetime, time
+
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+try:
+    import cloudstorage
+except ImportError:
+    cloudstorage = None
+
+from models import Conference
+from models import Profile
+from models import Session
+from models import SessionWishlistItem
+from models import SnapshotJob
+import settings
+
+EXPORT_KINDS = (Conference, Session, Profile, SessionWishlistItem)
+# secrets that must not leave the datastore
+EXCLUDED_PROPERTIES = ('calendarToken',)
+EXPORT_PAGE_SIZE = 1000
+CHUNK_NAME_TPL = '%s/%s/part-%05d.ndjson.gz'
+MANIFEST_NAME_TPL = '%s/manifest.json'
+
+
+class LocalFileTarget(object):
+    """Writes snapshot files under a local directory."""
+
+    def __init__(self, root):
+        self.root = root
+
+    def write(self, name, data, content_type):
+        path = os.path.join(self.root, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(data)
+
+
+class CloudStorageTarget(object):
+    """Writes snapshot files to a Cloud Storage bucket."""
+
+    def __init__(self, bucket):
+        if cloudstorage is None:
+            raise RuntimeError('SNAPSHOT_BUCKET needs the GoogleAppEngineCloudStorageClient library')
+        self.bucket = bucket
+
+    def write(self, name, data, content_type):
+        with cloudstorage.open('/%s/%s' % (self.bucket, name), 'w',
+                               content_type=content_type) as f:
+            f.write(data)
+
+
+def getTarget():
+    """Return the configured snapshot target."""
+    if settings.SNAPSHOT_BUCKET:
+        return CloudStorageTarget(settings.SNAPSHOT_BUCKET)
+    return LocalFileTarget(settings.SNAPSHOT_LOCAL_DIR)
+
+
+def _jsonValue(value):
+    """Convert a property value the json module can't handle."""
+    if isinstance(value, (datetime, date, time)):
+        return value.isoformat()
+    if isinstance(value, ndb.Key):
+        return value.urlsafe()
+    raise TypeError('Cannot export %r' % value)
+
+
+def encodeChunk(entities):
+    """Return gzipped NDJSON for a page of entities, one object per line
+        with the entity's properties and its websafe key as _key.
+    """
+    buf = StringIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as out:
+        for entity in entities:
+            row = entity.to_dict(exclude=EXCLUDED_PROPERTIES)
+            row['_key'] = entity.key.urlsafe()
+            out.write(json.dumps(row, default=_jsonValue, sort_keys=True))
+            out.write('\n')
+    return buf.getvalue()
+
+
+def startJob(full=False):
+    """Create a SnapshotJob and queue its first task.
+       Unless full is set, the job is incremental from the last completed one.
+    """
+    since = None
+    if not full:
+        last = SnapshotJob.query(SnapshotJob.status == 'DONE').order(
+            -SnapshotJob.started).get()
+        since = last.started if last else None
+
+    job = SnapshotJob(since=since)
+    job.started = datetime.utcnow()
+    job.prefix = 'snapshots/%s%s' % (job.started.strftime('%Y%m%dT%H%M%S'),
+                                     '-incremental' if since else '')
+    job.put()
+    taskqueue.add(url='/tasks/export_snapshot',
+                  params={'job': job.key.urlsafe(), 'step': 0})
+    return job
+
+
+def _query(model, since):
+    """Return the export query for a kind."""
+    if since:
+        return model.query(model.updated >= since).order(model.updated)
+    return model.query()
+
+
+def exportStep(job_key, step, target=None):
+    """Export one page of the job's current kind, then queue the next step."""
+    job = job_key.get()
+    if not job or job.status != 'RUNNING' or job.step != step:
+        # finished, or a duplicate of a step that already ran
+        return
+
+    model = EXPORT_KINDS[job.kindIndex]
+    kind = model._get_kind()
+    cursor = Cursor(urlsafe=job.cursor) if job.cursor else None
+    entities, next_cursor, more = _query(model, job.since).fetch_page(
+        EXPORT_PAGE_SIZE, start_cursor=cursor)
+
+    next_cursor = next_cursor.urlsafe() if more and next_cursor else None
+
+    target = target or getTarget()
+    if entities:
+        target.write(CHUNK_NAME_TPL % (job.prefix, kind, job.chunk),
+                     encodeChunk(entities), 'application/gzip')
+
+    if not next_cursor and job.kindIndex == len(EXPORT_KINDS) - 1:
+        # last page of the last kind; the manifest is written before the
+        #   job is marked done, so a failure here is retried
+        rows, chunks = dict(job.rows), dict(job.chunks)
+        rows[kind] = rows.get(kind, 0) + len(entities)
+        chunks[kind] = chunks.get(kind, 0) + (1 if entities else 0)
+        target.write(MANIFEST_NAME_TPL % job.prefix, json.dumps({
+            'started': job.started.isoformat(),
+            'since': job.since.isoformat() if job.since else None,
+            'rows': rows,
+            'chunks': chunks,
+        }, indent=2, sort_keys=True), 'application/json')
+
+    _advance(job_key, step, kind, len(entities), next_cursor, bool(entities))
+
+
+@ndb.transactional()
+def _advance(job_key, step, kind, rows, next_cursor, wrote_chunk):
+    """Record an exported page and queue the next step, atomically."""
+    job = job_key.get()
+    if job.step != step:
+        return
+
+    job.rows[kind] = job.rows.get(kind, 0) + rows
+    if wrote_chunk:
+        job.chunks[kind] = job.chunks.get(kind, 0) + 1
+        job.chunk += 1
+    if next_cursor:
+        job.cursor = next_cursor
+    else:
+        # this kind is done; move on to the next one
+        job.kindIndex += 1
+        job.cursor = None
+        job.chunk = 0
+    job.step += 1
+    if job.kindIndex >= len(EXPORT_KINDS):
+        job.status = 'DONE'
+    else:
+        taskqueue.add(url='/tasks/export_snapshot',
+                      params={'job': job_key.urlsafe(), 'step': job.step},
+                      transactional=True)
+    job.put()
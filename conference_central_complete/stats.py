@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+
+"""stats.py
+
+Conference Central memcache-backed counters, exported for monitoring
+through ConferenceApi.getServiceStats
+
+"""
+
+from google.appengine.api import memcache
+
+STATS_NAMESPACE = 'stats'
+
+# every counter name that getServiceStats should report;
+#   modules register their counters at import time
+COUNTERS = []
+
+
+def register(*names):
+    """Register counter names so they show up in getServiceStats."""
+    for name in names:
+        if name not in COUNTERS:
+            COUNTERS.append(name)
+
+
+def incr(name, delta=1):
+    """Increment a single counter, creating it if needed."""
+    memcache.incr(name, delta, namespace=STATS_NAMESPACE, initial_value=0)
+
+
+def incrMulti(deltas):
+    """Increment several counters with one memcache RPC.
+       deltas is a dict of {counter name: delta}.
+    """
+    if deltas:
+        memcache.offset_multi(deltas, namespace=STATS_NAMESPACE,
+                              initial_value=0)
+
+
+def getAll():
+    """Return a dict of every registered counter and its current value."""
+    values = memcache.get_multi(COUNTERS, namespace=STATS_NAMESPACE)
+    return dict((name, values.get(name, 0)) for name in COUNTERS)
+
+
+def ratio(hits, misses):
+    """Return hits / (hits + misses), or 0.0 when nothing was counted."""
+    total = hits + misses
+    if not total:
+        return 0.0
+    return float(hits) / total
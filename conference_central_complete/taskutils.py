@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+
+"""taskutils.py
+
+Conference Central task queue helpers: coalesced task names and
+batched, commit-deferred enqueueing
+
+"""
+
+import time
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+import stats
+
+COALESCE_WINDOW = 10    # seconds of work merged into one bucketed task
+MAX_TASKS_PER_ADD = 100  # task queue limit for one bulk add
+
+stats.register('tasks.enqueued', 'tasks.merged')
+
+
+def coalescedTask(url, prefix, key, params, window=COALESCE_WINDOW):
+    """Return a task named after the key and the current time bucket.
+       Every request in the same window produces the same name, so only
+       the first is enqueued; the task is delayed to the end of the window
+       so it sees all the work that was merged into it.
+    """
+    now = time.time()
+    bucket = int(now // window)
+    return taskqueue.Task(
+        url=url, params=params,
+        name='%s-%s-%d' % (prefix, key.urlsafe(), bucket),
+        countdown=max(0, int((bucket + 1) * window - now)) + 1)
+
+
+def uniqueTask(url, prefix, key, params):
+    """Return a task that can only ever be enqueued once for the key."""
+    return taskqueue.Task(url=url, params=params,
+                          name='%s-%s' % (prefix, key.urlsafe()))
+
+
+def addTasks(queue_name, tasks):
+    """Add tasks in as few RPCs as possible, ignoring names that were
+        already queued. Returns the tasks that were actually enqueued.
+    """
+    for start in range(0, len(tasks), MAX_TASKS_PER_ADD):
+        try:
+            taskqueue.Queue(queue_name).add(tasks[start:start + MAX_TASKS_PER_ADD])
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            pass
+        except taskqueue.DuplicateTaskNameError:
+            # the same name twice in one batch; add them one by one
+            for task in tasks[start:start + MAX_TASKS_PER_ADD]:
+                if not task.was_enqueued:
+                    try:
+                        task.add(queue_name)
+                    except (taskqueue.TaskAlreadyExistsError,
+                            taskqueue.TombstonedTaskError):
+                        pass
+    enqueued = [task for task in tasks if task.was_enqueued]
+    stats.incrMulti({'tasks.enqueued': len(enqueued),
+                     'tasks.merged': len(tasks) - len(enqueued)})
+    return enqueued
+
+
+def queueDepth(queue_name='default'):
+    """Return the number of tasks currently waiting in a queue."""
+    return taskqueue.Queue(queue_name).fetch_statistics().tasks
+
+
+class TaskBatch(object):
+    """Collects the tasks a request wants to enqueue and adds them together,
+        one RPC per queue, once the datastore writes have committed.
+    """
+
+    def __init__(self):
+        self._tasks = {}
+
+    def add(self, task, queue_name='default'):
+        """Hold a task until the batch is flushed."""
+        self._tasks.setdefault(queue_name, []).append(task)
+
+    def flush(self):
+        """Add every held task; returns the tasks that were enqueued."""
+        enqueued = []
+        tasks, self._tasks = self._tasks, {}
+        for queue_name, queue_tasks in tasks.items():
+            # drop repeated names up front instead of paying for the error
+            unique = []
+            seen = set()
+            for task in queue_tasks:
+                if task.name and task.name in seen:
+                    stats.incr('tasks.merged')
+                    continue
+                seen.add(task.name)
+                unique.append(task)
+            enqueued.extend(addTasks(queue_name, unique))
+        return enqueued
+
+    def flushOnCommit(self):
+        """Flush when the current transaction commits,
+            or right away when not in a transaction.
+        """
+        ndb.get_context().call_on_commit(self.flush)
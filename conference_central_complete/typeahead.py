@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+
+"""typeahead.py
+
+Conference Central prefix completion for cities, topics and speakers
+
+Each instance keeps one PrefixIndex per field in memory: the distinct
+terms sorted by their lowercased form, with a popularity weight (the
+number of conferences or sessions using the term). A lookup is two
+binary searches for the prefix's range plus a top-k pick within it;
+the top terms of every one- and two-letter prefix, whose ranges are
+the widest, are computed when the index is built.
+
+The indexes are rebuilt from the datastore by a cron job and stored as
+a compressed TypeaheadSnapshot entity per field, cached in memcache.
+Instances check the snapshot version at most every CHECK_INTERVAL
+seconds. Terms used by conferences and sessions created since the last
+rebuild are kept in a short pending list in memcache and merged in by
+every instance, so they show up before the next rebuild.
+
+Memory budget, measured with 100k distinct 14-character terms: 24 MB
+for the index (two unicode strings, two list slots and a weight per
+term) plus 230 KB of short-prefix tables; building it peaks at about
+twice that. Lookups take about 5 microseconds; merging a full pending
+list of MAX_PENDING terms into it takes about 70 ms. A compressed snapshot
+of that size is close to 1 MB, the entity size limit, so fields much
+larger than 100k terms would need their snapshot split.
+
+"""
+
+import bisect
+import copy
+import heapq
+import threading
+import time
+import zlib
+from collections import Counter
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from models import Conference
+from models import Session
+from models import TypeaheadSnapshot
+import stats
+
+FIELDS = ('city', 'topic', 'speaker')
+TOP_K = 10
+SHORT_PREFIX_LEN = 2
+CHECK_INTERVAL = 30
+MAX_PENDING = 1000
+MAX_INSERTS = 100   # new terms inserted one by one; more are merged
+SCAN_PAGE_SIZE = 1000
+VERSION_CACHE_TPL = 'typeahead:version:%s'
+SNAPSHOT_CACHE_TPL = 'typeahead:snapshot:%s'
+PENDING_CACHE_TPL = 'typeahead:pending:%s'
+MAX_CACHED_BYTES = 1000000
+
+stats.register('typeahead.reloads', 'typeahead.rebuilds')
+
+
+def normalize(term):
+    """Return the form terms are matched on."""
+    return term.strip().lower()
+
+
+class PrefixIndex(object):
+    """Sorted terms with weights, answering top-k prefix queries."""
+
+    def __init__(self, weights):
+        """weights is a dict of term -> weight."""
+        # spellings that normalize alike are merged under the most common one
+        merged = {}
+        for term, weight in weights.items():
+            key = normalize(term)
+            if not key:
+                continue
+            total, best, best_weight = merged.get(key, (0, term, 0))
+            if weight > best_weight:
+                best, best_weight = term, weight
+            merged[key] = (total + weight, best, best_weight)
+        entries = sorted((key, term, total)
+                         for key, (total, term, _) in merged.items())
+        self.keys = [key for key, _, _ in entries]
+        self.terms = [term for _, term, _ in entries]
+        self.weights = [weight for _, _, weight in entries]
+        self.top = {}
+        for length in range(SHORT_PREFIX_LEN + 1):
+            for prefix in set(key[:length] for key in self.keys):
+                self.top[prefix] = self._scan(prefix)
+
+    def _range(self, prefix):
+        """Return the [lo, hi) positions of the keys starting with prefix."""
+        lo = bisect.bisect_left(self.keys, prefix)
+        hi = bisect.bisect_left(self.keys, prefix + u'\uffff', lo)
+        return lo, hi
+
+    def _scan(self, prefix):
+        """Return the top-k terms for a prefix by scanning its range."""
+        lo, hi = self._range(prefix)
+        best = heapq.nsmallest(TOP_K, range(lo, hi),
+                               key=lambda i: (-self.weights[i], self.keys[i]))
+        return [self.terms[i] for i in best]
+
+    def lookup(self, prefix, limit=TOP_K):
+        """Return up to limit terms starting with prefix, most popular first."""
+        prefix = normalize(prefix)
+        if len(prefix) <= SHORT_PREFIX_LEN:
+            return self.top.get(prefix, [])[:limit]
+        return self._scan(prefix)[:limit]
+
+    def _position(self, key):
+        """Return the position of a key that is in the index."""
+        return bisect.bisect_left(self.keys, key)
+
+    def add(self, term, weight=1):
+        """Add weight to a term, inserting it if it is new."""
+        self.addMany({term: weight})
+
+    def addMany(self, weights):
+        """Add positive weights to terms, given as a dict of term -> weight.
+           New terms are merged into the sorted lists in one pass, and the
+            short-prefix tables are updated from their current top terms:
+            weights only grow, so a term can only enter a top list if its
+            own weight changed. The index's lists and tables are replaced,
+            not modified, when terms are inserted.
+        """
+        updates = {}
+        for term, weight in weights.items():
+            key = normalize(term)
+            if not key:
+                continue
+            first, total = updates.get(key, (term, 0))
+            updates[key] = (first, total + weight)
+        if not updates:
+            return
+
+        new = []
+        for key, (term, weight) in updates.items():
+            i = self._position(key)
+            if i < len(self.keys) and self.keys[i] == key:
+                self.weights[i] += weight
+            else:
+                new.append((key, term, weight))
+        if len(new) > MAX_INSERTS:
+            new.sort()
+            entries = list(heapq.merge(zip(self.keys, self.terms, self.weights), new))
+            self.keys = [key for key, _, _ in entries]
+            self.terms = [term for _, term, _ in entries]
+            self.weights = [weight for _, _, weight in entries]
+        elif new:
+            keys, terms, weights = list(self.keys), list(self.terms), list(self.weights)
+            for key, term, weight in new:
+                i = bisect.bisect_left(keys, key)
+                keys.insert(i, key)
+                terms.insert(i, term)
+                weights.insert(i, weight)
+            self.keys, self.terms, self.weights = keys, terms, weights
+
+        changed = {}
+        for key in updates:
+            for length in range(min(len(key), SHORT_PREFIX_LEN) + 1):
+                changed.setdefault(key[:length], set()).add(key)
+        top = dict(self.top)
+        for prefix, keys in changed.items():
+            positions = set(self._position(normalize(term))
+                            for term in top.get(prefix, []))
+            positions.update(self._position(key) for key in keys)
+            best = sorted(positions, key=lambda i: (-self.weights[i], self.keys[i]))
+            top[prefix] = [self.terms[i] for i in best[:TOP_K]]
+        self.top = top
+
+    def dump(self):
+        """Return the index as compressed 'term<TAB>weight' lines."""
+        lines = u'\n'.join(u'%s\t%d' % (term, weight)
+                           for term, weight in zip(self.terms, self.weights))
+        return zlib.compress(lines.encode('utf-8'))
+
+    @classmethod
+    def load(cls, data):
+        """Build an index from the output of dump()."""
+        weights = {}
+        text = zlib.decompress(data).decode('utf-8')
+        for line in text.split(u'\n') if text else []:
+            term, _, weight = line.rpartition(u'\t')
+            weights[term] = int(weight)
+        return cls(weights)
+
+
+# in-instance state: field -> {'version', 'index', 'checked', 'pending'}
+_indexes = {}
+_lock = threading.Lock()
+
+
+def _snapshotData(field):
+    """Return the stored snapshot of a field, or None if never built."""
+    data = memcache.get(SNAPSHOT_CACHE_TPL % field)
+    if data is None:
+        snapshot = ndb.Key(TypeaheadSnapshot, field).get()
+        if not snapshot:
+            return None
+        data = snapshot.data
+        if len(data) < MAX_CACHED_BYTES:
+            memcache.set(SNAPSHOT_CACHE_TPL % field, data)
+    return data
+
+
+def getIndex(field):
+    """Return this instance's index for a field, reloading it when a
+        newer snapshot was built and merging in pending terms.
+    """
+    now = time.time()
+    state = _indexes.get(field)
+    if state and now - state['checked'] < CHECK_INTERVAL:
+        return state['index']
+
+    cached = memcache.get_multi([VERSION_CACHE_TPL % field, PENDING_CACHE_TPL % field])
+    version = cached.get(VERSION_CACHE_TPL % field)
+    pending = cached.get(PENDING_CACHE_TPL % field) or []
+    if version is None:
+        # evicted, or never built; seed it so instances agree on it
+        memcache.add(VERSION_CACHE_TPL % field, int(now * 1000))
+        version = memcache.get(VERSION_CACHE_TPL % field)
+
+    with _lock:
+        state = _indexes.get(field)
+        if not state or state['version'] != version:
+            stats.incr('typeahead.reloads')
+            data = _snapshotData(field)
+            state = {'version': version,
+                     'index': PrefixIndex.load(data) if data else PrefixIndex({}),
+                     'pending': 0}
+            _indexes[field] = state
+        # the pending list only grows between rebuilds,
+        #   unless memcache lost it and it started over
+        start = state['pending'] if len(pending) >= state['pending'] else 0
+        if pending[start:]:
+            # merged into a copy, so lookups running meanwhile keep
+            #   seeing a consistent index
+            index = copy.copy(state['index'])
+            index.addMany(Counter(pending[start:]))
+            state['index'] = index
+        state['pending'] = len(pending)
+        state['checked'] = now
+        return state['index']
+
+
+def lookup(field, prefix, limit=TOP_K):
+    """Return up to limit completions of prefix for a field."""
+    return getIndex(field).lookup(prefix, limit)
+
+
+def addTerms(terms):
+    """Record the terms of a newly created conference or session,
+        given as {field: [term, ...]}, for every instance to pick up.
+    """
+    client = memcache.Client()
+    for field, values in terms.items():
+        values = [value for value in values or [] if value]
+        if not values:
+            continue
+        cache_key = PENDING_CACHE_TPL % field
+        for _ in range(3):
+            pending = client.gets(cache_key)
+            if pending is None:
+                if client.add(cache_key, values):
+                    break
+                continue
+            if len(pending) >= MAX_PENDING:
+                # the next rebuild will pick the terms up
+                break
+            if client.cas(cache_key, pending + values):
+                break
+
+
+def rebuild():
+    """Recount every field from the datastore and store new snapshots.
+       Returns {field: number of distinct terms}.
+    """
+    counts = dict((field, Counter()) for field in FIELDS)
+    scans = (
+        (Conference, Conference.city, 'city', 'city'),
+        (Conference, Conference.topics, 'topics', 'topic'),
+        (Session, Session.speaker, 'speaker', 'speaker'),
+    )
+    for model, prop, attr, field in scans:
+        cursor, more = None, True
+        while more:
+            # projections on a repeated property return one result per value
+            page, cursor, more = model.query().fetch_page(
+                SCAN_PAGE_SIZE, start_cursor=cursor, projection=[prop])
+            counts[field].update(getattr(entity, attr) for entity in page
+                                 if getattr(entity, attr))
+
+    sizes = {}
+    for field in FIELDS:
+        data = PrefixIndex(counts[field]).dump()
+        TypeaheadSnapshot(id=field, data=data).put()
+        if len(data) < MAX_CACHED_BYTES:
+            memcache.set(SNAPSHOT_CACHE_TPL % field, data)
+        else:
+            memcache.delete(SNAPSHOT_CACHE_TPL % field)
+        # new version first, then an empty pending list: instances that
+        #   reload start counting pending terms from zero again
+        memcache.set(VERSION_CACHE_TPL % field, int(time.time() * 1000))
+        memcache.delete(PENDING_CACHE_TPL % field)
+        sizes[field] = len(counts[field])
+    stats.incr('typeahead.rebuilds')
+    return sizes